@@ -9,6 +9,7 @@
 # Please also read SoRa/LICENSE
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 import json
+import numpy
 import random
 from optparse import OptionParser
 import dataReader
@@ -71,6 +72,24 @@ def readDataAndApplyFilters(config):
     return (labels, data)
 
 
+def filterRows(filterObj, labels, data):
+    """Works out which rows of the data a filter keeps, without changing the data.
+    Only works for filters that keep or throw away whole rows (fullRandom,
+    gridRandom, gridRegular).  The filters may reseed random, so its state is
+    put back afterwards.
+
+    :param filterObj: The filter, from modifierFactory
+    :param labels: The column headers
+    :param data: The data columns
+    :return: A sorted numpy array of the indexes of the rows kept
+    """
+    randomState = random.getstate()
+    rowLabel = "__row"  #Carry the row numbers through the filter as an extra column
+    kept = filterObj.apply(labels + [rowLabel], list(data) + [range(len(data[0]))])
+    random.setstate(randomState)
+    return numpy.array(sorted(int(row) for row in kept[-1]))
+
+
 #FullRandom takes removes points from the data completely randomly, as in, the resulting file will no longer be a full grid
 #It takes arguments:
 #seed:       The random seed to use.  0 will pull from os.urandom
@@ -24,6 +24,14 @@ except ImportError:
 #It's in a seperate function to avoid polluting the namespace shared
 #with the numpy math functions
 
+def modelString(indiv):
+    """The individual as a string.  With linear scaling (see sr_errorfuncs) the model
+    is a + b * the tree, so that's written out with the individual's a and b."""
+    scaling = getattr(indiv, "scaling", None)
+    if(scaling is None):
+        return str(indiv)
+    return "add(%r, mul(%r, %s))" % (scaling[0], scaling[1], str(indiv))
+
 class printLogging:
 
     def __init__(self, logFilename, printLevel, allRanksPrint, varslist, prettyPrint=True):
@@ -96,7 +104,7 @@ class printLogging:
 
             if(not hasSympy or not self.prettyPrint):  #simple case, no pretty printing
                 for (idx, indiv) in enumerate(population):
-                    print idx, ":", indiv.fitness, ":", indiv
+                    print idx, ":", indiv.fitness, ":", modelString(indiv)
 
             else:
                 #All the functions from symbreg_primitives must be represented here in a
@@ -126,10 +134,10 @@ class printLogging:
 
                 for (idx, indiv) in enumerate(population):
                     try:
-                        exec("expr = %s" % str(indiv))
+                        exec("expr = %s" % modelString(indiv))
                         print idx, ":", indiv.fitness, ":", expr
                     except:   #Backup case if symbreg can't handle simplifing the expression for some reason
-                        print idx, ":", indiv.fitness, ":", indiv
+                        print idx, ":", indiv.fitness, ":", modelString(indiv)
 
 
     def logPopulation(self, population):
@@ -142,4 +150,4 @@ class printLogging:
         if(logFile and (self.rank == 0 or self.allRanksPrint)):
             logFile.write("Rank %d population size: %d" % (self.rank, len(population)))
             for (idx, indiv) in enumerate(population):
-                logFile.write("%d: %s : %s" %( idx, str(indiv.fitness), str(indiv)))  
+                logFile.write("%d: %s : %s" %( idx, str(indiv.fitness), modelString(indiv)))  
@@ -23,8 +23,11 @@ from optparse import OptionParser
 
 import dataReader 
 import dataFilters 
+import sr_encoding
 import sr_factories
 import sr_migration
+import sr_mpi
+import sr_parallel
 import sr_primitives
 import printLogger
 
@@ -87,6 +90,20 @@ def main():
   configfile.close()  
   config = sr_factories.setDefaults(config, sr_factories.defaultConfigData)
 
+  #With distributed evaluation the ranks are split into islands.  The first rank of each
+  #island runs the algorithm, and from here on comm, rank and size are about those ranks.
+  #The other ranks just evaluate (see sr_mpi).
+  evalComm = None
+  distConfig = sr_factories.distributedEvaluationConfig(config)
+  if(config.has_key("incrementalEvaluation") and ((mpi and distConfig) or options.numThreads > 1)):
+    #The parents' node outputs and the mutation records only exist in the process that runs the algorithm
+    raise ValueError("incrementalEvaluation cannot be used with -t or distributedEvaluation")
+  if(mpi and distConfig):
+    (evalComm, comm) = sr_mpi.splitIslands(comm, distConfig["ranksPerIsland"])
+    if(comm is not None):
+      rank = comm.Get_rank()
+      size = comm.Get_size()
+
   #Set up logging and printing
   logger = printLogger.printLogging(config["logFilename"], options.printLevel,
                                       options.allRanksPrint, config["inVars"],
@@ -103,17 +120,11 @@ def main():
 
   #Read the infile data 
   (labels, data) = dataFilters.readDataAndApplyFilters(config)
+  if(evalComm is not None and distConfig["split"] == "rows"):
+    data = sr_mpi.shardRows(evalComm, data)  #Only keep this rank's rows
 
   #Set up the variables and primitives
-  pset = gp.PrimitiveSet("MAIN", len(config["inVars"]))  #Pass in the number of inVars here
-  sr_primitives.primitiveFactory(config["primitives"], pset)
-  sr_factories.constantFactory(config["constants"], pset)
-
-  #Rename the arguments to match the configuration file
-  rename_kwargs = {}
-  for ii in range(0, len(config["inVars"])):
-      rename_kwargs["ARG%d" % ii] = config["inVars"][ii]
-  pset.renameArguments(**rename_kwargs) 
+  pset = sr_factories.psetFactory(config)
 
   #Create and register the error / evaluation function
   hof = sr_factories.hofFactory(config)
@@ -122,6 +133,8 @@ def main():
     errorObj =  sr_errorfuncs.paretoErrorFuncFactory(config, labels, data, config)
   else:
     errorObj =  sr_errorfuncs.errorFuncFactory(config, labels, data, config)
+  if(evalComm is not None and distConfig["split"] == "rows"):
+    errorObj.setRowShards(evalComm)
   toolbox.register("evaluate", errorObj)
   creator.create("FitnessMin", base.Fitness, weights=errorObj.weight()) 
   creator.create("Individual", gp.PrimitiveTree, fitness=creator.FitnessMin)
@@ -131,6 +144,15 @@ def main():
   toolbox.register("individual", tools.initIterate, creator.Individual, toolbox.expr)
   toolbox.register("population", tools.initRepeat, list, toolbox.individual)
   toolbox.register("compile", gp.compile, pset=pset)
+  toolbox.register("evalTree", sr_factories.evaluatorFactory(config, pset))
+
+  #Ranks that only evaluate don't need the rest of the setup
+  if(evalComm is not None and comm is None):
+    if(distConfig["split"] == "rows"):
+      sr_mpi.shardWorker(evalComm, errorObj, pset)
+    else:
+      sr_mpi.evaluationWorker(evalComm, errorObj, pset)
+    return
   
   #Pick a selection algorithm
   sr_factories.selectionFactory("select", rank, config, toolbox)
@@ -143,14 +165,45 @@ def main():
   sr_factories.exprFactory("expr_mut", config, toolbox, pset) 
   sr_factories.registerMutator(config, toolbox, pset)
 
-  #Simple bloat control, set the depth limit (90 is the python limit, so it must be less <= 90)
+  #Simple bloat control, set the depth limit (90 is the python limit for the compile evaluator,
+  #so it must be less <= 90 unless the stack evaluator is used)
   toolbox.decorate("mate", gp.staticLimit(key=operator.attrgetter("height"), max_value=config["depthLimit"]))  
   toolbox.decorate("mutate", gp.staticLimit(key=operator.attrgetter("height"), max_value=config["depthLimit"]))
+  #Optional interval analysis, to skip trees that can't be evaluated anywhere on the data
+  sr_factories.registerIntervalAnalysis(config, toolbox, errorObj, pset)
+  #Optional algebraic simplification, before evaluation and/or after mate and mutate
+  sr_factories.registerSimplify(config, toolbox, errorObj, pset)
+  #Optional semantic fingerprints, trees that compute the same values share a fitness
+  sr_factories.registerFingerprint(config, toolbox, errorObj, pset)
 
   #Turn on optional multiprocessing as passed on command line.
-  if(options.numThreads > 1):
-    pool = multiprocessing.Pool(processes=options.numThreads)
-    toolbox.register("map", pool.map)
+  #The workers get the error function and data once, when they start up
+  batchConfig = {}
+  if(config.has_key("batchEvaluation")):
+    batchConfig = config["batchEvaluation"]
+  batchConfig = sr_factories.setDefaults(batchConfig, sr_factories.batchEvaluationDefaults)
+  pool = None
+  distributedMap = None
+  if(evalComm is not None):
+    if(options.numThreads > 1):
+      raise ValueError("-t cannot be used with distributedEvaluation, use more MPI ranks instead")
+    if(distConfig["split"] == "rows"):
+      distributedMap = sr_mpi.shardedMap(evalComm, errorObj, pset, logger)
+    else:
+      distributedMap = sr_mpi.mpiMap(evalComm, errorObj, pset, distConfig["batchesPerRank"], logger)
+    toolbox.register("map", distributedMap)
+  elif(options.numThreads > 1):
+    pool = sr_parallel.evaluationPool(options.numThreads, errorObj, pset)
+    toolbox.register("map", sr_parallel.poolMap(pool, options.numThreads, errorObj, pset,
+                                                batchConfig["batchesPerProcess"]))
+  else:
+    toolbox.register("map", sr_parallel.batchMap(errorObj))
+
+  #Put any of the optional evaluation layers (e.g. the fitness cache) in front of the map
+  evalMaps = sr_factories.registerEvaluationMap(config, toolbox, logger, hof)
+  #Optional fitting of the best individuals' constants, done every so often in the main loop
+  (constantOptimizer, constantOptimizationFreq) = sr_factories.constantOptimizerFactory(config, errorObj, pset, pool,
+                                                                                       options.numThreads, logger)
       
   if(config["seed"] == 0):  #a seed == 0 get the default seed os.urandom
     random.seed()
@@ -182,7 +235,8 @@ def main():
   checkpointsConfig = sr_factories.setDefaults(checkpointsConfig, sr_factories.checkpointsDefaults)
 
   algoArgs = config["algo"]  #Just a shorter name because the algorithm configuration is used a lot
-  algoArgs = sr_factories.registerAlgorithm(algoArgs, toolbox, mstats, hof,
+  algoHof = sr_factories.algorithmHallOfFame(config, hof, evalMaps, toolbox)
+  algoArgs = sr_factories.registerAlgorithm(algoArgs, toolbox, mstats, algoHof,
                                     verbose=(options.printLevel >=2 and (rank == 0 or options.allRanksPrint)));
 
   #If the user passed in a command line argument to load a checkpoint, see if a
@@ -223,9 +277,18 @@ def main():
   except AttributeError:
     pass
 
+  #Individuals are sent between ranks as compact encodings, not pickled
+  populationCodec = sr_encoding.populationCodec(pset, creator.Individual, errorObj)
+  migrator = None
+  if(mpi and size > 1 and config.has_key("islands")):
+    migrator = sr_migration.islandMigrator(comm, islandConfig["numMigrants"], toolbox.emmigrantSelect, replaceSelect,
+                                           islandConfig["topology"].lower(), islandConfig["degree"], config["seed"],
+                                           islandConfig["asynchronous"], islandConfig["maxAge"], populationCodec, logger)
+
   #vvvvvvvvvvvvvvvvvvvvvvvvvvvvv Main Loop vvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvv
   #Main Loop runs for "numGenerations" stopping every "stopFrequency" to see if something
-  #needs to be done. The two things that can be done are migration or taking a checkpoint.
+  #needs to be done. The things that can be done are constant optimization, migration or taking a checkpoint.
+  constantOptimizationCounter = 0
   migrationCounter = 0
   checkpointCounter = 0
   for ii in range(0, algoArgs["numGenerations"], algoArgs["stopFrequency"]):
@@ -235,34 +298,60 @@ def main():
 
     toolbox.algorithm(pop)
 
-    logger.printOut(5, "Population of rank: %d" % rank)
-    logger.printPopulation(5, pop)
+    if(logger.printLevel >= 5):  #Only worth re-scoring the population in float32 mode if it's printed
+      logger.printOut(5, "Population of rank: %d" % rank)
+      logger.printPopulation(5, sr_factories.exactPopulation(config, pop, algoHof))
+
+    #Replace individuals that compute the same thing as a smaller one with new random ones
+    if(hasattr(toolbox, "cullDuplicates")):
+      toolbox.cullDuplicates(pop)
+
+    #If the constant optimization counter is over its frequency, fit the constants of the best individuals
+    constantOptimizationCounter += algoArgs["stopFrequency"]
+    if(constantOptimizer and constantOptimizationCounter >= constantOptimizationFreq):
+      constantOptimizationCounter = 0
+      constantOptimizer.optimize(pop, toolbox, algoHof)
 
+    #Put in the immigrants that have arrived since the last stop, with asynchronous migration
+    if(migrator):
+      migrator.integrate(pop)
 
     #If the migration counter is over the migration freqency, it's time to migrate (if we have multiple islands)
     migrationCounter += algoArgs["stopFrequency"]
-    if(mpi and size > 1 and migrationCounter >= islandConfig["migrationFreq"]):  
+    if(migrator and migrationCounter >= islandConfig["migrationFreq"]):  
       migrationCounter = 0
-      sr_migration.MPIMigRing(comm, pop, islandConfig["numMigrants"], toolbox.emmigrantSelect, replaceSelect, logger)
+      migrator.migrate(pop)
 
     #If the checkpoint counter is over the checkpoint freqency, it's time to checkpoint
     checkpointCounter += algoArgs["stopFrequency"]
     if(checkpointsConfig["filenamebase"] and checkpointCounter >= checkpointsConfig["frequency"]):  
       checkpointCounter = 0
-      cp = dict(population=pop, halloffame=hof, rndstate=random.getstate())
+      cp = dict(population=sr_factories.exactPopulation(config, pop, algoHof), halloffame=hof, rndstate=random.getstate())
       with open("%s.%d.pkl" % (checkpointsConfig["filenamebase"], rank), "wb") as cp_file:
         cPickle.dump(cp, cp_file, 2)
   #^^^^^^^^^^^^^^^^ Main loop ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+  if(migrator):
+    migrator.finish()
+
+  if(distributedMap):
+    distributedMap.stop()
+    logger.printOut(3, distributedMap.report())
+  for evalMap in evalMaps:
+    logger.printOut(3, evalMap.report())
+  if(constantOptimizer):
+    logger.printOut(3, constantOptimizer.report())
+  if(migrator):
+    logger.printOut(3, migrator.report())
 
   #vvvvvvvvvvvvvvvv Run is done, compile all Hall of Fames from all ranks vvvvvvvv
   #mpi4py doesn't allow gather for object, so I wrote my own gather
   if(mpi and size > 1):
     if(rank == 0):
       for ii in range(1,size):
-        inpop = comm.recv(source=MPI.ANY_SOURCE)
+        inpop = populationCodec.decode(comm.recv(source=MPI.ANY_SOURCE))
         hof.update(inpop)
     else:
-      comm.send(hof.items, dest=0)
+      comm.send(populationCodec.encode(hof.items), dest=0)
 
 
   #Print out the final global Hall of Fame
@@ -0,0 +1,401 @@
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Copyright (c)2016, Lawrence Livermore National Security, LLC. 
+# Produced at the Lawrence Livermore National Laboratory. 
+# Written by Jim Leek <leek2@llnl.gov>. 
+# LLNL-CODE-704100. 
+# All rights reserved.
+#
+# This file is part of SoRa.  For details, see https://github.com/llnl/SoRa.
+# Please also read SoRa/LICENSE
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Benchmarks for the evaluation engine.  These set up the data, primitive set
+# and error function exactly the way a SoRa run would (from the same json
+# configuration file), then time evaluating a fixed random population.
+# The topologies benchmark runs whole island runs instead, under mpirun.
+#
+# usage: python sr_benchmark.py [options] configFile
+import os
+import operator
+import time
+import json
+import random
+import cPickle
+import numpy
+from optparse import OptionParser
+
+import dataFilters
+import printLogger
+import sr_factories
+import sr_errorfuncs
+import sr_encoding
+import sr_evaluators
+import sr_migration
+import sr_parallel
+import sr_simplify
+
+from globalData import *
+
+
+def add_options(op):
+    assert(isinstance(op, OptionParser))
+
+    op.add_option("-b", "--benchmark",
+                  action="store", dest="benchmark", type="string", default="evaluators",
+                  help="Which benchmark to run.  One of: %s" % ", ".join(sorted(benchmarks.keys())))
+    op.add_option("-i", "--input-file",
+                  action="store", dest="inputFile", type="string", default=None,
+                  help="The name of the input file")
+    op.add_option("-n", "--num-individuals",
+                  action="store", dest="numIndividuals", type="int", default=500,
+                  help="The number of random individuals to evaluate")
+    op.add_option("-r", "--repeats",
+                  action="store", dest="repeats", type="int", default=3,
+                  help="How many times to evaluate the population.  The best time is reported.")
+    op.add_option("-s", "--seed",
+                  action="store", dest="seed", type="int", default=314,
+                  help="The random seed used to make the population")
+    op.add_option("--target",
+                  action="store", dest="target", type="float", default=None,
+                  help="The error the topologies benchmark runs until the best island reaches")
+
+
+class benchmarkSetup(object):
+    """Everything a benchmark needs: the configuration, data, primitive set,
+    error function and a random population made with the configuration's "expr".
+    """
+
+    def __init__(self, config, numIndividuals, seed):
+        self.config = config
+        (self.labels, self.data) = dataFilters.readDataAndApplyFilters(config)
+        self.pset = sr_factories.psetFactory(config)
+        toolbox.register("evalTree", sr_factories.evaluatorFactory(config, self.pset))
+        self.errorObj = sr_errorfuncs.errorFuncFactory(config, self.labels, self.data, config)
+
+        random.seed(seed)
+        sr_factories.exprFactory("expr", config, toolbox, self.pset)
+        self.population = [gp.PrimitiveTree(toolbox.expr()) for ii in range(numIndividuals)]
+
+
+def timeEvaluations(errorObj, population, repeats, evaluator=None):
+    """Evaluates the population *repeats* times.  Each repeat is treated as a fresh
+    generation by evaluators that keep per generation state (the subtree cache).
+    :return (evalsPerSec, fitnesses): The evaluation rate of the fastest repeat, and the fitnesses
+    """
+    bestTime = None
+    for ii in range(repeats):
+        if(hasattr(evaluator, "newGeneration")):
+            evaluator.newGeneration()
+            evaluator.takeStats()  #So the stats left over are from the last repeat
+        start = time.time()
+        fitnesses = [errorObj(individual) for individual in population]
+        elapsed = time.time() - start
+        if(bestTime is None or elapsed < bestTime):
+            bestTime = elapsed
+    return (len(population) / max(bestTime, 1e-9), fitnesses)
+
+
+def benchEvaluators(setup, options):
+    """Compares the evaluators from sr_evaluators (compile vs stack vs grid vs buffered vs the subtree cache).
+    The subtree cache treats the whole population as one generation."""
+    print "Evaluating %d individuals on %d data points" % (len(setup.population), len(setup.errorObj.targetVarValues))
+    reference = None
+    for (name, extraConfig) in [("compile", {"evaluator" : "compile"}),
+                                ("stack", {"evaluator" : "stack"}),
+                                ("grid", {"evaluator" : "grid"}),
+                                ("buffered", {"evaluator" : "buffered"}),
+                                ("subtreeCache", {"subtreeCache" : {}})]:
+        config = dict(setup.config)
+        config.pop("subtreeCache", None)
+        config.update(extraConfig)
+        evaluator = sr_factories.evaluatorFactory(config, setup.pset)
+        toolbox.register("evalTree", evaluator)
+        (rate, fitnesses) = timeEvaluations(setup.errorObj, setup.population, options.repeats, evaluator)
+        if(reference is None):
+            reference = fitnesses
+        mismatches = sum(1 for (a, b) in zip(reference, fitnesses) if a != b)
+        print "%-12s : %10.1f evals/sec  (%d fitnesses differ from compile)" % (name, rate, mismatches)
+        if(hasattr(evaluator, "takeStats")):
+            print "               %s" % evaluator.formatStats(evaluator.takeStats())
+
+
+def benchBackends(setup, options):
+    """Compares the evaluation backends ("evalBackend"), numpy with the stack evaluator
+    against numexpr and numba.  Backends that aren't installed are skipped."""
+    print "Evaluating %d individuals on %d data points" % (len(setup.population), len(setup.errorObj.targetVarValues))
+    reference = None
+    for backend in ["numpy", "numexpr", "numba"]:
+        if((backend == "numexpr" and not sr_evaluators.hasNumexpr) or
+           (backend == "numba" and not sr_evaluators.hasNumba)):
+            print "%-8s : not installed" % backend
+            continue
+        config = dict(setup.config)
+        config.pop("subtreeCache", None)
+        config.pop("incrementalEvaluation", None)
+        config.update({ "evaluator" : "stack", "evalBackend" : backend })
+        start = time.time()
+        evaluator = sr_factories.evaluatorFactory(config, setup.pset)
+        setupTime = time.time() - start
+        toolbox.register("evalTree", evaluator)
+        (rate, fitnesses) = timeEvaluations(setup.errorObj, setup.population, options.repeats, evaluator)
+        if(reference is None):
+            reference = fitnesses
+        mismatches = sum(1 for (a, b) in zip(reference, fitnesses) if a != b)
+        worst = max([abs(a[0] - b[0]) / max(abs(a[0]), 1e-300) for (a, b) in zip(reference, fitnesses)
+                     if a != b and numpy.isfinite(a[0]) and numpy.isfinite(b[0])] or [0.0])
+        print "%-8s : %10.1f evals/sec  (%d fitnesses differ from numpy, by at most %.1e relative, %.2fs setup)" % \
+            (backend, rate, mismatches, worst, setupTime)
+        if(hasattr(evaluator, "takeStats")):
+            print "           %s" % evaluator.formatStats(evaluator.takeStats())
+
+
+def benchPrecision(setup, options):
+    """Compares evaluating in float64 and float32 ("precision"): the evaluation rate, and
+    how many pairs of individuals the float32 fitnesses put in the other order."""
+    print "Evaluating %d individuals on %d data points" % (len(setup.population), len(setup.errorObj.targetVarValues))
+    evaluator = toolbox.evalTree.func
+    context = setup.errorObj.getContext()
+    results = {}
+    for precision in ["float64", "float32"]:
+        context["precision"] = precision
+        setup.errorObj.setContext(context)
+        bestTime = None
+        for ii in range(options.repeats):
+            if(hasattr(evaluator, "newGeneration")):
+                evaluator.newGeneration()
+            start = time.time()
+            fitnesses = setup.errorObj.evaluateBatch(setup.population)
+            elapsed = time.time() - start
+            if(bestTime is None or elapsed < bestTime):
+                bestTime = elapsed
+        results[precision] = numpy.array([setup.errorObj.weight()[0] * fitness[0] for fitness in fitnesses])
+        print "%s : %10.1f evals/sec" % (precision, len(setup.population) / max(bestTime, 1e-9))
+    (exact, estimates) = (results["float64"], results["float32"])
+    with numpy.errstate(invalid='ignore'):
+        swapped = numpy.sign(estimates[:, numpy.newaxis] - estimates) * numpy.sign(exact[:, numpy.newaxis] - exact) < 0
+    numPairs = len(exact) * (len(exact) - 1) // 2
+    print "float32 puts %d of %d pairs in the other order (%.3f%%), %d fitnesses differ" % \
+        (numpy.sum(swapped) // 2, numPairs, 100.0 * numpy.sum(swapped) / 2 / max(numPairs, 1),
+         numpy.sum(exact != estimates))
+
+
+def poolPayloadBytes(func, items, numProcesses):
+    """The number of bytes pool.map pickles to send *items* to the workers.
+    pool.map splits the items into chunks of len/(4*processes) and pickles
+    the function along with every chunk."""
+    chunksize, extra = divmod(len(items), numProcesses * 4)
+    if extra:
+        chunksize += 1
+    total = 0
+    for start in range(0, len(items), chunksize):
+        total += len(cPickle.dumps((func, items[start:start + chunksize]), 2))
+    return total
+
+
+def benchPickle(setup, options):
+    """Measures the bytes sent to the -t worker pool per generation, before
+    (pool.map of the error function) and after (sr_parallel.poolMap)."""
+    from deap import creator, base
+    creator.create("BenchFitness", base.Fitness, weights=setup.errorObj.weight())
+    creator.create("BenchIndividual", gp.PrimitiveTree, fitness=creator.BenchFitness)
+    population = [creator.BenchIndividual(individual) for individual in setup.population]
+    toolbox.register("evaluate", setup.errorObj)
+    codec = sr_encoding.treeCodec(setup.pset)
+
+    print "Bytes sent to the pool per generation of %d individuals, %d data points" % \
+        (len(population), len(setup.errorObj.targetVarValues))
+    for numProcesses in [2, 4, 8, 16]:
+        before = poolPayloadBytes(toolbox.evaluate, population, numProcesses)
+        batches = sr_parallel.balancedBatches(population, numProcesses * 4)
+        tasks = [(0, setup.errorObj.getContext(), [codec.encode(population[idx]) for idx in batch])
+                 for batch in batches]
+        after = sum(len(cPickle.dumps((sr_parallel.evaluateEncodedBatch, [task]), 2)) for task in tasks)
+        print "%3d processes : before %10d bytes   after %8d bytes   (%.1fx smaller)" % \
+            (numProcesses, before, after, float(before) / after)
+
+
+def benchBatch(setup, options):
+    """Compares evaluating one individual at a time with errorFunc.evaluateBatch."""
+    print "Evaluating %d individuals on %d data points" % (len(setup.population), len(setup.errorObj.targetVarValues))
+    evaluator = toolbox.evalTree.func
+    (oneRate, oneFitnesses) = timeEvaluations(setup.errorObj, setup.population, options.repeats, evaluator)
+    bestTime = None
+    for ii in range(options.repeats):
+        if(hasattr(evaluator, "newGeneration")):
+            evaluator.newGeneration()
+        start = time.time()
+        batchFitnesses = setup.errorObj.evaluateBatch(setup.population)
+        elapsed = time.time() - start
+        if(bestTime is None or elapsed < bestTime):
+            bestTime = elapsed
+    batchRate = len(setup.population) / max(bestTime, 1e-9)
+    mismatches = sum(1 for (a, b) in zip(oneFitnesses, batchFitnesses) if a != b)
+    print "one at a time : %10.1f evals/sec" % oneRate
+    print "evaluateBatch : %10.1f evals/sec  (%d fitnesses differ)" % (batchRate, mismatches)
+
+
+def benchSimplify(setup, options):
+    """Compares the population before and after sr_simplify: average tree size,
+    evaluation rate, and whether any fitnesses changed."""
+    treeSimplifier = sr_simplify.simplifier(setup.pset, setup.config["inVars"], setup.errorObj.inVarValues)
+    start = time.time()
+    simplified = [treeSimplifier.simplify(gp.PrimitiveTree(individual)) for individual in setup.population]
+    simplifyRate = len(simplified) / max(time.time() - start, 1e-9)
+
+    print "Evaluating %d individuals on %d data points" % (len(setup.population), len(setup.errorObj.targetVarValues))
+    evaluator = toolbox.evalTree.func
+    (rate, fitnesses) = timeEvaluations(setup.errorObj, setup.population, options.repeats, evaluator)
+    (simplifiedRate, simplifiedFitnesses) = timeEvaluations(setup.errorObj, simplified, options.repeats, evaluator)
+    mismatches = sum(1 for (a, b) in zip(fitnesses, simplifiedFitnesses) if a != b)
+    print "original   : average size %6.2f  %10.1f evals/sec" % \
+        (numpy.mean([len(individual) for individual in setup.population]), rate)
+    print "simplified : average size %6.2f  %10.1f evals/sec  (%d fitnesses differ)" % \
+        (numpy.mean([len(individual) for individual in simplified]), simplifiedRate, mismatches)
+    print "simplify   : %10.1f trees/sec" % simplifyRate
+
+
+def benchIncremental(setup, options):
+    """Compares evaluating mutated children in full with incremental evaluation.  Each
+    individual in the population gets one child from the configuration's mutator, and
+    the parents are evaluated first (not timed), so every child can use its parent's
+    node outputs.  That's the best case: in a run, children that were also changed by
+    crossover, or whose parent's outputs were dropped, are evaluated in full."""
+    config = dict(setup.config)
+    config.pop("subtreeCache", None)
+    config["incrementalEvaluation"] = setup.config.get("incrementalEvaluation", {})
+    config["evalBackend"] = "numpy"
+    sr_factories.exprFactory("expr_mut", config, toolbox, setup.pset)
+    sr_factories.registerMutator(config, toolbox, setup.pset)
+    random.seed(options.seed)
+    children = [toolbox.mutate(gp.PrimitiveTree(parent))[0] for parent in setup.population]
+    print "Evaluating %d mutated children on %d data points, average size %.2f" % \
+        (len(children), len(setup.errorObj.targetVarValues), numpy.mean([len(child) for child in children]))
+
+    toolbox.register("evalTree", sr_evaluators.stackEvaluator(setup.pset))
+    (fullRate, fullFitnesses) = timeEvaluations(setup.errorObj, children, options.repeats)
+    evaluator = sr_factories.evaluatorFactory(config, setup.pset)
+    toolbox.register("evalTree", evaluator)
+    bestTime = None
+    for ii in range(options.repeats):
+        evaluator.clear()
+        for parent in setup.population:
+            setup.errorObj(parent)
+        evaluator.takeStats()  #So the stats left over are from the children
+        start = time.time()
+        fitnesses = [setup.errorObj(child) for child in children]
+        elapsed = time.time() - start
+        if(bestTime is None or elapsed < bestTime):
+            bestTime = elapsed
+    mismatches = sum(1 for (a, b) in zip(fullFitnesses, fitnesses) if a != b)
+    print "full        : %10.1f evals/sec" % fullRate
+    print "incremental : %10.1f evals/sec  (%d fitnesses differ from full)" % \
+        (len(children) / max(bestTime, 1e-9), mismatches)
+    print "              %s" % evaluator.formatStats(evaluator.takeStats())
+
+
+def benchTopologies(setup, options):
+    """Time to target for each island topology.  Run it with mpirun, every rank is an
+    island.  Each topology starts from the same populations and evolves with the
+    configuration's algorithm and islands section until the best fitness on any island
+    reaches --target, or numGenerations run out.  The evaluation layers (fitness cache,
+    etc.) are left out, so nothing carries over from one topology to the next.  The best
+    fitness is found with an allreduce at every stop, so asynchronous migration waits
+    there too."""
+    from mpi4py import MPI
+    from deap import creator, base
+    if(options.target is None):
+        raise ValueError("The topologies benchmark needs a --target")
+    comm = MPI.COMM_WORLD
+    (rank, size) = (comm.Get_rank(), comm.Get_size())
+    config = setup.config
+    sign = setup.errorObj.weight()[0]  #rSquared goes up, the errors go down
+
+    creator.create("BenchFitness", base.Fitness, weights=setup.errorObj.weight())
+    creator.create("BenchIndividual", gp.PrimitiveTree, fitness=creator.BenchFitness)
+    toolbox.register("evaluate", setup.errorObj)
+    toolbox.register("map", sr_parallel.batchMap(setup.errorObj))
+    toolbox.register("individual", tools.initIterate, creator.BenchIndividual, toolbox.expr)
+    toolbox.register("population", tools.initRepeat, list, toolbox.individual)
+    sr_factories.selectionFactory("select", rank, config, toolbox)
+    toolbox.register("mate", gp.cxOnePoint)
+    sr_factories.exprFactory("expr_mut", config, toolbox, setup.pset)
+    sr_factories.registerMutator(config, toolbox, setup.pset)
+    toolbox.decorate("mate", gp.staticLimit(key=operator.attrgetter("height"), max_value=config["depthLimit"]))
+    toolbox.decorate("mutate", gp.staticLimit(key=operator.attrgetter("height"), max_value=config["depthLimit"]))
+    islandConfig = sr_factories.setDefaults(config.get("islands", {}), sr_factories.islandsDefaults)
+    sr_factories.selectionFactory("emmigrantSelect", rank, islandConfig, toolbox)
+    sr_factories.selectionFactory("replacementSelect", rank, islandConfig, toolbox)
+    replaceSelect = getattr(toolbox, "replacementSelect", None)
+    codec = sr_encoding.populationCodec(setup.pset, creator.BenchIndividual, setup.errorObj)
+    logger = printLogger.printLogging(None, 0, False, config["inVars"], False)
+
+    if(rank == 0):
+        print "Time to reach %g on %d islands, migrating every %d generations" % \
+            (options.target, size, islandConfig["migrationFreq"])
+    for topology in sr_migration.topologies:
+        hof = tools.HallOfFame(1)
+        algoArgs = sr_factories.registerAlgorithm(config["algo"], toolbox, None, hof, False)
+        random.seed(options.seed + rank)
+        population = toolbox.population(n=algoArgs["initialPopulationSize"])
+        migrator = sr_migration.islandMigrator(comm, islandConfig["numMigrants"], toolbox.emmigrantSelect,
+                                               replaceSelect, topology, islandConfig["degree"], config["seed"],
+                                               islandConfig["asynchronous"], islandConfig["maxAge"], codec, logger)
+        comm.Barrier()
+        start = time.time()
+        (reached, generations, migrationCounter) = (False, 0, 0)
+        while(not reached and generations < algoArgs["numGenerations"]):
+            toolbox.algorithm(population)
+            generations += algoArgs["stopFrequency"]
+            migrator.integrate(population)
+            migrationCounter += algoArgs["stopFrequency"]
+            if(migrationCounter >= islandConfig["migrationFreq"]):
+                migrationCounter = 0
+                migrator.migrate(population)
+            best = sign * comm.allreduce(sign * hof[0].fitness.values[0], op=MPI.MAX)
+            reached = sign * best >= sign * options.target
+        elapsed = time.time() - start
+        migrator.finish()
+        if(rank == 0):
+            print "%-9s : %8.2f seconds, %5d generations, best %g%s" % \
+                (topology, elapsed, generations, best, "" if reached else "  (target not reached)")
+
+
+benchmarks = { "evaluators" : benchEvaluators,
+               "backends"   : benchBackends,
+               "precision"  : benchPrecision,
+               "pickle"     : benchPickle,
+               "batch"      : benchBatch,
+               "simplify"   : benchSimplify,
+               "incremental" : benchIncremental,
+               "topologies" : benchTopologies }
+
+
+def main():
+    parser = OptionParser()
+    parser.usage = "Times parts of the SoRa evaluation engine on the data and settings from\n" + \
+                   "a SoRa json configuration file.\n\n" + \
+                   "usage: %prog [options] configFile"
+    add_options(parser)
+    (options, args) = parser.parse_args()
+    numpy.seterr(all='ignore')  #Bad functions are expected, same as in a real run
+
+    if(len(args) != 1):
+        print parser.print_help()
+        exit(2)
+    configfile = open(args[0], "r")
+    config = json.load(configfile)
+    configfile.close()
+    config = sr_factories.setDefaults(config, sr_factories.defaultConfigData)
+
+    if(options.inputFile != None):
+        (config["infile"], config["infileExtension"]) = os.path.splitext(options.inputFile)
+    if(config["infileExtension"][0] == "."):
+        config["infileExtension"] = config["infileExtension"][1:]
+
+    if(not benchmarks.has_key(options.benchmark)):
+        raise ValueError("Unknown benchmark %s" % options.benchmark)
+    setup = benchmarkSetup(config, options.numIndividuals, options.seed)
+    benchmarks[options.benchmark](setup, options)
+
+
+if __name__ == "__main__":
+    main()
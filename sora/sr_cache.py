@@ -0,0 +1,464 @@
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Copyright (c)2016, Lawrence Livermore National Security, LLC. 
+# Produced at the Lawrence Livermore National Laboratory. 
+# Written by Jim Leek <leek2@llnl.gov>. 
+# LLNL-CODE-704100. 
+# All rights reserved.
+#
+# This file is part of SoRa.  For details, see https://github.com/llnl/SoRa.
+# Please also read SoRa/LICENSE
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Caches that let SoRa skip evaluating the same function over and over.
+# Crossover and mutation (especially mutEphemeral and HARM) keep producing
+# trees that have already been scored, so remembering fitnesses saves a
+# lot of evaluation time on big data sets.
+#
+# Trees that are written differently but compute the same thing (mul(x, 2) and
+# add(x, x)) get different treeKeys.  The semanticFingerprinter catches those by
+# what they compute: their values on a few fixed probe rows of the data.
+#
+# The persistentFitnessCache keeps the fitnesses in an sqlite file as well, so
+# later runs on the same data start out with everything earlier runs scored.
+import collections
+import cPickle
+import hashlib
+import math
+import numpy
+import sqlite3
+import time
+from deap import gp
+
+import sr_encoding
+import sr_errorfuncs
+
+
+def treeKey(individual):
+    """Makes a normalized string out of a tree, suitable for use as a cache key.
+    The tree is written out in prefix order (the way DEAP stores it) with the
+    constants written at full precision.  Integer constants (randint) keep
+    doing integer math (reciprocal(3) is 0), so they're written with "int:"
+    in front to keep them apart from the float constants with the same value.
+
+    :param individual: A PrimitiveTree
+    :return: A string that is the same for any two trees with the same nodes and constants
+    """
+    tokens = []
+    for node in individual:
+        if isinstance(node, gp.Primitive):
+            tokens.append(node.name)
+        elif isinstance(node.value, basestring):  #Arguments (inVars) have their name as value
+            tokens.append(node.value)
+        elif sr_encoding.isIntegerConstant(node.value):
+            tokens.append("int:" + repr(int(node.value)))
+        else:
+            tokens.append(repr(float(node.value)))
+    return " ".join(tokens)
+
+
+class fitnessCache(object):
+    """A bounded fitness cache.  When it's full, the least recently used
+    fitness is thrown away to make room.  cachedMap stores (fitness, attributes)
+    tuples, the attributes are the ones evaluation sets on the individual.
+    """
+
+    def __init__(self, maxSize):
+        """
+        :param maxSize: The maximum number of fitnesses to keep.
+        """
+        self.maxSize = maxSize
+        self.entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, key, persistent=True):
+        """Returns the cached entry for key, or None if we don't have it.
+
+        :param persistent: False if the entry only means something in this run (see persistentFitnessCache)
+        """
+        try:
+            fitness = self.entries.pop(key)
+        except KeyError:
+            return None
+        self.entries[key] = fitness  #Reinserting moves it to the most recently used end
+        return fitness
+
+    def store(self, key, fitness, persistent=True):
+        self.entries[key] = fitness
+        while(len(self.entries) > self.maxSize):
+            self.entries.popitem(last=False)
+
+    def flush(self):
+        """Called after each batch of lookups and stores.  Nothing to do in memory."""
+        pass
+
+
+class persistentFitnessCache(fitnessCache):
+    """A fitnessCache backed by an sqlite file that's kept from run to run.  Lookups
+    that miss in memory go to the file, and new entries are written to it in one
+    transaction per flush().  The keys in the file start with a context (a hash of
+    the data, filters and error function, see sr_factories.fitnessCacheContext), so
+    one file can be shared by runs on different data.
+
+    Several MPI ranks (or runs) can use the same file at once.  The file is in WAL
+    mode, so readers don't block the writer, and writers wait up to busyTimeout
+    seconds for each other.  If the file can't be used, it prints a warning and
+    carries on as a plain in-memory cache.  When the file has more than maxDiskSize
+    entries, the least recently used are deleted.
+    """
+
+    def __init__(self, maxSize, filename, context, maxDiskSize, busyTimeout=60.0):
+        """
+        :param maxSize:     The maximum number of fitnesses to keep in memory
+        :param filename:    The sqlite file, created if it doesn't exist
+        :param context:     A string that's the same for runs whose fitnesses are interchangeable
+        :param maxDiskSize: The maximum number of fitnesses to keep in the file
+        :param busyTimeout: Seconds to wait for another process that's writing the file
+        """
+        fitnessCache.__init__(self, maxSize)
+        self.filename = filename
+        self.context = context + ":"
+        self.maxDiskSize = maxDiskSize
+        self.pendingStores = {}    #key -> entry, written at the next flush
+        self.pendingHits = set()   #Keys read from the file, their lastUsed is updated at the next flush
+        self.diskHits = 0
+        self.diskStores = 0
+        self.diskEvictions = 0
+        self.connection = None
+        try:
+            #isolation_level None, so transactions are only the ones started in flush
+            self.connection = sqlite3.connect(filename, timeout=busyTimeout, isolation_level=None)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS fitness (key TEXT PRIMARY KEY, entry BLOB, lastUsed REAL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS fitnessLastUsed ON fitness (lastUsed)")
+        except sqlite3.Error as err:
+            print "WARNING: Unable to use fitness cache file %s (%s), only caching in memory" % (filename, err)
+            self.connection = None
+
+    def lookup(self, key, persistent=True):
+        entry = fitnessCache.lookup(self, key)
+        if(entry is not None or not persistent or self.connection is None):
+            return entry
+        try:
+            row = self.connection.execute("SELECT entry FROM fitness WHERE key = ?", (self.context + key,)).fetchone()
+        except sqlite3.Error:  #Locked for longer than busyTimeout, it's just a miss
+            return None
+        if(row is None):
+            return None
+        entry = cPickle.loads(str(row[0]))
+        fitnessCache.store(self, key, entry)
+        self.pendingHits.add(key)
+        self.diskHits += 1
+        return entry
+
+    def store(self, key, fitness, persistent=True):
+        fitnessCache.store(self, key, fitness)
+        if(persistent and self.connection is not None):
+            self.pendingStores[key] = fitness
+
+    def flush(self):
+        """Writes the new entries to the file, marks the ones that were read as used,
+        and evicts the least recently used if the file is over maxDiskSize."""
+        if(self.connection is None or not (self.pendingStores or self.pendingHits)):
+            return
+        now = time.time()
+        stores = [(self.context + key, buffer(cPickle.dumps(entry, 2)), now)
+                  for (key, entry) in self.pendingStores.iteritems()]
+        hits = [(now, self.context + key) for key in self.pendingHits]
+        try:
+            self.connection.execute("BEGIN IMMEDIATE")  #Take the write lock now, waiting up to busyTimeout
+            try:
+                self.connection.executemany("INSERT OR REPLACE INTO fitness VALUES (?, ?, ?)", stores)
+                self.connection.executemany("UPDATE fitness SET lastUsed = ? WHERE key = ?", hits)
+                count = self.connection.execute("SELECT COUNT(*) FROM fitness").fetchone()[0]
+                if(count > self.maxDiskSize):
+                    self.connection.execute("DELETE FROM fitness WHERE key IN "
+                                            "(SELECT key FROM fitness ORDER BY lastUsed LIMIT ?)",
+                                            (count - self.maxDiskSize,))
+                    self.diskEvictions += count - self.maxDiskSize
+                self.connection.execute("COMMIT")
+            except sqlite3.Error:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.diskStores += len(stores)
+        except sqlite3.Error as err:
+            print "WARNING: Unable to write fitness cache file %s (%s), %d fitnesses not saved" % \
+                (self.filename, err, len(stores))
+        self.pendingStores = {}
+        self.pendingHits = set()
+
+    def report(self):
+        return "%d hits from %s, %d written, %d evicted" % \
+            (self.diskHits, self.filename, self.diskStores, self.diskEvictions)
+
+
+class cachedMap(object):
+    """cachedMap sits in front of the map used for evaluation (toolbox.map).
+    The DEAP algorithms evaluate with toolbox.map(toolbox.evaluate, individuals),
+    so all the error functions (and the paretoErrorWrapper) go through here.
+    Only individuals not found in the cache are passed on to the inner map, so
+    the cache works the same whether the inner map is the builtin map or
+    pool.map from the -t option.  The cache itself always lives in the main process.
+    """
+
+    def __init__(self, cache, innerMap, logger=None):
+        """
+        :param cache:    A fitnessCache
+        :param innerMap: The map function to actually evaluate with
+        :param logger:   PrintLogger class.  Prints hit and miss counts each generation
+        """
+        self.cache = cache
+        self.innerMap = innerMap
+        self.logger = logger
+        self.generation = 0
+        self.totalHits = 0
+        self.totalMisses = 0
+
+    def __call__(self, func, individuals):
+        individuals = list(individuals)
+        fitnesses = [None] * len(individuals)
+        #Fitnesses from error functions on different rows (mini-batches) aren't interchangeable
+        errorObj = getattr(func, "func", func)
+        fitnessKey = getattr(errorObj, "fitnessKey", None)
+        prefix = ""
+        if(fitnessKey):
+            prefix = fitnessKey()
+        #The attributes evaluation sets on the individuals (linear scaling) are cached with the fitness
+        getAttributes = getattr(errorObj, "getAttributes", lambda individual: None)
+        #Fitnesses on a sample of the rows (mini-batches) only mean something in this run
+        persistent = True
+        if(hasattr(errorObj, "getContext")):
+            persistent = errorObj.getContext()["sampleId"] is None
+
+        #Individuals that aren't in the cache get evaluated.  If the same tree shows up
+        #more than once in this batch it's only evaluated once.
+        pending = collections.OrderedDict()  #key -> list of indexes into individuals
+        hits = 0
+        for (idx, individual) in enumerate(individuals):
+            key = prefix + treeKey(individual)
+            entry = self.cache.lookup(key, persistent)
+            if entry is not None:
+                (fitnesses[idx], attributes) = entry
+                if(attributes):
+                    errorObj.setAttributes(individual, attributes)
+                hits += 1
+            elif key in pending:
+                pending[key].append(idx)
+                hits += 1
+            else:
+                pending[key] = [idx]
+
+        toEvaluate = [individuals[idxs[0]] for idxs in pending.itervalues()]
+        results = self.innerMap(func, toEvaluate)
+        for ((key, idxs), fitness) in zip(pending.iteritems(), results):
+            attributes = getAttributes(individuals[idxs[0]])
+            if(not isinstance(fitness, sr_errorfuncs.racedFitness)):  #Only an estimate for this generation
+                self.cache.store(key, (fitness, attributes), persistent)
+            for idx in idxs:
+                fitnesses[idx] = fitness
+                if(attributes):
+                    errorObj.setAttributes(individuals[idx], attributes)
+        self.cache.flush()
+
+        misses = len(toEvaluate)
+        self.totalHits += hits
+        self.totalMisses += misses
+        if(self.logger):
+            self.logger.printOut(3, "Fitness cache generation %d: %d hits, %d misses, %d entries" %
+                                 (self.generation, hits, misses, len(self.cache)))
+        self.generation += 1
+        return fitnesses
+
+    def report(self):
+        """Returns a string with the hit and miss totals over the whole run."""
+        total = self.totalHits + self.totalMisses
+        hitRatio = 0.0
+        if(total > 0):
+            hitRatio = float(self.totalHits) / total
+        report = "Fitness cache total: %d hits, %d misses (%.1f%% hit ratio)" % \
+            (self.totalHits, self.totalMisses, 100.0 * hitRatio)
+        if(hasattr(self.cache, "report")):  #persistentFitnessCache
+            report += ", %s" % self.cache.report()
+        return report
+
+
+class semanticFingerprinter(object):
+    """Fingerprints trees by their function values on a small fixed set of probe rows.
+    The values are rounded to a number of significant digits (so trees that only
+    differ by rounding error match) and hashed.  Trees with the same fingerprint
+    are taken to be the same function on all the data.
+    """
+
+    def __init__(self, pset, inVarNames, inVarValues, probeRows, digits):
+        """
+        :param pset:        The primitive set the trees are made from
+        :param inVarNames:  The names of the input variables (config["inVars"])
+        :param inVarValues: The input variable arrays
+        :param probeRows:   How many rows to evaluate the trees on
+        :param digits:      How many significant digits of the values have to match
+        """
+        numPoints = len(inVarValues[0])
+        #A fixed random set of rows, picked without touching the run's random numbers.  Plus
+        #the rows where each variable is smallest, largest and closest to 0, since that's where
+        #trees that otherwise match are most likely to differ (div(x, x) and 1 at x = 0).
+        rows = numpy.arange(numPoints)
+        if(probeRows < numPoints):
+            rows = numpy.random.RandomState(0).choice(numPoints, probeRows, replace=False)
+            extremes = [[numpy.argmin(values), numpy.argmax(values), numpy.argmin(numpy.fabs(values))]
+                        for values in inVarValues]
+            rows = numpy.unique(numpy.concatenate([rows] + extremes))
+        self.numProbes = len(rows)
+        self.inVars = dict((name, numpy.asarray(values, dtype=float)[rows])
+                           for (name, values) in zip(inVarNames, inVarValues))
+        self.mantissaScale = 2.0 ** int(math.ceil(digits * math.log(10, 2)))
+        self.functions = {}
+        for primitives in pset.primitives.itervalues():
+            for primitive in primitives:
+                self.functions[primitive.name] = pset.context[primitive.name]
+
+    def values(self, individual):
+        """The function values of the tree on the probe rows."""
+        stack = []
+        for node in reversed(individual):
+            if isinstance(node, gp.Primitive):
+                args = [stack.pop() for ii in xrange(node.arity)]
+                stack.append(self.functions[node.name](*args))
+            elif isinstance(node.value, basestring):  #Arguments (inVars) have their name as value
+                stack.append(self.inVars[node.value])
+            else:
+                stack.append(node.value)
+        return numpy.broadcast_to(numpy.asarray(stack[0], dtype=float), (self.numProbes,))
+
+    def fingerprint(self, individual):
+        """:return: A hash of the rounded function values, or None if the tree can't be
+                    evaluated or isn't finite on the probe rows (it's left to the error function)"""
+        with numpy.errstate(all='ignore'):
+            try:
+                values = self.values(individual)
+            except (ArithmeticError, ValueError, TypeError):
+                return None
+            if(not numpy.all(numpy.isfinite(values))):
+                return None
+            (mantissas, exponents) = numpy.frexp(values)
+            mantissas = numpy.round(mantissas * self.mantissaScale).astype(numpy.int64)
+        return hashlib.sha1(mantissas.tostring() + exponents.astype(numpy.int32).tostring()).hexdigest()
+
+
+class fingerprintMap(object):
+    """fingerprintMap sits in front of the map used for evaluation (toolbox.map), like
+    cachedMap.  Individuals whose semantic fingerprint has already been scored get
+    that fitness without being evaluated on all the data.  The fitness is passed
+    through the error function's sharedFitness, so objectives that depend on the
+    tree itself (size) are still the individual's own.
+    """
+
+    def __init__(self, fingerprint, cache, innerMap, logger=None):
+        """
+        :param fingerprint: Fingerprints a tree (semanticFingerprinter.fingerprint)
+        :param cache:       A fitnessCache, keyed by fingerprint
+        :param innerMap:    The map function to actually evaluate with
+        :param logger:      PrintLogger class.  Prints hit and miss counts each generation
+        """
+        self.fingerprint = fingerprint
+        self.cache = cache
+        self.innerMap = innerMap
+        self.logger = logger
+        self.generation = 0
+        self.totalHits = 0
+        self.totalMisses = 0
+        self.totalUnkeyed = 0
+        self.totalCulled = 0
+
+    def __call__(self, func, individuals):
+        errorObj = getattr(func, "func", func)  #toolbox.evaluate is a partial
+        if(not hasattr(errorObj, "sharedFitness")):
+            return self.innerMap(func, individuals)
+        individuals = list(individuals)
+        fitnesses = [None] * len(individuals)
+        prefix = errorObj.fitnessKey()
+        getAttributes = getattr(errorObj, "getAttributes", lambda individual: None)
+
+        #Same as cachedMap, but the same function values instead of the same tree
+        pending = collections.OrderedDict()  #key -> list of indexes into individuals
+        unkeyed = []  #Indexes of the individuals that couldn't be fingerprinted
+        hits = 0
+        for (idx, individual) in enumerate(individuals):
+            fingerprint = self.fingerprint(individual)
+            if(fingerprint is None):
+                unkeyed.append(idx)
+                continue
+            key = prefix + fingerprint
+            entry = self.cache.lookup(key)
+            if entry is not None:
+                (fitness, attributes) = entry
+                fitnesses[idx] = errorObj.sharedFitness(fitness, individual)
+                if(attributes):
+                    errorObj.setAttributes(individual, attributes)
+                hits += 1
+            elif key in pending:
+                pending[key].append(idx)
+                hits += 1
+            else:
+                pending[key] = [idx]
+
+        toEvaluate = [idxs[0] for idxs in pending.itervalues()] + unkeyed
+        results = list(self.innerMap(func, [individuals[idx] for idx in toEvaluate]))
+        for (idx, fitness) in zip(toEvaluate, results):
+            fitnesses[idx] = fitness
+        for ((key, idxs), fitness) in zip(pending.iteritems(), results):
+            attributes = getAttributes(individuals[idxs[0]])
+            if(not isinstance(fitness, sr_errorfuncs.racedFitness)):  #Only an estimate for this generation
+                self.cache.store(key, (fitness, attributes))
+            for idx in idxs[1:]:
+                fitnesses[idx] = errorObj.sharedFitness(fitness, individuals[idx])
+                if(attributes):
+                    errorObj.setAttributes(individuals[idx], attributes)
+
+        misses = len(pending)
+        self.totalHits += hits
+        self.totalMisses += misses
+        self.totalUnkeyed += len(unkeyed)
+        if(self.logger):
+            self.logger.printOut(3, "Fingerprint generation %d: %d hits, %d misses, %d not fingerprinted" %
+                                 (self.generation, hits, misses, len(unkeyed)))
+        self.generation += 1
+        return fitnesses
+
+    def cull(self, population, toolbox):
+        """Replaces (in place) all but the smallest of the individuals in the population
+        that have the same fingerprint with new random individuals from toolbox.individual,
+        and evaluates those with toolbox.rescoreMap.
+
+        :return: The number of individuals replaced
+        """
+        kept = {}  #fingerprint -> index of the smallest individual with it
+        culled = []
+        for (idx, individual) in enumerate(population):
+            fingerprint = self.fingerprint(individual)
+            if(fingerprint is None):
+                continue
+            if(not kept.has_key(fingerprint)):
+                kept[fingerprint] = idx
+                continue
+            if(len(individual) < len(population[kept[fingerprint]])):
+                (kept[fingerprint], idx) = (idx, kept[fingerprint])
+            culled.append(idx)
+        if(culled):
+            newIndividuals = [toolbox.individual() for idx in culled]
+            fitnesses = toolbox.rescoreMap(toolbox.evaluate, newIndividuals)
+            for (idx, individual, fitness) in zip(culled, newIndividuals, fitnesses):
+                individual.fitness.values = fitness
+                population[idx] = individual
+        self.totalCulled += len(culled)
+        if(self.logger):
+            self.logger.printOut(3, "Fingerprint culling: %d duplicates replaced" % len(culled))
+        return len(culled)
+
+    def report(self):
+        """Returns a string with the number of full evaluations saved over the whole run."""
+        total = self.totalHits + self.totalMisses + self.totalUnkeyed
+        hitRatio = 0.0
+        if(total > 0):
+            hitRatio = float(self.totalHits) / total
+        return "Fingerprint total: %d full evaluations saved (%.1f%%), %d misses, %d not fingerprinted, %d duplicates culled" % \
+            (self.totalHits, 100.0 * hitRatio, self.totalMisses, self.totalUnkeyed, self.totalCulled)
@@ -0,0 +1,316 @@
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Copyright (c)2016, Lawrence Livermore National Security, LLC. 
+# Produced at the Lawrence Livermore National Laboratory. 
+# Written by Jim Leek <leek2@llnl.gov>. 
+# LLNL-CODE-704100. 
+# All rights reserved.
+#
+# This file is part of SoRa.  For details, see https://github.com/llnl/SoRa.
+# Please also read SoRa/LICENSE
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Constant optimization.  The constants from constantFactory only change through
+# mutEphemeral, a random walk that takes a long time to get several coefficients
+# right at once.  Every so often the best individuals have their constants fitted
+# to the data with Levenberg-Marquardt instead, and the fitted constants are
+# written back into the trees.
+#
+# The Jacobian is done with forward differences, but all the perturbed sets of
+# constants are evaluated together: each constant node holds a column of values,
+# one per set, and numpy broadcasting evaluates the tree for all of them in one
+# pass over the data.
+#
+# The fit minimizes the sum of squares of the error function's residuals (see
+# errorFunc.residuals).  The fitted constants are only kept if the error function
+# itself says the tree got better, so error functions that aren't a sum of
+# squares (maxAbsErrorSquared, etc.) never get worse.
+import numpy
+from deap import gp
+from deap import tools
+
+import sr_cache
+import sr_encoding
+import sr_parallel
+
+#The context the error function is given for fitting, all the rows in float64 and no racing
+fullContext = { "raceCutoff" : None, "sampleId" : None, "sampleRows" : None, "precision" : "float64" }
+
+
+def constantIndexes(tree):
+    """The indexes of the float constant nodes (ephemerals and folded constants) in the tree.
+    Integer constants (randint) do integer math (reciprocal(3) is 0), fitting them as
+    floats would change what the tree computes, so they're left as they are."""
+    return [idx for (idx, node) in enumerate(tree)
+            if not isinstance(node, gp.Primitive) and not isinstance(node.value, basestring) and
+            not sr_encoding.isIntegerConstant(node.value)]
+
+
+def withConstants(tree, constants):
+    """A copy of the tree with the constant nodes given new values.  Ephemeral
+    constants stay the same Ephemeral class, so mutEphemeral still works on them."""
+    nodes = list(tree)
+    for (idx, value) in zip(constantIndexes(tree), constants):
+        node = nodes[idx]
+        if isinstance(node, gp.Ephemeral):
+            newNode = type(node).__new__(type(node))  #Don't draw a new random value
+            gp.Terminal.__init__(newNode, float(value), False, node.ret)
+        else:
+            newNode = gp.Terminal(float(value), False, node.ret)
+        nodes[idx] = newNode
+    return tree.__class__(nodes)
+
+
+def scalingIdentifiable(values, columns):
+    """Which constants linear scaling doesn't undo.  If changing a constant only adds an
+    offset to the function values, or a multiple of them, a and b take it back out, and
+    its Jacobian column is just rounding noise.
+
+    :param values:  The function values
+    :param columns: (number of constants, number of points) array, the derivative of the
+                    function values with each constant
+    """
+    basis = [numpy.ones(len(values)) / numpy.sqrt(len(values))]
+    centered = values - numpy.mean(values)
+    if(numpy.dot(centered, centered) > 0):
+        basis.append(centered / numpy.sqrt(numpy.dot(centered, centered)))
+    left = columns.copy()
+    for vector in basis:
+        left -= numpy.dot(left, vector)[:, numpy.newaxis] * vector
+    return numpy.sqrt(numpy.sum(left ** 2, axis=1)) > 1e-6 * numpy.sqrt(numpy.sum(columns ** 2, axis=1))
+
+
+class treeFitter(object):
+    """Fits the constants of trees to the data with Levenberg-Marquardt.
+    """
+
+    def __init__(self, errorObj, pset, maxIterations):
+        """
+        :param errorObj:      The error function, for the data, residuals and to check the result
+        :param pset:          The primitive set the trees are made from
+        :param maxIterations: The most Levenberg-Marquardt iterations for each tree
+        """
+        self.errorObj = errorObj
+        self.linearScaling = errorObj.linearScaling
+        self.maxIterations = maxIterations
+        self.functions = {}
+        for primitives in pset.primitives.itervalues():
+            for primitive in primitives:
+                self.functions[primitive.name] = pset.context[primitive.name]
+        self.inVars = dict(zip(pset.arguments, errorObj.inVarValues))
+        self.numPoints = len(errorObj.inVarValues[0])
+
+    def evaluate(self, tree, constantIdx, constants):
+        """Evaluates the tree for several sets of constants at once.
+
+        :param constants: (number of sets, number of constants) array
+        :return: (number of sets, number of points) array of function values
+        """
+        columns = dict((idx, constants[:, jj:jj + 1]) for (jj, idx) in enumerate(constantIdx))
+        stack = []
+        for idx in xrange(len(tree) - 1, -1, -1):
+            node = tree[idx]
+            if isinstance(node, gp.Primitive):
+                args = [stack.pop() for ii in xrange(node.arity)]
+                stack.append(self.functions[node.name](*args))
+            elif idx in columns:
+                stack.append(columns[idx])
+            elif isinstance(node.value, basestring):  #Arguments (inVars) have their name as value
+                stack.append(self.inVars[node.value])
+            else:  #Integer constants aren't fitted
+                stack.append(node.value)
+        return numpy.broadcast_to(stack[0], (len(constants), self.numPoints))
+
+    def fit(self, tree):
+        """Levenberg-Marquardt on the tree's constants.
+        :return: The fitted constants, or None if the fit didn't get anywhere
+        """
+        constantIdx = constantIndexes(tree)
+        if(len(constantIdx) == 0):
+            return None
+        theta = numpy.array([float(tree[idx].value) for idx in constantIdx])
+        damping = 1e-3
+        improved = False
+        with numpy.errstate(all='ignore'):
+            try:
+                values = self.evaluate(tree, constantIdx, theta[numpy.newaxis, :])
+                residuals = self.errorObj.residuals(values)[0]
+                cost = numpy.dot(residuals, residuals)
+                for iteration in xrange(self.maxIterations):
+                    if(not numpy.isfinite(cost)):
+                        break
+                    #Forward differences, all the perturbed constants in one evaluation
+                    steps = numpy.sqrt(numpy.finfo(float).eps) * numpy.maximum(numpy.fabs(theta), 1.0)
+                    perturbed = theta + numpy.diag(steps)
+                    perturbedValues = self.evaluate(tree, constantIdx, perturbed)
+                    jacobian = (self.errorObj.residuals(perturbedValues) - residuals) / steps[:, numpy.newaxis]
+                    if(not numpy.all(numpy.isfinite(jacobian))):
+                        break
+                    #With linear scaling, constants that only shift or stretch the function (an
+                    #offset) have a column of rounding noise, which the damping doesn't hold back.
+                    #They'd wander off to huge values that cancel each other, so they stay put.
+                    free = numpy.ones(len(theta), dtype=bool)
+                    if(self.linearScaling):
+                        free = scalingIdentifiable(values[0], (perturbedValues - values) / steps[:, numpy.newaxis])
+                        if(not numpy.any(free)):
+                            break
+                        jacobian = jacobian[free]
+                    normal = numpy.dot(jacobian, jacobian.T)
+                    gradient = numpy.dot(jacobian, residuals)
+                    diagonal = numpy.diag(numpy.maximum(numpy.diag(normal), 1e-12))
+                    while(damping < 1e10):
+                        try:
+                            delta = numpy.linalg.solve(normal + damping * diagonal, -gradient)
+                        except numpy.linalg.LinAlgError:
+                            damping *= 10
+                            continue
+                        newTheta = theta.copy()
+                        newTheta[free] += delta
+                        newValues = self.evaluate(tree, constantIdx, newTheta[numpy.newaxis, :])
+                        newResiduals = self.errorObj.residuals(newValues)[0]
+                        newCost = numpy.dot(newResiduals, newResiduals)
+                        if(newCost < cost):
+                            break
+                        damping *= 10
+                    else:
+                        break  #No step makes it better, so we're at a minimum
+                    converged = (cost - newCost) <= 1e-12 * cost
+                    (theta, values, residuals, cost) = (newTheta, newValues, newResiduals, newCost)
+                    damping = max(damping / 10, 1e-12)
+                    improved = True
+                    if(converged):
+                        break
+            except (ArithmeticError, ValueError):  #Integer powers of negative numbers, etc.
+                pass
+        if(not improved):
+            return None
+        return theta
+
+    def optimize(self, trees):
+        """Fits the constants of each tree.  A fitted tree is only returned if the
+        error function says it's better than the original.
+        :return: A list with the fitted tree, or None, for each tree
+        """
+        sign = self.errorObj.weight()[0]
+        fitted = []
+        candidates = []
+        for tree in trees:
+            theta = self.fit(tree)
+            if(theta is None):
+                fitted.append(None)
+            else:
+                fitted.append(withConstants(tree, theta))
+                candidates.append(len(fitted) - 1)
+        if(candidates):
+            before = self.errorObj.evaluateBatch([trees[idx] for idx in candidates])
+            after = self.errorObj.evaluateBatch([fitted[idx] for idx in candidates])
+            for (idx, oldFitness, newFitness) in zip(candidates, before, after):
+                if(not sign * newFitness[0] > sign * oldFitness[0]):
+                    fitted[idx] = None
+        return fitted
+
+
+def optimizeEncodedBatch(task):
+    """Fits the constants of a batch of encoded trees in a -t worker process
+    (see sr_parallel.initWorker).
+
+    :param task: (maxIterations, list of encoded trees)
+    :return: A list with the encoded fitted tree, or None, for each tree
+    """
+    (maxIterations, encodedList) = task
+    errorObj = sr_parallel.workerState["errorObj"]
+    codec = sr_parallel.workerState["codec"]
+    errorObj.setContext(fullContext)
+    fitter = treeFitter(errorObj, sr_parallel.workerState["pset"], maxIterations)
+    fitted = fitter.optimize([codec.decode(encoded) for encoded in encodedList])
+    return [None if tree is None else codec.encode(tree) for tree in fitted]
+
+
+class constantOptimizer(object):
+    """Every so often takes the best individuals of the population and fits their
+    constants.  The individuals that got better get the fitted constants and are
+    re-evaluated with toolbox.rescoreMap, so the fitness goes through all the usual
+    evaluation layers (the fitness cache, mini-batches, etc.)
+    """
+
+    def __init__(self, errorObj, pset, topK, maxIterations, pool=None, numProcesses=1, logger=None):
+        """
+        :param errorObj:      The error function registered as toolbox.evaluate
+        :param pset:          The primitive set
+        :param topK:          How many of the best individuals to optimize each time
+        :param maxIterations: The most Levenberg-Marquardt iterations for each tree
+        :param pool:          The -t pool (see sr_parallel.evaluationPool), or None to fit here
+        :param numProcesses:  The number of processes in the pool
+        :param logger:        PrintLogger class
+        """
+        self.errorObj = errorObj
+        self.pset = pset
+        self.topK = topK
+        self.maxIterations = maxIterations
+        self.pool = pool
+        self.numProcesses = numProcesses
+        self.logger = logger
+        self.codec = sr_encoding.treeCodec(pset)
+        self.totalOptimized = 0
+        self.totalImproved = 0
+
+    def fitTrees(self, trees):
+        if(self.pool is None):
+            context = self.errorObj.getContext()
+            self.errorObj.setContext(fullContext)
+            try:
+                #Copies, so checking the fitted trees doesn't touch the population
+                trees = [gp.PrimitiveTree(tree) for tree in trees]
+                return treeFitter(self.errorObj, self.pset, self.maxIterations).optimize(trees)
+            finally:
+                self.errorObj.setContext(context)
+        batches = sr_parallel.balancedBatches(trees, self.numProcesses)
+        tasks = [(self.maxIterations, [self.codec.encode(trees[idx]) for idx in batch]) for batch in batches]
+        fitted = [None] * len(trees)
+        for (batch, results) in zip(batches, self.pool.map(optimizeEncodedBatch, tasks, chunksize=1)):
+            for (idx, encoded) in zip(batch, results):
+                if(encoded is not None):
+                    fitted[idx] = self.codec.decode(encoded)
+        return fitted
+
+    def optimize(self, population, toolbox, hallOfFame=None):
+        """Optimizes the constants of the topK best individuals in the population (in place).
+
+        :param toolbox:    The toolbox, its rescoreMap and evaluate re-evaluate the improved individuals
+        :param hallOfFame: Updated with the improved individuals
+        """
+        #The same tree can be in the population many times, only fit it once
+        candidates = {}
+        for individual in tools.selBest(population, len(population)):
+            if(len(candidates) >= self.topK):
+                break
+            if(individual.fitness.values[0] == self.errorObj.worstFitness()[0]):
+                continue
+            candidates.setdefault(sr_cache.treeKey(individual), individual)
+        trees = candidates.values()
+        fitted = self.fitTrees(trees)
+
+        improved = []
+        fittedByKey = {}
+        for (tree, fittedTree) in zip(trees, fitted):
+            if(fittedTree is not None):
+                fittedByKey[sr_cache.treeKey(tree)] = fittedTree
+        for individual in population:
+            fittedTree = fittedByKey.get(sr_cache.treeKey(individual))
+            if(fittedTree is not None):
+                individual[:] = list(fittedTree)
+                del individual.fitness.values
+                improved.append(individual)
+        if(improved):
+            fitnesses = toolbox.rescoreMap(toolbox.evaluate, improved)
+            for (individual, fitness) in zip(improved, fitnesses):
+                individual.fitness.values = fitness
+            if(hallOfFame is not None):
+                hallOfFame.update(improved)
+
+        self.totalOptimized += len(trees)
+        self.totalImproved += len(fittedByKey)
+        if(self.logger):
+            self.logger.printOut(3, "Constant optimization: %d of %d trees improved, %d individuals updated" %
+                                 (len(fittedByKey), len(trees), len(improved)))
+
+    def report(self):
+        return "Constant optimization total: %d of %d trees improved" % (self.totalImproved, self.totalOptimized)
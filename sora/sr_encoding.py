@@ -0,0 +1,156 @@
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Copyright (c)2016, Lawrence Livermore National Security, LLC. 
+# Produced at the Lawrence Livermore National Laboratory. 
+# Written by Jim Leek <leek2@llnl.gov>. 
+# LLNL-CODE-704100. 
+# All rights reserved.
+#
+# This file is part of SoRa.  For details, see https://github.com/llnl/SoRa.
+# Please also read SoRa/LICENSE
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Compact encodings of individuals for sending them between processes.
+# Pickling a DEAP individual sends every node object (and the class
+# references that go with them).  Instead each node is sent as a small
+# integer index into a table built from the primitive set, plus a table of
+# the constant values.  Both sides build the same table from the same
+# configuration file, so the tree can be rebuilt against the local pset.
+# Constants that aren't from an ephemeral (the ones sr_simplify folds) share
+# one extra code at the end of the table.
+import numpy
+from deap import gp
+
+
+def isIntegerConstant(value):
+    """Integer constants (randint, and the integers sr_simplify folds) do integer math
+    (reciprocal(3) is 0), so the cache keys, the codecs and the constant fitting keep
+    them apart from the float constants.  numpy integers count too."""
+    return isinstance(value, (int, long, numpy.integer))
+
+
+class treeCodec(object):
+    """Encodes and decodes trees for one primitive set.
+    An encoded tree is a tuple of two strings: the node codes (int16) and
+    the constant values (float64) in the order they appear in the tree.
+    Integer constants have their code stored as -(code + 1) and their value stored
+    as the bits of an int64, so they come back as the same integers and keep doing
+    integer math (reciprocal(3) is 0).
+    """
+
+    def __init__(self, pset):
+        #Primitives are sorted by name so the table doesn't depend on dictionary order.
+        #Terminals are kept in the order they were added to the pset.
+        self.table = []
+        for retType in sorted(pset.primitives.keys(), key=str):
+            self.table.extend(sorted(pset.primitives[retType], key=lambda prim: prim.name))
+        for retType in sorted(pset.terminals.keys(), key=str):
+            self.table.extend(pset.terminals[retType])
+        self.codes = {}
+        for (code, entry) in enumerate(self.table):
+            if isinstance(entry, gp.Primitive):
+                self.codes[entry.name] = code
+            elif isinstance(entry, gp.Terminal):
+                self.codes[entry.name] = code
+            else:  #An Ephemeral class, all its constants share the code
+                self.codes[entry] = code
+        self.constantCode = len(self.table)
+        self.ret = pset.ret
+
+    def encode(self, individual):
+        codes = []
+        constants = []
+        for node in individual:
+            if isinstance(node, gp.Primitive) or isinstance(node.value, basestring):
+                codes.append(self.codes[node.name])
+                continue
+            if isinstance(node, gp.Ephemeral):
+                code = self.codes[type(node)]
+            else:
+                code = self.constantCode
+            if isIntegerConstant(node.value):
+                codes.append(-(code + 1))
+                constants.append(numpy.int64(node.value).view(numpy.float64))
+            else:
+                codes.append(code)
+                constants.append(node.value)
+        return (numpy.array(codes, dtype=numpy.int16).tostring(),
+                numpy.array(constants, dtype=numpy.float64).tostring())
+
+    def decode(self, encoded, treeClass=gp.PrimitiveTree):
+        """Rebuilds the tree.
+        :param encoded:   The tuple from encode
+        :param treeClass: The class to make, usually gp.PrimitiveTree or creator.Individual
+        """
+        (codeString, constantString) = encoded
+        constants = iter(numpy.fromstring(constantString, dtype=numpy.float64))
+        nodes = []
+        for code in numpy.fromstring(codeString, dtype=numpy.int16):
+            convert = float
+            if(code < 0):
+                (code, convert) = (-code - 1, lambda value: int(value.view(numpy.int64)))
+            if(code == self.constantCode):
+                nodes.append(gp.Terminal(convert(constants.next()), False, self.ret))
+                continue
+            entry = self.table[code]
+            if isinstance(entry, (gp.Primitive, gp.Terminal)):
+                nodes.append(entry)  #DEAP shares these node objects between trees too
+            else:
+                #Don't call the Ephemeral constructor, it would draw a new random value
+                node = entry.__new__(entry)
+                gp.Terminal.__init__(node, convert(constants.next()), False, entry.ret)
+                nodes.append(node)
+        return treeClass(nodes)
+
+
+class populationCodec(object):
+    """Encodes a list of individuals, with their fitnesses, as one message for sending
+    between MPI ranks (migration and the hall of fame).  The message is a tuple of
+    strings: the node codes and constants of all the trees run together, the length
+    of each tree's codes and constants (int32), and the fitness values (float64, NaN
+    for individuals without a valid fitness).  The attributes evaluation sets (the
+    linear scaling) come last, or None if there aren't any.  Pickling the individuals
+    themselves sends every node, the fitness object and the creator class references.
+    """
+
+    def __init__(self, pset, individualClass, errorObj=None):
+        """
+        :param pset:            The primitive set the trees are made from
+        :param individualClass: The class of the decoded individuals (creator.Individual)
+        :param errorObj:        The error function, for the attributes on the individuals
+        """
+        self.codec = treeCodec(pset)
+        self.individualClass = individualClass
+        self.numObjectives = len(individualClass([]).fitness.weights)
+        self.getAttributes = getattr(errorObj, "getAttributes", lambda individual: None)
+        self.setAttributes = getattr(errorObj, "setAttributes", None)
+
+    def encode(self, individuals):
+        encoded = [self.codec.encode(individual) for individual in individuals]
+        lengths = numpy.array([(len(codes), len(constants)) for (codes, constants) in encoded], dtype=numpy.int32)
+        fitnesses = numpy.empty((len(individuals), self.numObjectives))
+        for (ii, individual) in enumerate(individuals):
+            fitnesses[ii] = individual.fitness.values if individual.fitness.valid else numpy.nan
+        attributes = [self.getAttributes(individual) for individual in individuals]
+        if(all(attribute is None for attribute in attributes)):
+            attributes = None
+        return ("".join(codes for (codes, constants) in encoded),
+                "".join(constants for (codes, constants) in encoded),
+                lengths.tostring(), fitnesses.tostring(), attributes)
+
+    def decode(self, message):
+        """Rebuilds the individuals, with their fitnesses, against the local pset."""
+        (codeString, constantString, lengthString, fitnessString, attributes) = message
+        lengths = numpy.fromstring(lengthString, dtype=numpy.int32).reshape(-1, 2)
+        fitnesses = numpy.fromstring(fitnessString, dtype=numpy.float64).reshape(len(lengths), self.numObjectives)
+        individuals = []
+        (codeStart, constantStart) = (0, 0)
+        for (ii, (codeLength, constantLength)) in enumerate(lengths):
+            individual = self.codec.decode((codeString[codeStart:codeStart + codeLength],
+                                            constantString[constantStart:constantStart + constantLength]),
+                                           self.individualClass)
+            (codeStart, constantStart) = (codeStart + codeLength, constantStart + constantLength)
+            if(not numpy.any(numpy.isnan(fitnesses[ii]))):
+                individual.fitness.values = tuple(float(value) for value in fitnesses[ii])
+            if(attributes is not None and self.setAttributes is not None):
+                self.setAttributes(individual, attributes[ii])
+            individuals.append(individual)
+        return individuals
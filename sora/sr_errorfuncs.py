@@ -8,7 +8,10 @@
 # This file is part of SoRa.  For details, see https://github.com/llnl/SoRa.
 # Please also read SoRa/LICENSE
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+import hashlib
+import math
 import numpy
+import random
 import sys
 from deap import algorithms
 from deap import base
@@ -18,126 +21,232 @@ from deap import gp
 
 from globalData import *
 
-#This is a basic error function that sums up all the absolute errors
-#and squares them.  At initialization time, it gets the data to compare against.
-#
-# The data is a list of lists, the labels give the names of interesting data.
-# The config file defines which data lists are of use.
-# All data lists are expected to be of equla length.  Repeated values are perfectly OK.
-# The config file defines a set of "inVars" which are the input variables.  (e.g. rho, T)
-# it also defines a single "targetVar" which is the array of function values.
-class totalAbsErrorSquared(object):
-    
-    def __init__(self, labels, data, config):
-        self.inVarValues = []
-        for inVar in config["inVars"]:
-            inVarIdx = labels.index(inVar)
-            self.inVarValues.append(numpy.array(data[inVarIdx]));  #Make a copy of each variable list
+try:
+    from mpi4py import MPI
+    hasMPI = True
+except ImportError:
+    hasMPI = False
 
-        targetVarIdx = labels.index(config["targetVar"])
-        self.targetVarValues = numpy.array(data[targetVarIdx])     #Make a copy of the target variable
+#The metrics the residualEngine can compute.  name : (weight, reduction), where
+#the reduction is "sum" or "max" if the metric is a running sum or max over the rows.
+#(Those can race, and sums are scaled up to all the rows when estimated from a sample.)
+errorMetrics = {
+    "totalAbsErrorSquared" : (-1.0, "sum"),
+    "avgAbsErrorSquared"   : (-1.0, None),
+    "maxAbsErrorSquared"   : (-1.0, "max"),
+    "avgRelError"          : (-1.0, None),
+    "totRelError"          : (-1.0, "sum"),
+    "maxRelError"          : (-1.0, "max"),
+    "rSquared"             : (1.0, None),
+    }
+relativeMetrics = ["avgRelError", "totRelError", "maxRelError"]
 
-    def weight(self):
-        return (-1.0,)
+#How each metric is put together when the rows are split across MPI ranks (see shardedEngine).
+#name : (statistic, how it's reduced over the ranks, divided by the number of rows).  The
+#statistics are the squared residuals, the relative errors or the residuals.  rSquared is
+#1 - (sum of squares) / variance, with the variance of the target over all the ranks.
+shardedMetrics = {
+    "totalAbsErrorSquared" : ("squares",   "sum", False),
+    "avgAbsErrorSquared"   : ("squares",   "sum", True),
+    "maxAbsErrorSquared"   : ("residuals", "max", False),
+    "avgRelError"          : ("relative",  "sum", True),
+    "totRelError"          : ("relative",  "sum", False),
+    "maxRelError"          : ("relative",  "max", False),
+    "rSquared"             : ("squares",   "sum", False),
+    }
 
-    def __call__(self, individual):
-        try:
-            # Transform the tree expression in a callable function
-            func = toolbox.compile(expr=individual)
 
-            sqerror = numpy.sum((func(*self.inVarValues) - self.targetVarValues)**2)
+#The residualEngine computes error metrics from function values.  The residuals
+#(approx - target) are computed once, and every metric that was asked for is
+#derived from them.  The things that only depend on the target (its inverse for
+#the relative errors, its variance for R^2) are worked out once, up front.
+class residualEngine(object):
 
-            if(numpy.isnan(sqerror)):
-                return (sys.float_info.max,)
-            return (sqerror,)
-        except :
-            return (sys.float_info.max,)
+    def __init__(self, targetVarValues, metrics):
+        """
+        :param targetVarValues: The target array
+        :param metrics:         The names of the metrics that will be asked for (see errorMetrics)
+        """
+        self.target = targetVarValues
+        self.numRows = len(targetVarValues)
+        for metric in metrics:
+            if(not errorMetrics.has_key(metric)):
+                raise ValueError("Unknown error metric %s" % metric)
+        self.inverseTarget = None
+        if(any(metric in relativeMetrics for metric in metrics)):
+            if(numpy.any(targetVarValues == 0)):
+                raise ValueError("Relative error (%s) cannot deal with 0's in the target data" %
+                                 ", ".join(metric for metric in metrics if metric in relativeMetrics))
+            self.inverseTarget = 1.0 / targetVarValues
+        self.meanTarget = numpy.mean(targetVarValues)
+        self.variance = numpy.sum((targetVarValues - self.meanTarget)**2)
 
+    def residuals(self, approx, metric):
+        """The residuals for least squares fitting with the metric: relative ones for
+        the relative errors, approx - target for the rest."""
+        residuals = approx - self.target
+        if(metric in relativeMetrics):
+            residuals *= self.inverseTarget
+        return residuals
 
-#This is a basic error function that finds the average of all the squared absolute errors
-#At initialization time, it gets the data to compare against.
-#
-# The data is a list of lists, the labels give the names of interesting data.
-# The config file defines which data lists are of use.
-# All data lists are expected to be of equla length.  Repeated values are perfectly OK.
-# The config file defines a set of "inVars" which are the input variables.  (e.g. rho, T)
-# it also defines a single "targetVar" which is the array of function values.
-class avgAbsErrorSquared(object):
-    
-    def __init__(self, labels, data, config):
-        self.inVarValues = []
-        for inVar in config["inVars"]:
-            inVarIdx = labels.index(inVar)
-            self.inVarValues.append(numpy.array(data[inVarIdx]));  #Make a copy of each variable list
+    def compute(self, approx, rows, metrics, sampleScale=1.0):
+        """Computes the metrics on the given rows in one pass.
 
-        targetVarIdx = labels.index(config["targetVar"])
-        self.targetVarValues = numpy.array(data[targetVarIdx])     #Make a copy of the target variable
+        :param approx:  Function values on the rows, or a 2-D array of them (one row per individual)
+        :param rows:    A slice or index array of the rows of the data
+        :param metrics: The names of the metrics
+        :param sampleScale: If the rows are a sample standing in for all the rows, the number
+                        of rows over the sample size.  Sums are scaled up to all the rows.
+        :return: A list of the metric values (reduced over the last axis), in the same order
+        """
+        residuals = approx - self.target[rows]
+        #Python numbers and numpy scalars make float64, so float32 sums need float32 scalars
+        sampleScale = self.target.dtype.type(sampleScale)
+        one = self.target.dtype.type(1)
+        squares = None
+        relative = None
+        values = []
+        for metric in metrics:
+            if(metric in ("totalAbsErrorSquared", "avgAbsErrorSquared", "rSquared") and squares is None):
+                squares = residuals * residuals
+            if(metric in relativeMetrics and relative is None):
+                relative = numpy.fabs(residuals) * self.inverseTarget[rows]
 
-    def weight(self):
-        return (-1.0,)
+            if(metric == "totalAbsErrorSquared"):
+                values.append(numpy.sum(squares, axis=-1) * sampleScale)
+            elif(metric == "avgAbsErrorSquared"):
+                values.append(numpy.mean(squares, axis=-1))
+            elif(metric == "maxAbsErrorSquared"):
+                values.append(numpy.max(residuals, axis=-1))
+            elif(metric == "avgRelError"):
+                values.append(numpy.mean(relative, axis=-1))
+            elif(metric == "totRelError"):
+                values.append(numpy.sum(relative, axis=-1) * sampleScale)
+            elif(metric == "maxRelError"):
+                values.append(numpy.max(relative, axis=-1))
+            elif(metric == "rSquared"):
+                values.append(one - (numpy.sum(squares, axis=-1) * sampleScale) / self.variance)
+        return values
 
-    def __call__(self, individual):
-        try:
-            # Transform the tree expression in a callable function
-            func = toolbox.compile(expr=individual)
 
-            sqerror = numpy.average((func(*self.inVarValues) - self.targetVarValues)**2)
-            if(numpy.isnan(sqerror)):
-                return (sys.float_info.max,)
-            return (sqerror,)
-        except NameError as ne:
-            print ne
-            print ne.message
-        except Exception as e:
-            return (sys.float_info.max,)
+#The shardedEngine is the residualEngine for when each MPI rank only has some of the
+#rows (see sr_mpi).  Every rank computes the sums and maxima of the statistics on its
+#rows, and they're combined with allreduce, so every rank gets the exact metrics for
+#all the rows.  The number of rows, and the mean and variance of the target, are for
+#all the rows too.  All the ranks have to call compute() with the same number of individuals.
+class shardedEngine(residualEngine):
 
+    def __init__(self, targetVarValues, metrics, comm, totals=None):
+        """
+        :param comm:   The communicator the rows are split across
+        :param totals: (number of rows, mean, variance) of the target over all the ranks.  If it's
+                       None they're worked out with allreduce, so all the ranks have to make their
+                       engine at the same time.
+        """
+        residualEngine.__init__(self, targetVarValues, metrics)
+        self.comm = comm
+        if(totals is None):
+            targetSum = comm.allreduce(float(numpy.sum(targetVarValues, dtype=numpy.float64)), op=MPI.SUM)
+            numRows = comm.allreduce(len(targetVarValues), op=MPI.SUM)
+            meanTarget = targetSum / numRows
+            deviations = numpy.asarray(targetVarValues, dtype=numpy.float64) - meanTarget
+            totals = (numRows, meanTarget, comm.allreduce(float(numpy.sum(deviations * deviations)), op=MPI.SUM))
+        (self.numRows, self.meanTarget, self.variance) = totals
+        self.totals = totals
 
-#This is a basic error function that returns the maximum absolute error
-# At initialization time, it gets the data to compare against.
-#
-# The data is a list of lists, the labels give the names of interesting data.
-# The config file defines which data lists are of use.
-# All data lists are expected to be of equla length.  Repeated values are perfectly OK.
-# The config file defines a set of "inVars" which are the input variables.  (e.g. rho, T)
-# it also defines a single "targetVar" which is the array of function values.
-class maxAbsErrorSquared(object):
-    
-    def __init__(self, labels, data, config):
-        self.inVarValues = []
-        for inVar in config["inVars"]:
-            inVarIdx = labels.index(inVar)
-            self.inVarValues.append(numpy.array(data[inVarIdx]));  #Make a copy of each variable list
+    def compute(self, approx, rows, metrics, sampleScale=1.0):
+        """Like residualEngine.compute, but for all the rows on all the ranks.  There are
+        no samples when the rows are split, so sampleScale has to be 1."""
+        residuals = approx - self.target[rows]
+        statistics = { "residuals" : residuals }
+        rules = [shardedMetrics[metric] for metric in metrics]
+        if(any(rule[0] == "squares" for rule in rules)):
+            statistics["squares"] = residuals * residuals
+        if(any(rule[0] == "relative" for rule in rules)):
+            statistics["relative"] = numpy.fabs(residuals) * self.inverseTarget[rows]
 
-        targetVarIdx = labels.index(config["targetVar"])
-        self.targetVarValues = numpy.array(data[targetVarIdx])     #Make a copy of the target variable
+        #Every statistic that's needed, once.  The last sum counts the NaNs, because
+        #MPI's max doesn't handle them, so they're inf until after the reduction.
+        reduced = []
+        for rule in rules:
+            if(rule[:2] not in reduced):
+                reduced.append(rule[:2])
+        sums = [numpy.sum(statistics[name], axis=-1) for (name, reduction) in reduced if reduction == "sum"]
+        sums.append(numpy.sum(numpy.isnan(residuals), axis=-1))
+        maxes = [numpy.max(statistics[name], axis=-1, initial=-numpy.inf) for (name, reduction) in reduced if reduction == "max"]
+        sums = numpy.array(sums, dtype=numpy.float64)
+        self.comm.Allreduce(MPI.IN_PLACE, sums, op=MPI.SUM)
+        if(maxes):
+            maxes = numpy.array(maxes, dtype=numpy.float64)
+            maxes[numpy.isnan(maxes)] = numpy.inf
+            self.comm.Allreduce(MPI.IN_PLACE, maxes, op=MPI.MAX)
+        hasNaN = sums[-1] > 0
 
-    def weight(self):
-        return (-1.0,)
+        totals = {}
+        (sumIdx, maxIdx) = (0, 0)
+        for (name, reduction) in reduced:
+            if(reduction == "sum"):
+                totals[(name, reduction)] = sums[sumIdx]
+                sumIdx += 1
+            else:
+                totals[(name, reduction)] = numpy.where(hasNaN, numpy.nan, maxes[maxIdx])
+                maxIdx += 1
+        values = []
+        for (metric, (name, reduction, average)) in zip(metrics, rules):
+            value = totals[(name, reduction)]
+            if(average):
+                value = value / self.numRows
+            if(metric == "rSquared"):
+                value = 1.0 - value / self.variance
+            values.append(value)
+        return values
 
-    def __call__(self, individual):
-        try:
-            # Transform the tree expression in a callable function
-            func = toolbox.compile(expr=individual)
 
-            error = numpy.max(func(*self.inVarValues) - self.targetVarValues)
+#The fitness of an individual that was dropped by racing.  It's an estimate that depends
+#on the cutoff it was raced against, so the fitness caches don't keep it: in a later
+#generation (or run) the individual might beat the cutoff and get its exact error.
+class racedFitness(tuple):
+    pass
 
-            if(numpy.isnan(error)):
-                return (sys.float_info.max,)
-            return (error,)
-        except :
-            return (sys.float_info.max,)
 
-#This is a basic error function that finds the average of all the relative errors.
-#Note that your data set should not contain any 0 values.  That will cause a "divide by zero" error.
-#At initialization time, it gets the data to compare against.
+#errorFunc is the base class for all the error functions.  At initialization time,
+#it gets the data to compare against.
 #
 # The data is a list of lists, the labels give the names of interesting data.
 # The config file defines which data lists are of use.
 # All data lists are expected to be of equla length.  Repeated values are perfectly OK.
 # The config file defines a set of "inVars" which are the input variables.  (e.g. rho, T)
 # it also defines a single "targetVar" which is the array of function values.
-class avgRelError(object):
-    
+#
+# The individual is evaluated with toolbox.evalTree (see sr_evaluators), and the
+# error is computed from the function values by the residualEngine.  The
+# subclasses just say which metric they are.  rowsError() turns the function
+# values on some rows of the data into the error, reducing over the last axis, so
+# it also works on a 2-D array of function values, one row per individual (see
+# evaluateBatch).
+#
+# The "errorfunc" in the config can also be a list of metrics (see errorMetrics),
+# which makes a multiMetricErrorFunc.  Its fitness has one objective per metric.
+#
+# Error functions that are a sum or max over the rows can race (see setupRacing):
+# the rows are evaluated a chunk at a time, and an individual is dropped as soon
+# as its partial error is over the cutoff, because it can only get worse.
+#
+# With mini-batches (see miniBatchMap) only a random sample of the rows is used
+# each generation, and the fitness is an estimate of the error on all the rows.
+#
+# With linear scaling (a "linearScaling" section in the config) the error is
+# computed on a + b * f(X) instead of f(X), where a and b are the least squares fit
+# of the function values to the target.  So the evolution doesn't have to find the
+# offset and scale with constants.  a and b are stored on the individual as
+# individual.scaling, and printLogger prints the scaled model.
+#
+# With the rows split across MPI ranks (see setRowShards and sr_mpi), each rank's
+# error function only has its own rows, and the shardedEngine combines the errors.
+class errorFunc(object):
+    raceReduce = None  #"sum" or "max" if the error is a running sum or max over the rows
+    metrics = []       #The residualEngine metrics this error function is made of
+
     def __init__(self, labels, data, config):
         self.inVarValues = []
         for inVar in config["inVars"]:
@@ -146,159 +255,429 @@ class avgRelError(object):
 
         targetVarIdx = labels.index(config["targetVar"])
         self.targetVarValues = numpy.array(data[targetVarIdx])     #Make a copy of the target variable
-        if(self.targetVarValues.__contains__(0)):
-            raise ValueError("Relative error (avgRelError) cannot deal with 0's in the target data")
+        self.shardComm = None   #The communicator the rows are split across, see setRowShards
+        self.engine = residualEngine(self.targetVarValues, self.metrics)
+        #The inputs and residualEngine for each precision the data is evaluated in (see setContext)
+        self.precisions = { "float64" : (self.inVarValues, self.engine) }
+        self.precision = "float64"
+        self.precisionInputs = self.inVarValues
+
+        #evaluateBatch works on blocks of individuals at a time, this bounds the size of a block
+        maxBlockMB = config.get("batchEvaluation", {}).get("maxBlockMB", 64)
+        self.maxBlockBytes = int(maxBlockMB * 1024 * 1024)
+
+        self.raceChunks = None  #(rows, inVarValues on those rows) for each chunk, when racing
+        self.raceCutoff = None
+        self.raceStats = self.emptyRaceStats()
+        self.sampleId = None    #Which sample (mini-batch or grid) sampleRows is, None means all the rows
+        self.sampleRows = None
+        self.sampleInputs = self.inVarValues
+        if(config.has_key("racing")):  #Set up here so -t workers get the chunks too
+            self.setupRacing(config["racing"].get("chunkSize", 1024))
+        self.linearScaling = config.has_key("linearScaling")
+        if(self.linearScaling and self.raceChunks is not None):
+            raise ValueError("linearScaling cannot be used with racing, a and b aren't known until all the rows are done")
 
     def weight(self):
         return (-1.0,)
 
-    def __call__(self, individual):
-        try:
-            # Transform the tree expression in a callable function
-            func = toolbox.compile(expr=individual)
-
-            error = numpy.fabs(func(*self.inVarValues) - self.targetVarValues) / self.targetVarValues
-            avgerror = numpy.average(error)
-            
-            if(numpy.isnan(avgerror)):
-                return (sys.float_info.max,)
-            return (avgerror,)
-        except NameError as ne:
-            print ne
-            print ne.message
-        except Exception as e:
-            return (sys.float_info.max,)
+    def worstFitness(self):
+        """The fitness given to functions that can't be evaluated (NaN, divide by 0, etc.)"""
+        return (-self.weight()[0] * sys.float_info.max,)
 
-#This is a basic error function that finds the total of all the relative errors.
-#Note that your data set should not contain any 0 values.  That will cause a "divide by zero" error.
-#At initialization time, it gets the data to compare against.
-#
-# The data is a list of lists, the labels give the names of interesting data.
-# The config file defines which data lists are of use.
-# All data lists are expected to be of equla length.  Repeated values are perfectly OK.
-# The config file defines a set of "inVars" which are the input variables.  (e.g. rho, T)
-# it also defines a single "targetVar" which is the array of function values.
-class totRelError(object):
-    
-    def __init__(self, labels, data, config):
-        self.inVarValues = []
-        for inVar in config["inVars"]:
-            inVarIdx = labels.index(inVar)
-            self.inVarValues.append(numpy.array(data[inVarIdx]));  #Make a copy of each variable list
+    def invalidFitness(self, individual):
+        """The fitness for an individual that is known to be bad without evaluating it."""
+        if(self.linearScaling):
+            individual.scaling = None
+        return self.worstFitness()
 
-        targetVarIdx = labels.index(config["targetVar"])
-        self.targetVarValues = numpy.array(data[targetVarIdx])     #Make a copy of the target variable
-        if(self.targetVarValues.__contains__(0)):
-            raise ValueError("Relative error (totRelError) cannot deal with 0's in the target data")
+    def getAttributes(self, individual):
+        """The attributes evaluation sets on an individual (the linear scaling), so they can
+        be sent back from -t workers and kept in the fitness cache.  None if there aren't any."""
+        if(not self.linearScaling):
+            return None
+        return { "scaling" : getattr(individual, "scaling", None) }
 
-    def weight(self):
-        return (-1.0,)
+    def setAttributes(self, individual, attributes):
+        if(attributes):
+            for (name, value) in attributes.iteritems():
+                setattr(individual, name, value)
 
-    def __call__(self, individual):
-        try:
-            # Transform the tree expression in a callable function
-            func = toolbox.compile(expr=individual)
-
-            error = numpy.fabs(func(*self.inVarValues) - self.targetVarValues) /  self.targetVarValues
-            sumerror = numpy.sum(error)
-            
-            if(numpy.isnan(sumerror)):
-                return (sys.float_info.max,)
-            return (sumerror,)
-        except NameError as ne:
-            print ne
-            print ne.message
-        except Exception as e:
-            return (sys.float_info.max,)
+    def scale(self, approx):
+        """Linear scaling.  Fits a + b * approx to the target by least squares, for each
+        row of approx in one vectorized pass.  Constant functions get b = 0.
 
-#This is a basic error function that finds the maximum of all the relative errors.
-#Note that your data set should not contain any 0 values.  That will cause a "divide by zero" error.
-#At initialization time, it gets the data to compare against.
-#
-# The data is a list of lists, the labels give the names of interesting data.
-# The config file defines which data lists are of use.
-# All data lists are expected to be of equla length.  Repeated values are perfectly OK.
-# The config file defines a set of "inVars" which are the input variables.  (e.g. rho, T)
-# it also defines a single "targetVar" which is the array of function values.
-class maxRelError(object):
-    
-    def __init__(self, labels, data, config):
-        self.inVarValues = []
-        for inVar in config["inVars"]:
-            inVarIdx = labels.index(inVar)
-            self.inVarValues.append(numpy.array(data[inVarIdx]));  #Make a copy of each variable list
+        :param approx: A 2-D array of function values on the current sample rows, one row per individual
+        :return (scaled, a, b): The scaled function values, and arrays of a and b
+        """
+        target = self.engine.target
+        if(self.sampleRows is not None):
+            target = target[self.sampleRows]
+        meanTarget = numpy.mean(target)
+        meanApprox = numpy.mean(approx, axis=-1)
+        centered = approx - meanApprox[:, numpy.newaxis]
+        variance = numpy.sum(centered * centered, axis=-1)
+        covariance = numpy.sum(centered * (target - meanTarget), axis=-1)  #Not dot, so the result doesn't depend on the block
+        b = numpy.zeros(len(approx))
+        nonConstant = variance > 0
+        b[nonConstant] = covariance[nonConstant] / variance[nonConstant]
+        b[numpy.isnan(variance)] = numpy.nan  #So NaN and inf functions still get the worst fitness
+        a = meanTarget - b * meanApprox
+        return (a[:, numpy.newaxis] + b[:, numpy.newaxis] * approx, a, b)
 
-        targetVarIdx = labels.index(config["targetVar"])
-        self.targetVarValues = numpy.array(data[targetVarIdx])     #Make a copy of the target variable
-        if(self.targetVarValues.__contains__(0)):
-            raise ValueError("Relative error (maxRelError) cannot deal with 0's in the target data")
+    def combine(self, values):
+        """Turns the list of metric values from the residualEngine into the error."""
+        return values[0]
 
-    def weight(self):
-        return (-1.0,)
+    def fitness(self, error, individual):
+        """The fitness tuple for an error from rowsError() or estimateError()."""
+        return (error,)
+
+    def sharedFitness(self, fitness, individual):
+        """The fitness for individual, given the fitness of a different tree with the same
+        function values (see sr_cache.fingerprintMap).  The error is the same, so only
+        objectives that depend on the tree itself (size) have to change."""
+        return fitness
+
+    def rowsError(self, approx, rows):
+        """The error of the function values approx on the given rows of the data.
+
+        :param approx: Function values on the rows, or a 2-D array of them (one row per individual)
+        :param rows:   A slice of the data
+        """
+        return self.combine(self.engine.compute(approx, rows, self.metrics))
+
+    def error(self, approx):
+        return self.rowsError(approx, slice(None))
+
+    def residuals(self, approx):
+        """The residuals on all the rows, for least squares fitting (see sr_constants).
+        The error is the sum of their squares, or at least gets smaller with it.
+        With linear scaling they're the residuals of the scaled function values.
+
+        :param approx: A 2-D array of function values, one row per individual
+        """
+        if(self.linearScaling):
+            approx = self.scale(approx)[0]
+        return self.engine.residuals(approx, self.metrics[0])
+
+    def estimateError(self, approx):
+        """The error on the current sample rows, as an estimate of the error on all the rows.
+        Sums are scaled up to the full number of rows, so estimates from different
+        size samples are comparable.  Without a sample, this is just error()."""
+        if(self.sampleRows is None):
+            return self.error(approx)
+        sampleScale = float(len(self.targetVarValues)) / len(self.sampleRows)
+        return self.combine(self.engine.compute(approx, self.sampleRows, self.metrics, sampleScale))
+
+    def setupRacing(self, chunkSize):
+        """Turns on racing: rows are evaluated chunkSize at a time, and once the cutoff is set
+        (with setContext) individuals whose partial error goes over it are dropped.  They get
+        a pessimistic fitness, the partial error extrapolated to all the rows (a racedFitness)."""
+        if(self.raceReduce is None):
+            raise ValueError("racing only works with sum or max error functions (totalAbsErrorSquared, maxAbsErrorSquared, totRelError, maxRelError), not %s" % self.__class__.__name__)
+        numPoints = len(self.targetVarValues)
+        self.raceChunks = []
+        for start in xrange(0, numPoints, chunkSize):
+            rows = slice(start, min(start + chunkSize, numPoints))
+            self.raceChunks.append((rows, [values[rows] for values in self.inVarValues]))
+
+    def getContext(self):
+        """The state that has to be sent along with the individuals to -t workers."""
+        return { "raceCutoff" : self.raceCutoff,
+                 "sampleId"   : self.sampleId,
+                 "sampleRows" : self.sampleRows,
+                 "precision"  : self.precision }
+
+    def setContext(self, context):
+        self.raceCutoff = context["raceCutoff"]
+        if(context["sampleId"] != self.sampleId or context["precision"] != self.precision):
+            #Only make new inputs when the sample changes, so the evaluators see the same
+            #inVarValues object for the whole generation
+            self.sampleId = context["sampleId"]
+            self.sampleRows = context["sampleRows"]
+            self.precision = context["precision"]
+            (self.precisionInputs, self.engine) = self.precisionData(self.precision)
+            if(self.sampleRows is None):
+                self.sampleInputs = self.precisionInputs
+            else:
+                self.sampleInputs = [values[self.sampleRows] for values in self.precisionInputs]
+
+    def precisionData(self, precision):
+        """The input arrays and residualEngine for evaluating in a precision ("float64" or
+        "float32").  They're made the first time the precision is used in each process."""
+        if(not self.precisions.has_key(precision)):
+            dtype = numpy.dtype(precision)
+            inputs = [values.astype(dtype) for values in self.inVarValues]
+            self.precisions[precision] = (inputs, self.makeEngine(self.targetVarValues.astype(dtype)))
+        return self.precisions[precision]
+
+    def makeEngine(self, targetVarValues):
+        """The residualEngine for the target (in some precision)."""
+        if(self.shardComm is None):
+            return residualEngine(targetVarValues, self.metrics)
+        return shardedEngine(targetVarValues, self.metrics, self.shardComm, self.engine.totals)
+
+    def setRowShards(self, comm):
+        """Says the data this error function was made with is only this rank's share of the
+        rows, and the rest are on the other ranks of comm (see sr_mpi.shardRows).  All the
+        ranks of comm have to call this together, and from then on evaluate the same
+        individuals together.  The errors are for all the rows."""
+        if(self.raceChunks is not None or self.linearScaling):
+            raise ValueError("racing and linearScaling cannot be used with the rows split across ranks")
+        self.shardComm = comm
+        self.engine = shardedEngine(self.targetVarValues, self.metrics, comm)
+        self.precisions = { "float64" : (self.inVarValues, self.engine) }
+        (self.precisionInputs, self.engine) = self.precisionData(self.precision)
+
+    def numRows(self):
+        """The number of rows of the data, on all the ranks if they're split."""
+        return self.engine.numRows
+
+    def dataKey(self):
+        """A hash of the data (inputs and target, after the filters), so fitnesses can be kept
+        for runs on the same data (see sr_cache.persistentFitnessCache)."""
+        digest = hashlib.sha1()
+        for values in self.inVarValues + [self.targetVarValues]:
+            digest.update(numpy.ascontiguousarray(values).tostring())
+        return digest.hexdigest()
+
+    def fitnessKey(self):
+        """Fitnesses are only comparable (and cachable) with others that have the same key."""
+        key = ""
+        if(self.precision != "float64"):
+            key += "%s:" % self.precision
+        if(self.sampleId is not None):
+            key += "%s:" % self.sampleId
+        return key
+
+    def emptyRaceStats(self):
+        return { "raced" : 0, "aborted" : 0, "rowsEvaluated" : 0, "rowsTotal" : 0 }
+
+    def takeStats(self):
+        """Returns the racing statistics since the last call, and resets them."""
+        stats = self.raceStats
+        self.raceStats = self.emptyRaceStats()
+        return stats
+
+    def mergeStats(self, stats):
+        """Adds in the racing statistics from a -t worker."""
+        for (key, value) in stats.iteritems():
+            self.raceStats[key] += value
+
+    def racing(self):
+        return self.raceChunks is not None and self.raceCutoff is not None
 
     def __call__(self, individual):
+        if(self.racing() or self.linearScaling or self.shardComm is not None):
+            return self.evaluateBatch([individual])[0]
         try:
-            # Transform the tree expression in a callable function
-            func = toolbox.compile(expr=individual)
-
-            error = numpy.fabs((func(*self.inVarValues) - self.targetVarValues)) / self.targetVarValues
-            maxerror = numpy.max(error)
-            
-            if(numpy.isnan(maxerror)):
-                return (sys.float_info.max,)
-            return (maxerror,)
-        except NameError as ne:
-            print ne
-            print ne.message
-        except Exception as e:
-            return (sys.float_info.max,)
+            approx = toolbox.evalTree(individual, self.sampleInputs)
+            error = self.estimateError(approx)
+
+            if(numpy.any(numpy.isnan(error))):
+                return self.worstFitness()
+            return self.fitness(error, individual)
+        except NameError:  #Means the primitive set is broken, not just this function
+            raise
+        except Exception:
+            return self.worstFitness()
+
+    def evaluateBatch(self, individuals):
+        """Evaluates a whole list of individuals at once.  The function values of a
+        block of individuals are stacked into a 2-D array (one row per individual),
+        and error() reduces all the rows in one vectorized call.  That saves the
+        per call overhead of __call__ for every individual.
+
+        :param individuals: A list of individuals
+        :return: A list of fitness tuples, in the same order
+        """
+        fitnesses = [None] * len(individuals)
+        numPoints = len(self.targetVarValues) if self.sampleRows is None else len(self.sampleRows)
+        dtype = self.engine.target.dtype
+        blockRows = numPoints
+        if(self.shardComm is not None):  #The block size has to be the same on every rank
+            blockRows = self.engine.numRows
+        blockSize = max(1, self.maxBlockBytes // (dtype.itemsize * blockRows))
+        for blockStart in xrange(0, len(individuals), blockSize):
+            block = individuals[blockStart:blockStart + blockSize]
+            if(self.racing()):
+                self.raceBlock(block, blockStart, fitnesses)
+                continue
+            approx = numpy.empty((len(block), numPoints), dtype=dtype)
+            rows = []  #The index (into individuals) of each row filled in approx
+            for (ii, individual) in enumerate(block):
+                try:
+                    approx[len(rows)] = toolbox.evalTree(individual, self.sampleInputs)
+                    rows.append(blockStart + ii)
+                except NameError:
+                    raise
+                except Exception:
+                    if(self.shardComm is not None):  #Every rank has to reduce the same individuals
+                        approx[len(rows)] = numpy.nan
+                        rows.append(blockStart + ii)
+                    else:
+                        fitnesses[blockStart + ii] = self.invalidFitness(individual)
+
+            approx = approx[:len(rows)]
+            if(self.linearScaling):
+                (approx, a, b) = self.scale(approx)
+                for (idx, aa, bb) in zip(rows, a, b):
+                    individuals[idx].scaling = (float(aa), float(bb))
+            errors = self.estimateError(approx)
+            for (idx, error) in zip(rows, errors):
+                if(numpy.any(numpy.isnan(error))):
+                    fitnesses[idx] = self.invalidFitness(individuals[idx])
+                else:
+                    fitnesses[idx] = self.fitness(error, individuals[idx])
+        return fitnesses
+
+    def raceBlock(self, block, blockStart, fitnesses):
+        """Evaluates a block of individuals a chunk of rows at a time, dropping
+        the ones that go over the cutoff.  The survivors' function values are
+        kept, so their error is computed exactly the same way as without racing.
+        """
+        numPoints = len(self.targetVarValues)
+        approx = numpy.empty((len(block), numPoints))
+        alive = range(len(block))  #Indexes into block (and rows of approx)
+        partial = numpy.zeros(len(block))
+        rowsDone = 0
+        for (chunkIdx, (rows, inputs)) in enumerate(self.raceChunks):
+            stillAlive = []
+            for ii in alive:
+                try:
+                    approx[ii, rows] = toolbox.evalTree(block[ii], inputs)
+                    stillAlive.append(ii)
+                except NameError:
+                    raise
+                except Exception:
+                    fitnesses[blockStart + ii] = self.worstFitness()
+            alive = stillAlive
+            self.raceStats["rowsEvaluated"] += len(alive) * (rows.stop - rows.start)
+            rowsDone = rows.stop
+            if(chunkIdx == len(self.raceChunks) - 1 or not alive):
+                break
+
+            errors = self.rowsError(approx[alive, rows], rows)
+            if(self.raceReduce == "sum"):
+                partial[alive] += errors
+            else:
+                partial[alive] = numpy.maximum(partial[alive], errors) if chunkIdx > 0 else errors
+            stillAlive = []
+            for ii in alive:
+                if(numpy.isnan(partial[ii])):
+                    fitnesses[blockStart + ii] = self.worstFitness()
+                elif(partial[ii] > self.raceCutoff):  #Can only get worse, so it's out
+                    if(self.raceReduce == "sum"):
+                        fitnesses[blockStart + ii] = racedFitness((partial[ii] * numPoints / rowsDone,))
+                    else:
+                        fitnesses[blockStart + ii] = racedFitness((partial[ii],))
+                    self.raceStats["aborted"] += 1
+                else:
+                    stillAlive.append(ii)
+            alive = stillAlive
+
+        if(alive):
+            errors = self.error(approx[alive])
+            for (ii, error) in zip(alive, errors):
+                if(numpy.isnan(error)):
+                    fitnesses[blockStart + ii] = self.worstFitness()
+                else:
+                    fitnesses[blockStart + ii] = (error,)
+        self.raceStats["raced"] += len(block)
+        self.raceStats["rowsTotal"] += len(block) * numPoints
+
+
+#This is a basic error function that sums up all the absolute errors
+#and squares them.
+class totalAbsErrorSquared(errorFunc):
+    raceReduce = "sum"
+    metrics = ["totalAbsErrorSquared"]
+
+
+#This is a basic error function that finds the average of all the squared absolute errors
+class avgAbsErrorSquared(errorFunc):
+    metrics = ["avgAbsErrorSquared"]
+
+
+#This is a basic error function that returns the maximum absolute error
+class maxAbsErrorSquared(errorFunc):
+    raceReduce = "max"
+    metrics = ["maxAbsErrorSquared"]
+
+#This is a basic error function that finds the average of all the relative errors.
+#Note that your data set should not contain any 0 values.  That will cause a "divide by zero" error.
+class avgRelError(errorFunc):
+    metrics = ["avgRelError"]
+
+#This is a basic error function that finds the total of all the relative errors.
+#Note that your data set should not contain any 0 values.  That will cause a "divide by zero" error.
+class totRelError(errorFunc):
+    raceReduce = "sum"
+    metrics = ["totRelError"]
+
+#This is a basic error function that finds the maximum of all the relative errors.
+#Note that your data set should not contain any 0 values.  That will cause a "divide by zero" error.
+class maxRelError(errorFunc):
+    raceReduce = "max"
+    metrics = ["maxRelError"]
 
 #R^2 is a common regression measurement to find how much variance is explained by the approximation.
 #It works well early on in the calcuation, but loses percision has the approximation becomes close.
-#
-# The data is a list of lists, the labels give the names of interesting data.
-# The config file defines which data lists are of use.
-# All data lists are expected to be of equla length.  Repeated values are perfectly OK.
-# The config file defines a set of "inVars" which are the input variables.  (e.g. rho, T)
-# it also defines a single "targetVar" which is the array of function values.
-class rSquared(object):
-    
-    def __init__(self, labels, data, config):
-        self.inVarValues = []
-        for inVar in config["inVars"]:
-            inVarIdx = labels.index(inVar)
-            self.inVarValues.append(numpy.array(data[inVarIdx]));  #Make a copy of each variable list
-
-        targetVarIdx = labels.index(config["targetVar"])
-        self.targetVarValues = numpy.array(data[targetVarIdx])     #Make a copy of the target variable
-        self.meanTarget = numpy.average(self.targetVarValues)
-        self.variance = sum((self.targetVarValues-self.meanTarget)**2)
+class rSquared(errorFunc):
+    metrics = ["rSquared"]
 
     def weight(self):  #We want to maximize R^2
         return (1.0,)
 
-    def __call__(self, individual):
-        try:
-            # Transform the tree expression in a callable function
-            func = toolbox.compile(expr=individual)
 
-            sumSqErrors = sum((func(*self.inVarValues) - self.targetVarValues)**2)
-            r2 = 1 - (sumSqErrors/self.variance)
-            
-            if(numpy.isnan(r2)):
-                return (sys.float_info.max,)
-            return (r2,)
-        except NameError as ne:
-            print ne
-            print ne.message
-        except Exception as e:
-            return (-sys.float_info.max,)
+#multiMetricErrorFunc is a multi-objective error function made of any set of the
+#errorMetrics, all computed in one pass over the residuals.  "size" can be in the
+#list too, for the number of nodes in the tree (like paretoErrorWrapper adds).
+class multiMetricErrorFunc(errorFunc):
 
+    def __init__(self, labels, data, config, objectives):
+        """
+        :param objectives: The list of metric names (and "size"), one per objective
+        """
+        self.objectives = objectives
+        self.metrics = [objective for objective in objectives if objective != "size"]
+        if(len(self.metrics) == 0):
+            raise ValueError("errorfunc needs at least one error metric, not just size")
+        errorFunc.__init__(self, labels, data, config)
+
+    def weight(self):
+        return tuple(-1.0 if objective == "size" else errorMetrics[objective][0]
+                     for objective in self.objectives)
+
+    def worstFitness(self):
+        return tuple(-weight * sys.float_info.max for weight in self.weight())
+
+    def combine(self, values):
+        return numpy.stack(values, axis=-1)
+
+    def fitness(self, error, individual):
+        error = iter(error)
+        return tuple(float(len(individual)) if objective == "size" else error.next()
+                     for objective in self.objectives)
+
+    def sharedFitness(self, fitness, individual):
+        return tuple(float(len(individual)) if objective == "size" else value
+                     for (objective, value) in zip(self.objectives, fitness))
 
 
 def errorFuncFactory(indict, labels, data, config):
     modtype = indict["errorfunc"]
 
+    if(isinstance(modtype, list)):
+        metricNames = dict((name.lower(), name) for name in errorMetrics.keys() + ["size"])
+        objectives = []
+        for name in modtype:
+            if(not metricNames.has_key(name.lower())):
+                raise ValueError("Unknown error metric %s" % name)
+            objectives.append(metricNames[name.lower()])
+        return multiMetricErrorFunc(labels, data, config, objectives)
+
     if(modtype.lower() == "rsquared"):
         return rSquared(labels, data, config)
     if(modtype.lower() == "avgabserrorsquared"):
@@ -322,6 +701,8 @@ def errorFuncFactory(indict, labels, data, config):
 class paretoErrorWrapper:
     def __init__(self, singleErrorFunc):
         self.errorFunc = singleErrorFunc
+        self.inVarValues = singleErrorFunc.inVarValues
+        self.linearScaling = singleErrorFunc.linearScaling
 
     def weight(self):  #We want to maximize R^2
         singleWeight = self.errorFunc.weight()
@@ -330,8 +711,385 @@ class paretoErrorWrapper:
     def __call__(self, individual):
         fitness = self.errorFunc(individual)
         complexity = len(individual)  #Still using the rough complexity measure for now
-        return fitness + (complexity,)
+        return type(fitness)(fitness + (complexity,))  #Keeps a racedFitness a racedFitness
+
+    def evaluateBatch(self, individuals):
+        fitnesses = self.errorFunc.evaluateBatch(individuals)
+        return [type(fitness)(fitness + (len(individual),)) for (fitness, individual) in zip(fitnesses, individuals)]
+
+    def worstFitness(self):
+        """The worst error, and the biggest size, so it has an entry for every objective."""
+        return self.errorFunc.worstFitness() + (sys.float_info.max,)
+
+    def invalidFitness(self, individual):
+        return self.errorFunc.invalidFitness(individual) + (len(individual),)
+
+    def sharedFitness(self, fitness, individual):
+        return self.errorFunc.sharedFitness(fitness[:-1], individual) + (len(individual),)
+
+    def fitnessKey(self):
+        return self.errorFunc.fitnessKey()
+
+    def residuals(self, approx):
+        return self.errorFunc.residuals(approx)
+
+    def getAttributes(self, individual):
+        return self.errorFunc.getAttributes(individual)
+
+    def setAttributes(self, individual, attributes):
+        self.errorFunc.setAttributes(individual, attributes)
+
+    def numRows(self):
+        return self.errorFunc.numRows()
+
+    def dataKey(self):
+        return self.errorFunc.dataKey()
+
+    def setRowShards(self, comm):
+        self.errorFunc.setRowShards(comm)
+
+    def getContext(self):
+        return self.errorFunc.getContext()
+
+    def setContext(self, context):
+        self.errorFunc.setContext(context)
+
+    def takeStats(self):
+        return self.errorFunc.takeStats()
+
+    def mergeStats(self, stats):
+        self.errorFunc.mergeStats(stats)
+
+#racingMap sits in front of the map used for evaluation (toolbox.map) when racing.
+#Before each generation is evaluated it sets the cutoff on the error function, and
+#afterwards it works out the cutoff for the next generation.  The cutoff comes
+#from either the errors of the last generation evaluated ("population"), or the
+#worst error in the hall of fame ("halloffame").
+#Individuals evaluated between generations (constant optimization, culling) go
+#through rescoreMap instead, which races them but doesn't learn the cutoff from
+#them: they're a few elites or random newcomers, not a generation.
+class racingMap(object):
+
+    def __init__(self, errorObj, innerMap, raceConfig, hallOfFame=None, logger=None):
+        """
+        :param errorObj:   The error function registered as toolbox.evaluate
+        :param innerMap:   The map function to actually evaluate with
+        :param raceConfig: The "racing" configuration (see sr_factories.racingDefaults)
+        :param hallOfFame: The hall of fame, for the "halloffame" cutoff
+        :param logger:     PrintLogger class.  Prints the abort rate each generation
+        """
+        self.errorObj = errorObj
+        self.innerMap = innerMap
+        self.cutoffType = raceConfig["cutoff"].lower()
+        if(self.cutoffType not in ["population", "halloffame"]):
+            raise ValueError("Unknown racing cutoff %s" % raceConfig["cutoff"])
+        self.quantile = raceConfig["quantile"]
+        self.scale = raceConfig["scale"]
+        self.hallOfFame = hallOfFame
+        self.logger = logger
+        self.lastErrors = []
+        self.generation = 0
+        self.totals = self.errorObj.takeStats()
+
+    def cutoff(self):
+        """The error an individual has to beat to be evaluated on all the rows, or None
+        if there isn't enough information yet."""
+        if(self.cutoffType == "halloffame"):
+            if(self.hallOfFame is None or len(self.hallOfFame) == 0):
+                return None
+            return self.scale * max(individual.fitness.values[0] for individual in self.hallOfFame)
+        if(len(self.lastErrors) == 0):
+            return None
+        return self.scale * numpy.percentile(self.lastErrors, 100.0 * self.quantile)
+
+    def __call__(self, func, individuals):
+        return self.race(func, individuals, True)
+
+    def rescoreMap(self, func, individuals):
+        """Evaluates individuals outside of a generation, without changing the cutoff."""
+        return self.race(func, individuals, False)
+
+    def race(self, func, individuals, generation):
+        """:param generation: True if the individuals are a generation, the next cutoff is learned from them"""
+        if(getattr(func, "func", func) is not self.errorObj):  #toolbox.evaluate is a partial
+            return self.innerMap(func, individuals)
+        cutoff = self.cutoff()
+        context = self.errorObj.getContext()
+        context["raceCutoff"] = cutoff
+        self.errorObj.setContext(context)
+        fitnesses = list(self.innerMap(func, individuals))
+        if(len(fitnesses) == 0 or not generation):  #Nothing to learn a new cutoff from
+            return fitnesses
+
+        worst = self.errorObj.worstFitness()[0]
+        self.lastErrors = [fitness[0] for fitness in fitnesses if fitness[0] != worst]
+        stats = self.errorObj.takeStats()
+        for key in self.totals:
+            self.totals[key] += stats[key]
+        if(self.logger and cutoff is not None):
+            self.logger.printOut(3, "Racing generation %d: cutoff %g, %s" % (self.generation, cutoff, self.formatStats(stats)))
+        self.generation += 1
+        return fitnesses
+
+    def formatStats(self, stats):
+        abortRatio = 0.0
+        rowRatio = 0.0
+        if(stats["raced"] > 0):
+            abortRatio = float(stats["aborted"]) / stats["raced"]
+            rowRatio = float(stats["rowsEvaluated"]) / stats["rowsTotal"]
+        return "%d of %d aborted (%.1f%%), %.1f%% of rows evaluated" % \
+            (stats["aborted"], stats["raced"], 100.0 * abortRatio, 100.0 * rowRatio)
+
+    def report(self):
+        return "Racing total: %s" % self.formatStats(self.totals)
+
+
+#sampledMap is the base for the maps that evaluate on only some of the rows (a
+#sample), or in float32.  The error function is told which rows and precision through
+#its context, and fullMap evaluates on all the rows in float64, for the hall of fame
+#(see rescoringHallOfFame).
+class sampledMap(object):
+
+    def __init__(self, errorObj, innerMap, logger=None, precision="float64"):
+        """
+        :param errorObj: The error function registered as toolbox.evaluate
+        :param innerMap: The map function to actually evaluate with
+        :param logger:   PrintLogger class
+        :param precision: The precision the estimates are evaluated in, "float64" or "float32"
+        """
+        self.errorObj = errorObj
+        self.innerMap = innerMap
+        self.logger = logger
+        self.precision = precision
+        self.generation = 0
+        self.fullEvals = 0
+        self.sample = (None, None, "float64")  #(sampleId, sampleRows, precision) currently in use
+        self.rankedPairs = 0
+        self.swappedPairs = 0
+        self.bestChecks = 0
+        self.bestChanged = 0
+
+    def setSample(self, sampleId, sampleRows, precision=None):
+        """:param precision: None for the precision the estimates are evaluated in"""
+        if(precision is None):
+            precision = self.precision
+        self.sample = (sampleId, sampleRows, precision)
+        context = self.errorObj.getContext()
+        context["sampleId"] = sampleId
+        context["sampleRows"] = sampleRows
+        context["precision"] = precision
+        self.errorObj.setContext(context)
+
+    def isErrorFunc(self, func):
+        return getattr(func, "func", func) is self.errorObj  #toolbox.evaluate is a partial
+
+    def fullMap(self, func, individuals):
+        """Evaluates the individuals on all the rows, in float64."""
+        sample = self.sample
+        self.setSample(None, None, "float64")
+        fitnesses = list(self.innerMap(func, individuals))
+        self.setSample(*sample)
+        self.fullEvals += len(fitnesses)
+        return fitnesses
+
+    def rescore(self, func, individuals):
+        """Re-scores individuals that have estimated fitnesses with fullMap, and sets
+        their fitness.  Keeps count of how often the estimates put two of them in the
+        other order, and how often they picked the wrong one as the best (see rankingReport)."""
+        fitnesses = self.fullMap(func, individuals)
+        if(len(individuals) > 1):
+            sign = self.errorObj.weight()[0]
+            estimates = numpy.array([sign * individual.fitness.values[0] for individual in individuals])
+            exact = numpy.array([sign * fitness[0] for fitness in fitnesses])
+            with numpy.errstate(invalid='ignore'):
+                swapped = numpy.sign(estimates[:, numpy.newaxis] - estimates) * \
+                          numpy.sign(exact[:, numpy.newaxis] - exact) < 0
+            self.rankedPairs += len(individuals) * (len(individuals) - 1) // 2
+            self.swappedPairs += int(numpy.sum(swapped)) // 2
+            self.bestChecks += 1
+            if(exact[numpy.argmax(estimates)] != numpy.max(exact)):
+                self.bestChanged += 1
+        for (individual, fitness) in zip(individuals, fitnesses):
+            individual.fitness.values = fitness
+        return individuals
+
+    def rankingReport(self):
+        return "%d of %d pairs ranked the other way by the estimates (%.2f%%), the best was wrong %d of %d times" % \
+            (self.swappedPairs, self.rankedPairs, 100.0 * self.swappedPairs / max(self.rankedPairs, 1),
+             self.bestChanged, self.bestChecks)
+
+
+#lowPrecisionMap sits in front of the map used for evaluation (toolbox.map) when
+#"precision" is float32.  Every individual is evaluated on all the rows, but in
+#float32, which halves the size of the arrays the evaluation goes through.  The
+#fitnesses are estimates, so like mini-batch mode, anything that goes in the hall
+#of fame is re-scored in float64 first (see rescoringHallOfFame).
+class lowPrecisionMap(sampledMap):
+
+    def __init__(self, errorObj, innerMap, logger=None):
+        sampledMap.__init__(self, errorObj, innerMap, logger, "float32")
+        self.lowEvals = 0
+
+    def __call__(self, func, individuals):
+        if(not self.isErrorFunc(func)):
+            return self.innerMap(func, individuals)
+        self.setSample(None, None)
+        fitnesses = list(self.innerMap(func, individuals))
+        self.lowEvals += len(fitnesses)
+        self.generation += 1
+        return fitnesses
+
+    def report(self):
+        return "Low precision total: %d evaluations in %s, %d re-scored in float64, %s" % \
+            (self.lowEvals, self.precision, self.fullEvals, self.rankingReport())
+
+
+#miniBatchMap sits in front of the map used for evaluation (toolbox.map) in mini-batch
+#mode.  Each generation it draws a fresh random sample of the rows and the error
+#function estimates the fitness from just those rows.
+class miniBatchMap(sampledMap):
+
+    def __init__(self, errorObj, innerMap, sampleSize, logger=None, precision="float64"):
+        """
+        :param sampleSize: The number of rows in each sample
+        """
+        sampledMap.__init__(self, errorObj, innerMap, logger, precision)
+        self.sampleSize = sampleSize
+        self.sampledEvals = 0
+
+    def __call__(self, func, individuals):
+        if(not self.isErrorFunc(func)):
+            return self.innerMap(func, individuals)
+        numPoints = self.errorObj.numRows()
+        if(self.sampleSize >= numPoints):
+            return self.fullMap(func, individuals)
+        #Python's random, so the samples repeat with the seed
+        rows = numpy.array(sorted(random.sample(xrange(numPoints), self.sampleSize)))
+        self.setSample("batch%d" % self.generation, rows)
+        fitnesses = list(self.innerMap(func, individuals))
+        self.sampledEvals += len(fitnesses)
+        if(self.logger):
+            self.logger.printOut(4, "Mini-batch generation %d: %d individuals on %d of %d rows" %
+                                 (self.generation, len(fitnesses), self.sampleSize, numPoints))
+        self.generation += 1
+        return fitnesses
+
+    def sampleMap(self, func, individuals):
+        """Evaluates on the last generation's sample, without drawing a new one.  So the
+        individuals scored between generations (culling, constant optimization) are
+        compared with the rest of the population on the same rows.  fullMap puts the
+        sample back when it's done, so the error function is still set up for it."""
+        if(not self.isErrorFunc(func)):
+            return self.innerMap(func, individuals)
+        fitnesses = list(self.innerMap(func, individuals))
+        if(self.sample[0] is None):
+            self.fullEvals += len(fitnesses)
+        else:
+            self.sampledEvals += len(fitnesses)
+        return fitnesses
+
+    def report(self):
+        return "Mini-batch total: %d evaluations on samples, %d on all the rows, %s" % \
+            (self.sampledEvals, self.fullEvals, self.rankingReport())
+
+
+#multiFidelityMap does successive halving over a list of coarser grids (fidelity levels).
+#Everything is scored on the coarsest grid, the best fraction of those are promoted
+#to the next grid and scored again, and so on until the ones left are scored on all
+#the rows.  Individuals keep the fitness from the finest grid they got to.
+class multiFidelityMap(sampledMap):
+
+    def __init__(self, errorObj, innerMap, levels, logger=None, precision="float64"):
+        """
+        :param levels: A list of (rows, promote) from coarsest to finest.  rows is the rows
+                       of the grid, promote is the fraction promoted to the next level.
+        """
+        sampledMap.__init__(self, errorObj, innerMap, logger, precision)
+        self.levels = levels
+        self.levelEvals = [0] * len(levels)
+        self.promotedEvals = 0  #Evaluations on all the rows, not counting the hall of fame
+        self.totalIndividuals = 0
+
+    def __call__(self, func, individuals):
+        if(not self.isErrorFunc(func)):
+            return self.innerMap(func, individuals)
+        individuals = list(individuals)
+        fitnesses = [None] * len(individuals)
+        candidates = range(len(individuals))
+        sign = self.errorObj.weight()[0]
+        counts = []
+        for (levelIdx, (rows, promote)) in enumerate(self.levels):
+            self.setSample("grid%d" % levelIdx, rows)
+            levelFitnesses = self.innerMap(func, [individuals[idx] for idx in candidates])
+            for (idx, fitness) in zip(candidates, levelFitnesses):
+                fitnesses[idx] = fitness
+            counts.append(len(candidates))
+            self.levelEvals[levelIdx] += len(candidates)
+            numPromoted = min(len(candidates), int(math.ceil(promote * len(candidates))))
+            candidates.sort(key=lambda idx: sign * fitnesses[idx][0], reverse=True)
+            candidates = sorted(candidates[:numPromoted])
+        self.setSample(None, None)
+        self.promotedEvals += len(candidates)
+        if(candidates):
+            for (idx, fitness) in zip(candidates, self.fullMap(func, [individuals[idx] for idx in candidates])):
+                fitnesses[idx] = fitness
+        self.totalIndividuals += len(individuals)
+        if(self.logger):
+            self.logger.printOut(4, "Multi-fidelity generation %d: %s, %d on all the rows" %
+                                 (self.generation, ", ".join("%d on grid %d" % (count, levelIdx) for (levelIdx, count) in enumerate(counts)),
+                                  len(candidates)))
+        self.generation += 1
+        return fitnesses
+
+    def report(self):
+        return "Multi-fidelity total: %d individuals, %s, %d on all the rows (%.1fx fewer), %d hall of fame re-scores, %s" % \
+            (self.totalIndividuals, ", ".join("%d on grid %d" % (count, levelIdx) for (levelIdx, count) in enumerate(self.levelEvals)),
+             self.promotedEvals, float(self.totalIndividuals) / max(self.promotedEvals, 1),
+             self.fullEvals - self.promotedEvals, self.rankingReport())
+
+
+#rescoringHallOfFame is what the algorithm gets as its hall of fame in mini-batch,
+#multi-fidelity and float32 mode.  The fitnesses in the population are only
+#estimates, so before anything goes in the real hall of fame it's re-scored on
+#all the rows, in float64.  Only the
+#individuals that look like they could make it in are re-scored: the best
+#(maxsize) of them for a HallOfFame, the first front for a ParetoFront.
+#The population keeps its estimates, so selection isn't affected.
+class rescoringHallOfFame(object):
+
+    def __init__(self, hallOfFame, evalMap, toolbox):
+        """
+        :param hallOfFame: The real hall of fame (a HallOfFame or ParetoFront)
+        :param evalMap:    The sampledMap, used to evaluate on all the rows
+        :param toolbox:    The toolbox, for clone and evaluate
+        """
+        self.hallOfFame = hallOfFame
+        self.evalMap = evalMap
+        self.toolbox = toolbox
+
+    def update(self, population):
+        if(self.hallOfFame.maxsize is None):  #ParetoFront
+            candidates = tools.sortNondominated(population, len(population), first_front_only=True)[0]
+        else:
+            candidates = tools.selBest(population, self.hallOfFame.maxsize)
+        self.hallOfFame.update(self.rescored(candidates))
+
+    def rescored(self, population):
+        """Copies of the individuals, re-scored on all the rows (in float64)."""
+        return self.evalMap.rescore(self.toolbox.evaluate, [self.toolbox.clone(individual) for individual in population])
+
+    def __len__(self):
+        return len(self.hallOfFame)
+
+    def __getitem__(self, idx):
+        return self.hallOfFame[idx]
+
+    def __iter__(self):
+        return iter(self.hallOfFame)
+
 
 def paretoErrorFuncFactory(indict, labels, data, config):
     singleErrorFunc = errorFuncFactory(indict, labels, data, config)
+    if(isinstance(singleErrorFunc, multiMetricErrorFunc)):
+        return singleErrorFunc  #The list of metrics already says what the objectives are
     return paretoErrorWrapper(singleErrorFunc)
@@ -0,0 +1,888 @@
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Copyright (c)2016, Lawrence Livermore National Security, LLC. 
+# Produced at the Lawrence Livermore National Laboratory. 
+# Written by Jim Leek <leek2@llnl.gov>. 
+# LLNL-CODE-704100. 
+# All rights reserved.
+#
+# This file is part of SoRa.  For details, see https://github.com/llnl/SoRa.
+# Please also read SoRa/LICENSE
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Evaluators turn an individual (a PrimitiveTree) plus the input variable
+# arrays into the array of function values.  The error functions in
+# sr_errorfuncs call whichever one is registered as toolbox.evalTree,
+# which is picked with the "evaluator" key in the configuration file.
+import collections
+import numpy
+from deap import gp
+import sr_cache
+
+try:
+    import numexpr
+    hasNumexpr = True
+except ImportError:
+    hasNumexpr = False
+try:
+    import numba
+    hasNumba = True
+except ImportError:
+    hasNumba = False
+
+
+class compiledEvaluator(object):
+    """The original evaluation path.  gp.compile turns the tree into a python
+    source string, and eval turns that into a lambda, which is then called on
+    the data.  Python's parser can't handle trees deeper than about 90.
+    """
+
+    def __init__(self, pset):
+        self.pset = pset
+
+    def __call__(self, individual, inVarValues):
+        func = gp.compile(individual, self.pset)
+        return func(*inVarValues)
+
+
+class stackEvaluator(object):
+    """Evaluates the tree directly from DEAP's prefix node list, without making
+    any python source.  The nodes are walked backwards, so every primitive
+    finds its arguments already computed on an explicit stack of numpy arrays.
+    There's no parsing and no recursion, so there is no depth limit either.
+    """
+
+    def __init__(self, pset):
+        self.functions = {}
+        for primitives in pset.primitives.itervalues():
+            for primitive in primitives:
+                self.functions[primitive.name] = pset.context[primitive.name]
+        self.argIndex = {}
+        for (idx, argName) in enumerate(pset.arguments):
+            self.argIndex[argName] = idx
+        self.merged = {}  #Statistics sent back from worker processes, see mergeStats
+
+    def mergeStats(self, stats):
+        """Adds the statistics from the same evaluator in another process (a -t worker)
+        in with this one's, so they get reported together on the next takeStats."""
+        for (key, value) in stats.iteritems():
+            self.merged[key] = self.merged.get(key, 0) + value
+
+    def takeMerged(self, stats):
+        for (key, value) in self.merged.iteritems():
+            stats[key] = stats.get(key, 0) + value
+        self.merged = {}
+        return stats
+
+    def __call__(self, individual, inVarValues):
+        stack = []
+        for node in reversed(individual):
+            if isinstance(node, gp.Primitive):
+                #The first argument is on top of the stack
+                args = [stack.pop() for ii in xrange(node.arity)]
+                stack.append(self.functions[node.name](*args))
+            elif node.value in self.argIndex:
+                stack.append(inVarValues[self.argIndex[node.value]])
+            else:
+                stack.append(node.value)
+        return stack[0]
+
+    def subtreeSizes(self, individual):
+        """Returns the number of nodes in the subtree rooted at each node"""
+        sizes = [1] * len(individual)
+        stack = []
+        for idx in xrange(len(individual) - 1, -1, -1):
+            node = individual[idx]
+            if isinstance(node, gp.Primitive):
+                for ii in xrange(node.arity):
+                    sizes[idx] += sizes[stack.pop()]
+            stack.append(idx)
+        return sizes
+
+    def evaluateWithKnown(self, individual, inVarValues, known, sizes, outputs):
+        """The normal stack evaluation, except that the subtrees rooted at the
+        nodes in *known* already have outputs, so they (and everything below them)
+        are not evaluated.
+
+        :param known:   Dictionary of node index -> output of that subtree
+        :param sizes:   The subtree sizes, from subtreeSizes
+        :param outputs: A list as long as individual.  The output of every primitive
+                        that actually gets computed is put at its node index.
+        :return: The output of the whole tree
+        """
+        numNodes = len(individual)
+        skip = [False] * numNodes
+        for idx in known:
+            for child in xrange(idx + 1, idx + sizes[idx]):
+                skip[child] = True
+        stack = []
+        for idx in xrange(numNodes - 1, -1, -1):
+            if skip[idx]:
+                continue
+            node = individual[idx]
+            if idx in known:
+                stack.append(known[idx])
+            elif isinstance(node, gp.Primitive):
+                args = [stack.pop() for ii in xrange(node.arity)]
+                outputs[idx] = self.functions[node.name](*args)
+                stack.append(outputs[idx])
+            elif node.value in self.argIndex:
+                stack.append(inVarValues[self.argIndex[node.value]])
+            else:
+                stack.append(node.value)
+        return stack[0]
+
+
+class gridLayout(object):
+    """Describes input data that is a full rectilinear grid (every combination of
+    the unique values of each input variable appears exactly once).  axes holds
+    each variable's unique values, shaped so numpy broadcasting combines them
+    into the full grid: the first variable varies along axis 0, the second along
+    axis 1, and so on.  toRows turns a grid shaped result back into the rows
+    of the original data.
+    """
+
+    def __init__(self, axes, shape, rowIndex):
+        self.axes = axes
+        self.shape = shape
+        self.rowIndex = rowIndex  #Where each row is in the flattened grid, None if they're in order
+
+    @staticmethod
+    def detect(inVarValues):
+        """Returns the gridLayout of the inputs, or None if they aren't a full grid."""
+        if(len(inVarValues) < 2):  #Nothing to gain
+            return None
+        numPoints = len(inVarValues[0])
+        uniques = []
+        codes = []
+        for values in inVarValues:
+            (unique, code) = numpy.unique(values, return_inverse=True)
+            uniques.append(unique)
+            codes.append(code)
+        shape = tuple(len(unique) for unique in uniques)
+        if(numpy.prod(shape) != numPoints):
+            return None
+        rowIndex = numpy.ravel_multi_index(codes, shape)
+        if(len(numpy.unique(rowIndex)) != numPoints):  #Some point is repeated, so some are missing
+            return None
+        if(numpy.array_equal(rowIndex, numpy.arange(numPoints))):
+            rowIndex = None
+        axes = []
+        for (axisIdx, unique) in enumerate(uniques):
+            axisShape = [1] * len(shape)
+            axisShape[axisIdx] = len(unique)
+            axes.append(unique.reshape(axisShape))
+        return gridLayout(axes, shape, rowIndex)
+
+    def toRows(self, result):
+        if(numpy.ndim(result) == 0):  #Constant, the error functions broadcast it themselves
+            return result
+        full = numpy.broadcast_to(result, self.shape).reshape(-1)
+        if(self.rowIndex is None):
+            return full
+        return full[self.rowIndex]
+
+
+class gridEvaluator(stackEvaluator):
+    """A stack evaluator for data on a full grid (e.g. rho x T).  Each variable is
+    replaced by just its unique values (an axis vector), so a subtree that only
+    depends on one variable is computed on that axis alone.  numpy broadcasting
+    builds the full grid only at the nodes where variables are combined.  The
+    grid is detected once for each new set of inputs, if the inputs aren't a
+    full grid (a sample of the rows, say) it's just a stackEvaluator.
+    """
+
+    def __init__(self, pset):
+        stackEvaluator.__init__(self, pset)
+        self.inputs = None  #The inVarValues layout was detected from
+        self.layout = None
+
+    def __call__(self, individual, inVarValues):
+        if(inVarValues is not self.inputs):
+            self.inputs = inVarValues
+            self.layout = gridLayout.detect(inVarValues)
+        if(self.layout is None):
+            return stackEvaluator.__call__(self, individual, inVarValues)
+        return self.layout.toRows(stackEvaluator.__call__(self, individual, self.layout.axes))
+
+
+#The kinds of values on bufferedEvaluator's stack
+constant = 0
+inputArray = 1
+scratchArray = 2
+
+
+class bufferedEvaluator(stackEvaluator):
+    """A stack evaluator that doesn't make a new array for every node.  Each
+    primitive writes its output with the ufunc's out= argument into a scratch
+    array: one of its own arguments' scratch arrays if it has one, otherwise one
+    from a pool of free scratch arrays.  The pool is kept from one individual
+    to the next, and is only thrown away when the size of the data changes.
+
+    The number of scratch arrays in use at once is at most the height of the
+    stack, which is bounded by the tree height, so the pool never keeps more
+    than maxScratch of them.  The array returned is scratch too, so it's only
+    good until the next call (the error functions are done with it by then).
+    """
+
+    def __init__(self, pset, maxScratch):
+        """
+        :param pset:       The primitive set the individuals are made from
+        :param maxScratch: The most scratch arrays to keep, depthLimit + 1 is enough for any legal tree
+        """
+        stackEvaluator.__init__(self, pset)
+        self.ufuncNames = set(name for (name, function) in self.functions.iteritems()
+                              if isinstance(function, numpy.ufunc))
+        self.maxScratch = maxScratch
+        self.free = []
+        self.inputs = None
+        self.layout = None  #(length, dtype) of the scratch arrays
+        self.lent = None  #The scratch array returned by the last call
+        self.stats = self.emptyStats()
+        self.totals = self.emptyStats()
+
+    def emptyStats(self):
+        return { "trees" : 0, "reused" : 0, "allocated" : 0 }
+
+    def newGeneration(self):
+        pass
+
+    def takeStats(self):
+        stats = self.stats
+        stats["bytes"] = sum(array.nbytes for array in self.free)
+        stats = self.takeMerged(stats)
+        for key in self.totals:
+            self.totals[key] += stats[key]
+        self.stats = self.emptyStats()
+        return stats
+
+    def formatStats(self, stats):
+        return "Buffered evaluation: %d trees, %d scratch arrays reused, %d allocated, %.1f MB held" % \
+            (stats["trees"], stats["reused"], stats["allocated"], stats["bytes"] / (1024.0 * 1024.0))
+
+    def report(self):
+        return "Buffered evaluation total: %d trees, %d scratch arrays reused, %d allocated" % \
+            (self.totals["trees"], self.totals["reused"], self.totals["allocated"])
+
+    def scratch(self):
+        if(self.free):
+            self.stats["reused"] += 1
+            return self.free.pop()
+        self.stats["allocated"] += 1
+        return numpy.empty(self.layout[0], dtype=self.layout[1])
+
+    def release(self, array):
+        if(len(self.free) < self.maxScratch):
+            self.free.append(array)
+
+    def __call__(self, individual, inVarValues):
+        if(inVarValues is not self.inputs):
+            self.inputs = inVarValues
+            layout = (len(inVarValues[0]), inVarValues[0].dtype)
+            if(layout != self.layout):
+                self.layout = layout
+                self.free = []
+                self.lent = None
+        if(self.lent is not None):
+            self.release(self.lent)
+            self.lent = None
+        self.stats["trees"] += 1
+
+        #Each entry is (value, kind), kind is constant, inputArray or scratchArray
+        stack = []
+        for node in reversed(individual):
+            if isinstance(node, gp.Primitive):
+                args = [stack.pop() for ii in xrange(node.arity)]
+                function = self.functions[node.name]
+                out = None
+                for (value, kind) in args:
+                    if(kind == scratchArray):
+                        if(out is None):
+                            out = value
+                        else:
+                            self.release(value)
+                if(out is None and node.name in self.ufuncNames and
+                   any(kind == inputArray for (value, kind) in args)):
+                    out = self.scratch()
+                values = [arg[0] for arg in args]
+                if(out is None):  #Constants stay numpy scalars, same as in the stack evaluator
+                    stack.append((function(*values), constant))
+                else:
+                    values.append(out)  #A ufunc's output array can be its last positional argument
+                    function(*values)
+                    stack.append((out, scratchArray))
+            elif node.value in self.argIndex:
+                stack.append((inVarValues[self.argIndex[node.value]], inputArray))
+            else:
+                stack.append((node.value, constant))
+        (value, kind) = stack[0]
+        if(kind == scratchArray):
+            self.lent = value
+        return value
+
+
+class subtreeCachingEvaluator(stackEvaluator):
+    """A stack evaluator that remembers the output of every subtree it computes.
+    The offspring from crossover and mutation share most of their subtrees with
+    their parents and siblings, so within a generation the same subtree gets
+    evaluated over and over.  Subtrees are identified by their structure, so
+    identical subtrees in different individuals (or different places in the
+    same individual) share one cache entry.  Each distinct subtree gets a small
+    integer key: a primitive's key is looked up from its name and its children's
+    keys, a constant's from its type and repr (so 3 and 3.0 are different, they
+    don't do the same math).  The lookup is a dict, so different subtrees can't
+    share a key the way they could share a hash.
+
+    The cache is cleared every generation (see newGeneration) and whenever the
+    input data changes.  Within a generation the least recently used outputs are
+    thrown away to keep the memory held under the budget.
+    """
+
+    def __init__(self, pset, memoryBudgetMB):
+        stackEvaluator.__init__(self, pset)
+        self.memoryBudget = int(memoryBudgetMB * 1024 * 1024)
+        self.cache = collections.OrderedDict()
+        self.bytesHeld = 0
+        self.inputs = None  #The inVarValues the cached outputs were computed from
+        self.keyIds = {}    #(name, child keys...) or ("constant", type, repr) -> key
+        self.hits = 0
+        self.misses = 0
+        self.totalHits = 0
+        self.totalMisses = 0
+
+    def newGeneration(self):
+        self.cache.clear()
+        self.keyIds.clear()
+        self.bytesHeld = 0
+
+    def subtreeKey(self, structure):
+        """The integer key of a subtree, from its structure tuple."""
+        return self.keyIds.setdefault(structure, len(self.keyIds))
+
+    def takeStats(self):
+        """Returns the hits, misses and bytes held since the last call, and resets the counts."""
+        stats = self.takeMerged({ "hits" : self.hits, "misses" : self.misses,
+                                  "bytes" : self.bytesHeld, "entries" : len(self.cache) })
+        self.totalHits += stats["hits"]
+        self.totalMisses += stats["misses"]
+        self.hits = 0
+        self.misses = 0
+        return stats
+
+    def formatStats(self, stats):
+        return "Subtree cache: %.1f%% hit ratio (%d hits, %d misses), %d entries, %.1f MB held" % \
+            (100.0 * hitRatio(stats["hits"], stats["misses"]), stats["hits"], stats["misses"],
+             stats["entries"], stats["bytes"] / (1024.0 * 1024.0))
+
+    def report(self):
+        return "Subtree cache total: %.1f%% hit ratio (%d hits, %d misses)" % \
+            (100.0 * hitRatio(self.totalHits, self.totalMisses), self.totalHits, self.totalMisses)
+
+    def store(self, key, value):
+        self.cache[key] = value
+        self.bytesHeld += getattr(value, "nbytes", 8)
+        while(self.bytesHeld > self.memoryBudget and len(self.cache) > 0):
+            (oldKey, oldValue) = self.cache.popitem(last=False)
+            self.bytesHeld -= getattr(oldValue, "nbytes", 8)
+
+    def __call__(self, individual, inVarValues):
+        #Outputs are only good for the data they were computed on.  Holding a reference
+        #to the inputs means the check can't be fooled by a new list at a recycled address.
+        if(inVarValues is not self.inputs):
+            self.newGeneration()
+            self.inputs = inVarValues
+
+        #First pass, backwards, computes the key and size of every subtree
+        numNodes = len(individual)
+        keys = [None] * numNodes
+        sizes = [1] * numNodes
+        idxStack = []
+        for idx in xrange(numNodes - 1, -1, -1):
+            node = individual[idx]
+            if isinstance(node, gp.Primitive):
+                children = [idxStack.pop() for ii in xrange(node.arity)]
+                keys[idx] = self.subtreeKey((node.name,) + tuple(keys[child] for child in children))
+                for child in children:
+                    sizes[idx] += sizes[child]
+            elif node.value in self.argIndex:
+                keys[idx] = self.subtreeKey(("argument", node.value))
+            else:
+                keys[idx] = self.subtreeKey(("constant", type(node.value).__name__, repr(node.value)))
+            idxStack.append(idx)
+
+        #Second pass, forwards, finds the biggest subtrees that are already cached.
+        #Everything underneath them can be skipped.
+        cached = {}
+        idx = 0
+        while(idx < numNodes):
+            if isinstance(individual[idx], gp.Primitive):
+                value = self.cache.pop(keys[idx], None)
+                if value is not None:
+                    self.cache[keys[idx]] = value  #Reinserting marks it as recently used
+                    cached[idx] = value
+                    self.hits += 1
+                    idx += sizes[idx]
+                    continue
+            idx += 1
+
+        #Third pass, backwards, is the normal stack evaluation except for the cached subtrees
+        outputs = [None] * numNodes
+        value = self.evaluateWithKnown(individual, inVarValues, cached, sizes, outputs)
+        for (idx, output) in enumerate(outputs):
+            if output is not None:
+                self.misses += 1
+                self.store(keys[idx], output)
+        return value
+
+
+class incrementalEvaluator(stackEvaluator):
+    """An evaluator for the children of mutation.  Mutators wrapped with
+    sr_mutators.recordMutation leave a record on the child of which parent it
+    came from and which nodes were changed.  Every individual evaluated here
+    leaves the outputs of all its nodes behind (keyed by its tree), so when its
+    children are evaluated, only the changed nodes and the path from them up to
+    the root are computed.  Every other subtree is the same as in the parent,
+    so the parent's outputs are used.
+
+    If there's no record, or the parent's outputs have been dropped (or were
+    computed in another process), the child is just evaluated in full.
+    The node outputs are kept across generations, but the least recently used
+    are dropped to keep the memory held under the budget.
+    """
+
+    def __init__(self, pset, memoryBudgetMB):
+        stackEvaluator.__init__(self, pset)
+        self.memoryBudget = int(memoryBudgetMB * 1024 * 1024)
+        self.nodeOutputs = collections.OrderedDict()  #treeKey -> list of primitive node outputs
+        self.arrays = {}  #id(array) -> [array, number of nodeOutputs entries using it]
+        self.bytesHeld = 0
+        self.inputs = None
+        self.stats = self.emptyStats()
+        self.totals = self.emptyStats()
+
+    def emptyStats(self):
+        return { "incremental" : 0, "full" : 0, "nodesComputed" : 0, "nodesTotal" : 0 }
+
+    def newGeneration(self):
+        pass  #Parents can come from any earlier generation, so nothing gets cleared
+
+    def takeStats(self):
+        stats = self.stats
+        stats["bytes"] = self.bytesHeld
+        stats["entries"] = len(self.nodeOutputs)
+        stats = self.takeMerged(stats)
+        for key in self.totals:
+            self.totals[key] += stats[key]
+        self.stats = self.emptyStats()
+        return stats
+
+    def formatStats(self, stats):
+        return "Incremental evaluation: %d incremental, %d full, %.1f%% of nodes computed, %d trees (%.1f MB) held" % \
+            (stats["incremental"], stats["full"], 100.0 * fraction(stats["nodesComputed"], stats["nodesTotal"]),
+             stats["entries"], stats["bytes"] / (1024.0 * 1024.0))
+
+    def report(self):
+        return "Incremental evaluation total: %d incremental, %d full, %.1f%% of nodes computed" % \
+            (self.totals["incremental"], self.totals["full"],
+             100.0 * fraction(self.totals["nodesComputed"], self.totals["nodesTotal"]))
+
+    def clear(self):
+        self.nodeOutputs.clear()
+        self.arrays.clear()
+        self.bytesHeld = 0
+
+    def release(self, outputs):
+        """Stops counting the outputs of a tree that was dropped or replaced."""
+        for output in outputs:
+            if output is None:
+                continue
+            entry = self.arrays[id(output)]
+            entry[1] -= 1
+            if(entry[1] == 0):
+                del self.arrays[id(output)]
+                self.bytesHeld -= getattr(output, "nbytes", 8)
+
+    def store(self, key, outputs):
+        #The outputs just computed replace any that were kept for the same tree
+        oldOutputs = self.nodeOutputs.pop(key, None)
+        if oldOutputs is not None:
+            self.release(oldOutputs)
+        self.nodeOutputs[key] = outputs
+        for output in outputs:
+            if output is None:
+                continue
+            entry = self.arrays.get(id(output))
+            if entry is None:
+                self.arrays[id(output)] = [output, 1]
+                self.bytesHeld += getattr(output, "nbytes", 8)
+            else:
+                entry[1] += 1
+
+        #Arrays shared with other trees are only counted (and only freed) once
+        while(self.bytesHeld > self.memoryBudget and len(self.nodeOutputs) > 0):
+            (oldKey, oldOutputs) = self.nodeOutputs.popitem(last=False)
+            self.release(oldOutputs)
+
+    def lookupParent(self, individual):
+        """Returns (parentOutputs, start, parentEnd, childEnd) if this individual
+        can be evaluated incrementally, otherwise None."""
+        record = getattr(individual, "mutation", None)
+        if record is None:
+            return None
+        (parentKey, start, parentEnd, childEnd, childKey) = record
+        parentOutputs = self.nodeOutputs.pop(parentKey, None)
+        if parentOutputs is None:
+            return None
+        self.nodeOutputs[parentKey] = parentOutputs  #Reinserting marks it as recently used
+        #The record is copied along with the individual, so make sure it's really about this tree
+        if(sr_cache.treeKey(individual) != childKey):
+            return None
+        return (parentOutputs, start, parentEnd, childEnd)
+
+    def __call__(self, individual, inVarValues):
+        if(inVarValues is not self.inputs):
+            self.clear()
+            self.inputs = inVarValues
+
+        numNodes = len(individual)
+        sizes = self.subtreeSizes(individual)
+        outputs = [None] * numNodes
+        known = {}
+        parent = self.lookupParent(individual)
+        if parent is not None:
+            #Any subtree that ends before the changed nodes, or starts after them, is
+            #exactly the same as in the parent.  Only the biggest ones need to go in known.
+            (parentOutputs, start, parentEnd, childEnd) = parent
+            shift = parentEnd - childEnd
+            idx = 0
+            while(idx < numNodes):
+                if(idx + sizes[idx] <= start):
+                    parentIdx = idx
+                elif(idx >= childEnd):
+                    parentIdx = idx + shift
+                else:
+                    idx += 1
+                    continue
+                if isinstance(individual[idx], gp.Primitive):
+                    known[idx] = parentOutputs[parentIdx]
+                    outputs[idx:idx + sizes[idx]] = parentOutputs[parentIdx:parentIdx + sizes[idx]]
+                idx += sizes[idx]
+            self.stats["incremental"] += 1
+        else:
+            self.stats["full"] += 1
+
+        numKnown = sum(1 for output in outputs if output is not None)
+        value = self.evaluateWithKnown(individual, inVarValues, known, sizes, outputs)
+        self.stats["nodesTotal"] += sum(1 for node in individual if isinstance(node, gp.Primitive))
+        self.stats["nodesComputed"] += sum(1 for output in outputs if output is not None) - numKnown
+        self.store(sr_cache.treeKey(individual), outputs)
+        return value
+
+
+#How each primitive is written in a fused expression, {0} and {1} are its arguments.
+#The function names are numexpr's, numbaEvaluator makes them mean the numpy functions.
+fusedExpressions = {
+    numpy.add         : "({0} + {1})",
+    numpy.subtract    : "({0} - {1})",
+    numpy.multiply    : "({0} * {1})",
+    numpy.true_divide : "({0} / {1})",
+    numpy.negative    : "(-{0})",
+    numpy.power       : "({0} ** {1})",
+    numpy.absolute    : "abs({0})",
+    numpy.exp         : "exp({0})",
+    numpy.exp2        : "exp2({0})",
+    numpy.log         : "log({0})",
+    numpy.log2        : "log2({0})",
+    numpy.log10       : "log10({0})",
+    numpy.sqrt        : "sqrt({0})",
+    numpy.square      : "({0} * {0})",
+    numpy.reciprocal  : "(1.0 / {0})",
+    numpy.sin         : "sin({0})",
+    numpy.cos         : "cos({0})",
+    numpy.tan         : "tan({0})",
+    numpy.arcsin      : "arcsin({0})",
+    numpy.arccos      : "arccos({0})",
+    numpy.arctan      : "arctan({0})",
+    numpy.arctan2     : "arctan2({0}, {1})",
+    numpy.sinh        : "sinh({0})",
+    numpy.cosh        : "cosh({0})",
+    numpy.tanh        : "tanh({0})",
+    numpy.arcsinh     : "arcsinh({0})",
+    numpy.arccosh     : "arccosh({0})",
+    numpy.arctanh     : "arctanh({0})",
+    }
+
+
+class fusedEvaluator(stackEvaluator):
+    """Base class for the evaluation backends (see "evalBackend") that evaluate a
+    whole tree in one go, instead of making a numpy array for every node.
+
+    The subtrees that don't depend on any input variable are folded into a
+    constant first, with the primitive set's own functions, so they come out
+    exactly as the stack evaluator computes them.  The backend gets the rest as
+    code made by its constantCode(value), variableCode(argIdx) and
+    primitiveCode(function, argCodes), and evaluates the code of the whole tree
+    with run(code, inVarValues).  If the backend can't do some primitive,
+    primitiveCode returns None, and if run can't evaluate the code it returns
+    None.  Either way the tree is evaluated by the stack evaluator instead.
+    """
+
+    name = None
+
+    def __init__(self, pset):
+        stackEvaluator.__init__(self, pset)
+        self.stats = self.emptyStats()
+        self.totals = self.emptyStats()
+
+    def emptyStats(self):
+        return { "trees" : 0, "fallback" : 0 }
+
+    def newGeneration(self):
+        pass
+
+    def takeStats(self):
+        stats = self.takeMerged(self.stats)
+        for key in self.totals:
+            self.totals[key] += stats[key]
+        self.stats = self.emptyStats()
+        return stats
+
+    def formatStats(self, stats):
+        return "%s backend: %d trees, %d evaluated with numpy instead" % \
+            (self.name, stats["trees"], stats["fallback"])
+
+    def report(self):
+        return "%s backend total: %d trees, %d evaluated with numpy instead" % \
+            (self.name, self.totals["trees"], self.totals["fallback"])
+
+    def __call__(self, individual, inVarValues):
+        self.stats["trees"] += 1
+        if(len(individual) == 1):
+            return stackEvaluator.__call__(self, individual, inVarValues)
+        #Each entry is (True, constant value) or (False, the backend's code for the subtree)
+        stack = []
+        for node in reversed(individual):
+            if isinstance(node, gp.Primitive):
+                args = [stack.pop() for ii in xrange(node.arity)]
+                function = self.functions[node.name]
+                if(all(arg[0] for arg in args)):
+                    stack.append((True, function(*[arg[1] for arg in args])))
+                    continue
+                argCodes = [code if not isConstant else self.constantCode(code) for (isConstant, code) in args]
+                if(any(code is None for code in argCodes)):
+                    stack.append((False, None))
+                else:
+                    stack.append((False, self.primitiveCode(function, argCodes)))
+            elif node.value in self.argIndex:
+                stack.append((False, self.variableCode(self.argIndex[node.value])))
+            else:
+                stack.append((True, node.value))
+        (isConstant, code) = stack[0]
+        if(isConstant):
+            return code
+        if(code is not None):
+            values = self.run(code, inVarValues)
+            if(values is not None):
+                return values
+        self.stats["fallback"] += 1
+        return stackEvaluator.__call__(self, individual, inVarValues)
+
+
+class numexprEvaluator(fusedEvaluator):
+    """Turns the tree into one numexpr expression string.  numexpr evaluates it
+    a cache sized block of rows at a time, so the only full size array made is
+    the result.  numexpr has no exp2 or log2, trees with those use numpy.
+
+    The constants are passed in as variables rather than written into the
+    string.  numexpr rewrites expressions with literal constants (x / 3 becomes
+    x * 0.333...), which changes the results.  It also means trees that only
+    differ in their constants share one compiled expression in numexpr's cache.
+    """
+
+    name = "numexpr"
+
+    def __call__(self, individual, inVarValues):
+        self.constants = {}
+        return fusedEvaluator.__call__(self, individual, inVarValues)
+
+    def constantCode(self, value):
+        name = "c%d" % len(self.constants)
+        self.constants[name] = float(value)
+        return name
+
+    def variableCode(self, argIdx):
+        return "v%d" % argIdx
+
+    def primitiveCode(self, function, argCodes):
+        if(function is numpy.exp2 or function is numpy.log2):
+            return None
+        expression = fusedExpressions.get(function)
+        if(expression is None):
+            return None
+        return expression.format(*argCodes)
+
+    def run(self, code, inVarValues):
+        variables = dict(("v%d" % idx, values) for (idx, values) in enumerate(inVarValues))
+        #Constants in the precision of the data, as numpy treats python floats with float32 arrays
+        scalarType = inVarValues[0].dtype.type
+        variables.update((name, scalarType(value)) for (name, value) in self.constants.iteritems())
+        try:
+            return numexpr.evaluate(code, local_dict=variables, global_dict={})
+        except (ValueError, RuntimeError, SyntaxError, MemoryError):  #Too big for numexpr's compiler
+            return None
+
+
+#numbaEvaluator runs programs with a kernel that is compiled once: each
+#instruction is an opcode and an argument (which variable or constant to load).
+#The kernel goes through the rows a block at a time, and runs the whole program
+#on each block with a stack of block sized scratch rows.
+numbaLoadVariable = 0
+numbaLoadConstant = 1
+numbaFunctions = sorted(fusedExpressions.keys(), key=lambda function: function.__name__)
+numbaOpcodes = dict((function, idx + 2) for (idx, function) in enumerate(numbaFunctions))
+
+
+def numbaKernelSource():
+    """The python source of the numba kernel, with a branch for each opcode."""
+    lines = ["def runProgram(opcodes, opargs, inputs, constants, depth, out, blockSize):",
+             "    stack = numpy.empty((depth, blockSize), dtype=out.dtype)",
+             "    numPoints = out.shape[0]",
+             "    for start in range(0, numPoints, blockSize):",
+             "        size = min(blockSize, numPoints - start)",
+             "        top = -1",
+             "        for pc in range(opcodes.shape[0]):",
+             "            op = opcodes[pc]",
+             "            if op == %d:" % numbaLoadVariable,
+             "                top += 1",
+             "                values = inputs[opargs[pc]]",
+             "                for ii in range(size):",
+             "                    stack[top, ii] = values[start + ii]",
+             "            elif op == %d:" % numbaLoadConstant,
+             "                top += 1",
+             "                value = constants[opargs[pc]]",
+             "                for ii in range(size):",
+             "                    stack[top, ii] = value"]
+    for function in numbaFunctions:
+        lines.append("            elif op == %d:" % numbaOpcodes[function])
+        if(function.nin == 1):
+            lines += ["                row = stack[top]",
+                      "                for ii in range(size):",
+                      "                    a = row[ii]",
+                      "                    row[ii] = %s" % fusedExpressions[function].format("a")]
+        else:
+            #The first argument is on top of the stack, same as in the stack evaluator
+            lines += ["                top -= 1",
+                      "                first = stack[top + 1]",
+                      "                row = stack[top]",
+                      "                for ii in range(size):",
+                      "                    a = first[ii]",
+                      "                    b = row[ii]",
+                      "                    row[ii] = %s" % fusedExpressions[function].format("a", "b")]
+    lines += ["        for ii in range(size):",
+              "            out[start + ii] = stack[0, ii]"]
+    return "\n".join(lines) + "\n"
+
+
+def numbaKernel():
+    """Compiles the kernel.  The names in fusedExpressions are the numpy functions."""
+    namespace = { "numpy" : numpy, "abs" : numpy.absolute }
+    for function in numbaFunctions:
+        namespace[function.__name__] = function
+    exec numbaKernelSource() in namespace
+    return numba.njit(error_model="numpy", nogil=True)(namespace["runProgram"])
+
+
+class numbaEvaluator(fusedEvaluator):
+    """Turns the tree into a program for a numba kernel (see numbaKernelSource).
+    The kernel is compiled once per process, not per tree, so new trees cost
+    nothing extra.  Only block sized scratch rows are used, and they stay in cache.
+    """
+
+    name = "numba"
+    blockSize = 512
+
+    def __init__(self, pset):
+        fusedEvaluator.__init__(self, pset)
+        self.kernel = numbaKernel()
+        #Compile it now, so -t worker processes inherit the compiled kernel
+        self.run([(numbaLoadVariable, 0)], [numpy.zeros(1) for name in pset.arguments])
+
+    def constantCode(self, value):
+        return [(numbaLoadConstant, float(value))]
+
+    def variableCode(self, argIdx):
+        return [(numbaLoadVariable, argIdx)]
+
+    def primitiveCode(self, function, argCodes):
+        opcode = numbaOpcodes.get(function)
+        if(opcode is None):
+            return None
+        code = []
+        for argCode in reversed(argCodes):  #So the first argument ends up on top
+            code.extend(argCode)
+        code.append((opcode, 0))
+        return code
+
+    def run(self, code, inVarValues):
+        opcodes = numpy.empty(len(code), dtype=numpy.int64)
+        opargs = numpy.zeros(len(code), dtype=numpy.int64)
+        constants = []
+        depth = 0
+        maxDepth = 0
+        for (pc, (opcode, oparg)) in enumerate(code):
+            opcodes[pc] = opcode
+            if(opcode == numbaLoadConstant):
+                opargs[pc] = len(constants)
+                constants.append(oparg)
+            else:
+                opargs[pc] = oparg
+            if(opcode == numbaLoadVariable or opcode == numbaLoadConstant):
+                depth += 1
+            else:
+                depth -= numbaFunctions[opcode - 2].nin - 1
+            maxDepth = max(maxDepth, depth)
+        #The kernel is compiled again for each dtype the first time it's used (float32, see "precision")
+        dtype = inVarValues[0].dtype
+        inputs = tuple(numpy.ascontiguousarray(values, dtype=dtype) for values in inVarValues)
+        out = numpy.empty(len(inputs[0]), dtype=dtype)
+        self.kernel(opcodes, opargs, inputs, numpy.array(constants, dtype=dtype),
+                    maxDepth, out, self.blockSize)
+        return out
+
+
+class generationMap(object):
+    """generationMap wraps toolbox.map so the evaluator is told whenever a new
+    generation of individuals is about to be evaluated, and so it can report
+    what the evaluator did each generation.
+    """
+
+    def __init__(self, evaluator, innerMap, logger=None):
+        """
+        :param evaluator: The evaluator registered as toolbox.evalTree
+        :param innerMap:  The map function to actually evaluate with
+        :param logger:    PrintLogger class.  Prints the evaluator statistics each generation
+        """
+        self.evaluator = evaluator
+        self.innerMap = innerMap
+        self.logger = logger
+        self.generation = 0
+
+    def __call__(self, func, individuals):
+        self.evaluator.newGeneration()
+        fitnesses = self.innerMap(func, individuals)
+        stats = self.evaluator.takeStats()
+        if(self.logger):
+            self.logger.printOut(3, "Generation %d %s" % (self.generation, self.evaluator.formatStats(stats)))
+        self.generation += 1
+        return fitnesses
+
+    def report(self):
+        return self.evaluator.report()
+
+
+def hitRatio(hits, misses):
+    return fraction(hits, hits + misses)
+
+
+def fraction(part, total):
+    if(total == 0):
+        return 0.0
+    return float(part) / total
@@ -11,9 +11,18 @@
 from deap import tools
 from deap import gp
 from deap import algorithms
+import hashlib
 import json
 from optparse import OptionParser
 import sr_mutators
+import sr_primitives
+import sr_cache
+import sr_evaluators
+import sr_errorfuncs
+import dataFilters
+import sr_intervals
+import sr_simplify
+import sr_constants
 import random
 
 defaultConfigData = { "infile"            : "foo",
@@ -39,7 +48,10 @@ defaultConfigData = { "infile"            : "foo",
                 "mate"     : "cxOnePoint",
                 "mutator"  : { "type" : "mutUniform" },
                 "primitives" : ["add", "sub", "mul", "div", "neg", "sqrt"],
-                "errorfunc": "avgAbsErrorSquared"
+                "errorfunc": "avgAbsErrorSquared",
+                "evaluator": "compile",
+                "evalBackend": "numpy",
+                "precision": "float64"
                 }
 
 #All the expression generators take the same inputs, min, max, and pset.  So it's easy to set up defaults    
@@ -85,9 +97,22 @@ eaHARMDefaults = { "type"  : "harm",
 
 islandsDefaults = { "migrationFreq" : 50,
                     "numMigrants" : 10,
+                    "topology" : "ring",
+                    "degree" : 2,
+                    "asynchronous" : False,
+                    "maxAge" : 2,
                     "select"            : [ { "type" : "SPEA2" } ],
                     "replacementSelect" : [ { "type" : None } ]
                   }
+#Distributed evaluation splits the MPI ranks into islands of ranksPerIsland ranks (0 is
+#one island with all of them).  The first rank of each island runs the algorithm, the
+#others evaluate for it.  split is what's split across the ranks: "individuals" (each
+#generation is split into batchesPerRank batches per rank) or "rows" (each rank only
+#has some of the rows of the data, and evaluates every individual on them).
+distributedEvaluationDefaults = { "ranksPerIsland" : 0,
+                                  "batchesPerRank" : 4,
+                                  "split"          : "individuals"
+                                }
 #filename base means no checkpoint will be generated by default
 #allRanks = False only outputs a checkpoint file for rank 0.  (True will output a file for each rank) 
 checkpointsDefaults = {
@@ -96,6 +121,99 @@ checkpointsDefaults = {
     "frequency"    : 100
     }
 
+#Racing evaluates the rows chunkSize at a time and drops individuals once their
+#error is over the cutoff.  The cutoff is scale times either the quantile of the last
+#generation's errors ("population") or the worst error in the hall of fame ("halloffame").
+racingDefaults = {
+    "chunkSize" : 1024,
+    "cutoff"    : "population",
+    "quantile"  : 0.9,
+    "scale"     : 1.0
+    }
+
+#In mini-batch mode each generation is evaluated on a random sample of size rows
+miniBatchDefaults = {
+    "size" : 4096
+    }
+
+#Multi-fidelity evaluation scores everything on the first (coarsest) grid, promotes the
+#best "promote" fraction to the next grid, and so on.  The ones left at the end are
+#scored on all the data.  The levels are gridRegular filters (see dataFilters),
+#the axes default to the first two inVars.
+multiFidelityDefaults = {
+    "levels" : [ { "xRemainingPoints" : 25, "yRemainingPoints" : 25, "promote" : 0.3 },
+                 { "xRemainingPoints" : 63, "yRemainingPoints" : 63, "promote" : 0.3 } ]
+    }
+
+#Interval analysis rejects trees that are NaN or infinite everywhere on the data
+#before they are evaluated.  With decorate, children from mate and mutate that are
+#rejected are replaced by a parent.
+intervalAnalysisDefaults = {
+    "decorate" : False
+    }
+
+#Simplification folds constants and applies identity rules (see sr_simplify).
+#beforeEvaluation simplifies every individual in place before it is evaluated,
+#afterVariation simplifies the children of mate and mutate.
+simplifyDefaults = {
+    "beforeEvaluation" : True,
+    "afterVariation"   : False
+    }
+
+#Constant optimization fits the constants of the topK best individuals with
+#Levenberg-Marquardt (at most maxIterations iterations each) every frequency
+#generations.  Like migration and checkpoints it happens every stopFrequency
+#generations at most.
+constantOptimizationDefaults = {
+    "frequency"     : 10,
+    "topK"          : 10,
+    "maxIterations" : 20
+    }
+
+#Individuals are evaluated in batches.  maxBlockMB bounds the memory used for the
+#function values of a block of individuals, batchesPerProcess is how many batches
+#each -t process gets per generation.
+batchEvaluationDefaults = {
+    "maxBlockMB"        : 64,
+    "batchesPerProcess" : 4
+    }
+
+#The subtree cache is only turned on if there is a "subtreeCache" section in the config.
+#memoryBudgetMB bounds the memory held by the cached subtree outputs.
+subtreeCacheDefaults = {
+    "memoryBudgetMB" : 256
+    }
+
+#Incremental evaluation is only turned on if there is an "incrementalEvaluation" section in the config.
+#memoryBudgetMB bounds the memory held by the node outputs kept for parents.
+incrementalEvaluationDefaults = {
+    "memoryBudgetMB" : 512
+    }
+
+#The fitness cache is only turned on if there is a "fitnessCache" section in the config.
+#maxSize is the number of fitnesses to remember before the least recently used are dropped.
+#With a persistentFile (sqlite), fitnesses are also kept there for later runs on the same
+#data, up to persistentMaxSize of them.  busyTimeout is how many seconds to wait when
+#another rank or run is writing the file.
+fitnessCacheDefaults = {
+    "maxSize"           : 100000,
+    "persistentFile"    : None,
+    "persistentMaxSize" : 1000000,
+    "busyTimeout"       : 60.0
+    }
+
+#Semantic fingerprinting is only turned on if there is a "semanticFingerprint" section in the config.
+#Trees are evaluated on probeRows fixed rows of the data, and trees whose values there match
+#to digits significant digits share a fitness.  maxSize is the number of fingerprints to
+#remember.  With cullDuplicates, every stopFrequency generations all but the smallest of the
+#individuals with the same fingerprint are replaced with new random individuals.
+semanticFingerprintDefaults = {
+    "probeRows"      : 64,
+    "digits"         : 12,
+    "maxSize"        : 100000,
+    "cullDuplicates" : False
+    }
+
 
 def add_options(op):
     """
@@ -206,6 +324,8 @@ def registerMutator(config, toolbox, pset):
     mut_block = setDefaults(mut_block, { "type" : "mutUniform" })
 
     (mutator, kwargs) = mutationFactory(mut_block, toolbox, pset)
+    if(config.has_key("incrementalEvaluation")):  #The incremental evaluator needs to know what changed
+        mutator = sr_mutators.recordMutation(mutator)
     toolbox.register("mutate", mutator, **kwargs)
 
 
@@ -290,6 +410,312 @@ def registerAlgorithm(algo_config, toolbox, stats, halloffame, verbose):
         raise ValueError("Unknown evolution algorithm %s" % algo_config["type"])
     return algoArgs
 
+def evaluatorFactory(config, pset):
+    """Returns the evaluator object to be registered as toolbox.evalTree.
+
+    :param config: The configuration dictionary.  "evaluator" is compile, stack, grid or buffered.
+                   If there is a "subtreeCache" section the subtree caching stack evaluator is used,
+                   if there is an "incrementalEvaluation" section the incremental one is.
+                   "evalBackend" numexpr or numba replaces all of those, if it's installed.
+    :param pset: The primitive set the individuals are made from
+    """
+    evaluatorName = config["evaluator"]
+    if(config.has_key("subtreeCache") and config.has_key("incrementalEvaluation")):
+        raise ValueError("subtreeCache and incrementalEvaluation cannot be used together")
+    backend = config["evalBackend"].lower()
+    if(backend != "numpy"):
+        if(config.has_key("subtreeCache") or config.has_key("incrementalEvaluation")):
+            raise ValueError("evalBackend %s cannot be used with subtreeCache or incrementalEvaluation" % backend)
+        if(backend == "numexpr"):
+            if(sr_evaluators.hasNumexpr):
+                return sr_evaluators.numexprEvaluator(pset)
+        elif(backend == "numba"):
+            if(sr_evaluators.hasNumba):
+                return sr_evaluators.numbaEvaluator(pset)
+        else:
+            raise ValueError("Unknown evalBackend %s" % config["evalBackend"])
+        print "WARNING: %s is not installed, using evalBackend numpy" % backend
+    if(config.has_key("incrementalEvaluation")):
+        incrementalConfig = setDefaults(config["incrementalEvaluation"], incrementalEvaluationDefaults)
+        return sr_evaluators.incrementalEvaluator(pset, incrementalConfig["memoryBudgetMB"])
+    if(config.has_key("subtreeCache")):
+        cacheConfig = setDefaults(config["subtreeCache"], subtreeCacheDefaults)
+        return sr_evaluators.subtreeCachingEvaluator(pset, cacheConfig["memoryBudgetMB"])
+    if(evaluatorName.lower() == "compile"):
+        return sr_evaluators.compiledEvaluator(pset)
+    if(evaluatorName.lower() == "stack"):
+        return sr_evaluators.stackEvaluator(pset)
+    if(evaluatorName.lower() == "grid"):
+        return sr_evaluators.gridEvaluator(pset)
+    if(evaluatorName.lower() == "buffered"):
+        return sr_evaluators.bufferedEvaluator(pset, config["depthLimit"] + 1)
+    raise ValueError("Unknown evaluator %s" % evaluatorName)
+
+def distributedEvaluationConfig(config):
+    """The "distributedEvaluation" section with its defaults, after checking it works
+    with the rest of the configuration.  None if there isn't one.
+    """
+    if(not config.has_key("distributedEvaluation")):
+        return None
+    distConfig = setDefaults(config["distributedEvaluation"], distributedEvaluationDefaults)
+    distConfig["split"] = distConfig["split"].lower()
+    if(distConfig["split"] not in ["individuals", "rows"]):
+        raise ValueError("Unknown distributedEvaluation split %s" % distConfig["split"])
+    if(distConfig["split"] == "rows"):
+        #These need all the rows on the rank that runs the algorithm, or rows picked across ranks
+        for section in ["racing", "miniBatch", "multiFidelity", "linearScaling", "intervalAnalysis",
+                        "constantOptimization"]:
+            if(config.has_key(section)):
+                raise ValueError("%s cannot be used with distributedEvaluation split rows" % section)
+    return distConfig
+
+def rowsSplit(config):
+    """True if the rows of the data are split across MPI ranks (see sr_mpi)."""
+    distConfig = distributedEvaluationConfig(config)
+    return distConfig is not None and distConfig["split"] == "rows"
+
+def registerIntervalAnalysis(config, toolbox, errorObj, pset):
+    """If there's an "intervalAnalysis" section, registers toolbox.rejectTree, which
+    says if interval analysis (see sr_intervals) shows a tree can't be evaluated anywhere
+    on the data.  registerEvaluationMap uses it to skip those trees.
+    With "decorate", mate and mutate are decorated to throw out children like that.
+    mate and mutate must already be registered.
+
+    :param errorObj: The error function, it has the inVar data
+    :param pset: The primitive set
+    """
+    if(not config.has_key("intervalAnalysis")):
+        return
+    intervalConfig = setDefaults(config["intervalAnalysis"], intervalAnalysisDefaults)
+    analyzer = sr_intervals.intervalAnalyzer(pset, config["inVars"], errorObj.inVarValues)
+    toolbox.register("rejectTree", analyzer.rejects)
+    if(intervalConfig["decorate"]):
+        #A rejected child is 1 over the limit of 0, so staticLimit swaps it for a parent
+        toolbox.decorate("mate", gp.staticLimit(key=analyzer.rejects, max_value=0))
+        toolbox.decorate("mutate", gp.staticLimit(key=analyzer.rejects, max_value=0))
+
+def registerSimplify(config, toolbox, errorObj, pset):
+    """If there's a "simplify" section, sets up sr_simplify.  With beforeEvaluation
+    it registers toolbox.simplifyTree, which registerEvaluationMap uses to simplify
+    trees before they are evaluated.  With afterVariation, mate and mutate are decorated
+    to simplify their children.  mate and mutate must already be registered.
+
+    :param errorObj: The error function, it has the inVar data
+    :param pset: The primitive set
+    """
+    if(not config.has_key("simplify")):
+        return
+    simplifyConfig = setDefaults(config["simplify"], simplifyDefaults)
+    inVarValues = errorObj.inVarValues
+    if(rowsSplit(config)):  #The rules checked on the data would only be checked on this rank's rows
+        inVarValues = []
+    treeSimplifier = sr_simplify.simplifier(pset, config["inVars"], inVarValues)
+    if(simplifyConfig["beforeEvaluation"]):
+        toolbox.register("simplifyTree", treeSimplifier.simplify)
+    if(simplifyConfig["afterVariation"]):
+        toolbox.decorate("mate", treeSimplifier.decorator)
+        toolbox.decorate("mutate", treeSimplifier.decorator)
+
+def registerFingerprint(config, toolbox, errorObj, pset):
+    """If there's a "semanticFingerprint" section, registers toolbox.fingerprint, which
+    registerEvaluationMap uses to share fitnesses between trees that compute the same
+    values (see sr_cache.semanticFingerprinter).
+
+    :param errorObj: The error function, it has the inVar data
+    :param pset: The primitive set
+    """
+    if(not config.has_key("semanticFingerprint")):
+        return
+    fingerprintConfig = setDefaults(config["semanticFingerprint"], semanticFingerprintDefaults)
+    fingerprinter = sr_cache.semanticFingerprinter(pset, config["inVars"], errorObj.inVarValues,
+                                                   fingerprintConfig["probeRows"], fingerprintConfig["digits"])
+    toolbox.register("fingerprint", fingerprinter.fingerprint)
+
+def constantOptimizerFactory(config, errorObj, pset, pool=None, numProcesses=1, logger=None):
+    """Returns the sr_constants.constantOptimizer for the "constantOptimization" section,
+    or None if there isn't one.
+
+    :param pool: The -t evaluation pool, the fitting is split across it.  None to fit serially.
+    :return (optimizer, frequency): The optimizer and how many generations between optimizations
+    """
+    if(not config.has_key("constantOptimization")):
+        return (None, None)
+    optimizationConfig = setDefaults(config["constantOptimization"], constantOptimizationDefaults)
+    optimizer = sr_constants.constantOptimizer(errorObj, pset, optimizationConfig["topK"],
+                                               optimizationConfig["maxIterations"],
+                                               pool, numProcesses, logger)
+    return (optimizer, optimizationConfig["frequency"])
+
+def registerEvaluationMap(config, toolbox, logger=None, hallOfFame=None):
+    """registerEvaluationMap wraps whatever map is currently registered in the toolbox
+    (the builtin map, or pool.map when running with -t) with the optional evaluation
+    layers from the configuration file, and registers the result as toolbox.map.
+    The DEAP algorithms evaluate with toolbox.map, so this is how things like the
+    fitness cache get in front of the error functions.  Evaluations between generations
+    go through toolbox.rescoreMap, also registered here.
+
+    :param config:  The configuration dictionary
+    :param toolbox: The toolbox to register in.  toolbox.map must already be registered.
+    :param logger:  PrintLogger class, used to report evaluation statistics
+    :param hallOfFame: The hall of fame, racing can take its cutoff from it
+    :return evalMaps: The list of wrappers, innermost first.  Each has a report() for the end of the run.
+    """
+    evalMaps = []
+    evaluator = toolbox.evalTree.func  #toolbox.register wraps the evaluator in a partial
+    if(hasattr(evaluator, "newGeneration")):
+        evalMaps.append(sr_evaluators.generationMap(evaluator, toolbox.map, logger))
+        toolbox.register("map", evalMaps[-1])
+    if(hasattr(toolbox, "rejectTree")):
+        evalMaps.append(sr_intervals.intervalMap(toolbox.rejectTree, toolbox.evaluate.func, toolbox.map, logger))
+        toolbox.register("map", evalMaps[-1])
+    if(hasattr(toolbox, "fingerprint")):
+        #Inside the fitness cache, so only trees the cache hasn't seen get fingerprinted
+        fingerprintConfig = setDefaults(config["semanticFingerprint"], semanticFingerprintDefaults)
+        cache = sr_cache.fitnessCache(fingerprintConfig["maxSize"])
+        evalMaps.append(sr_cache.fingerprintMap(toolbox.fingerprint, cache, toolbox.map, logger))
+        toolbox.register("map", evalMaps[-1])
+        if(fingerprintConfig["cullDuplicates"]):
+            #The new individuals would be scored on a different grid from the population
+            if(config.has_key("multiFidelity")):
+                raise ValueError("cullDuplicates cannot be used with multiFidelity")
+            toolbox.register("cullDuplicates", evalMaps[-1].cull, toolbox=toolbox)
+    if(config.has_key("fitnessCache")):
+        cacheConfig = setDefaults(config["fitnessCache"], fitnessCacheDefaults)
+        if(cacheConfig["persistentFile"]):
+            cache = sr_cache.persistentFitnessCache(cacheConfig["maxSize"], cacheConfig["persistentFile"],
+                                                    fitnessCacheContext(config, toolbox.evaluate.func),
+                                                    cacheConfig["persistentMaxSize"], cacheConfig["busyTimeout"])
+        else:
+            cache = sr_cache.fitnessCache(cacheConfig["maxSize"])
+        evalMaps.append(sr_cache.cachedMap(cache, toolbox.map, logger))
+        toolbox.register("map", evalMaps[-1])
+    if(hasattr(toolbox, "simplifyTree")):
+        #Outside the cache, so the cache sees the simplified trees
+        evalMaps.append(sr_simplify.simplifyMap(toolbox.simplifyTree, toolbox.evaluate.func, toolbox.map, logger))
+        toolbox.register("map", evalMaps[-1])
+    if(config.has_key("racing")):
+        #The caching evaluators keep outputs for the whole data set, they would just
+        #throw everything away on every chunk of rows
+        if isinstance(evaluator, (sr_evaluators.subtreeCachingEvaluator, sr_evaluators.incrementalEvaluator)):
+            raise ValueError("racing cannot be used with subtreeCache or incrementalEvaluation")
+        raceConfig = setDefaults(config["racing"], racingDefaults)
+        errorObj = toolbox.evaluate.func  #The error function already set up its chunks (see errorFunc)
+        raceMap = sr_errorfuncs.racingMap(errorObj, toolbox.map, raceConfig, hallOfFame, logger)
+        evalMaps.append(raceMap)
+        toolbox.register("map", raceMap)
+    sampleModes = [mode for mode in ["racing", "miniBatch", "multiFidelity"] if config.has_key(mode)]
+    if(len(sampleModes) > 1):
+        raise ValueError("%s cannot be used together" % " and ".join(sampleModes))
+    precision = str(config["precision"].lower())  #JSON gives unicode, it goes into byte string cache keys
+    if(precision not in ["float64", "float32"]):
+        raise ValueError("Unknown precision %s" % config["precision"])
+    if(precision == "float32" and config.has_key("racing")):
+        raise ValueError("racing cannot be used with precision float32")
+    if(config.has_key("miniBatch")):
+        batchConfig = setDefaults(config["miniBatch"], miniBatchDefaults)
+        batchMap = sr_errorfuncs.miniBatchMap(toolbox.evaluate.func, toolbox.map, batchConfig["size"], logger,
+                                              precision)
+        evalMaps.append(batchMap)
+        toolbox.register("map", batchMap)
+    if(config.has_key("multiFidelity")):
+        fidelityConfig = setDefaults(config["multiFidelity"], multiFidelityDefaults)
+        #The levels are regular sub-grids in x and y, other inVars would just be ignored
+        if(len(config["inVars"]) != 2):
+            raise ValueError("multiFidelity needs 2-D grid data with exactly two inVars (the grid axes), there are %d" %
+                             len(config["inVars"]))
+        errorObj = toolbox.evaluate.func
+        levels = []
+        for levelConfig in fidelityConfig["levels"]:
+            levelConfig = setDefaults(levelConfig, { "xAxisName" : config["inVars"][0],
+                                                     "yAxisName" : config["inVars"][1],
+                                                     "startValue" : 0.5,
+                                                     "promote"   : 0.5 })
+            if(levelConfig["xAxisName"] == levelConfig["yAxisName"]):
+                raise ValueError("multiFidelity xAxisName and yAxisName are both %s" % levelConfig["xAxisName"])
+            levelConfig["type"] = "gridRegular"
+            gridFilter = dataFilters.modifierFactory(levelConfig)
+            rows = dataFilters.filterRows(gridFilter, config["inVars"], errorObj.inVarValues)
+            levels.append((rows, levelConfig["promote"]))
+        evalMaps.append(sr_errorfuncs.multiFidelityMap(errorObj, toolbox.map, levels, logger, precision))
+        toolbox.register("map", evalMaps[-1])
+    if(precision == "float32" and not (config.has_key("miniBatch") or config.has_key("multiFidelity"))):
+        evalMaps.append(sr_errorfuncs.lowPrecisionMap(toolbox.evaluate.func, toolbox.map, logger))
+        toolbox.register("map", evalMaps[-1])
+    #Individuals evaluated between generations (constant optimization, culling) go through
+    #rescoreMap.  Racing and miniBatch are never combined with each other, so their map is
+    #the outermost.  Racing doesn't learn a cutoff from them, miniBatch uses the generation's sample.
+    if(config.has_key("racing")):
+        toolbox.register("rescoreMap", raceMap.rescoreMap)
+    elif(config.has_key("miniBatch")):
+        toolbox.register("rescoreMap", batchMap.sampleMap)
+    else:
+        toolbox.register("rescoreMap", toolbox.map)
+    return evalMaps
+
+def fitnessCacheContext(config, errorObj):
+    """The context for a persistent fitness cache: a hash of everything besides the tree
+    that the fitness depends on.  That's the data after the filters, the error function
+    and the options that change what the fitness means.
+
+    :param errorObj: The error function registered as toolbox.evaluate
+    """
+    description = { "data"          : errorObj.dataKey(),
+                    "filters"       : config["filters"],
+                    "inVars"        : config["inVars"],
+                    "targetVar"     : config["targetVar"],
+                    "errorfunc"     : config["errorfunc"],
+                    "weights"       : errorObj.weight(),  #Different with the pareto size objective
+                    "linearScaling" : config.has_key("linearScaling"),
+                    "treeKey"       : 2 }  #Version 1 keys didn't keep int and float constants apart
+    return hashlib.sha1(json.dumps(description, sort_keys=True)).hexdigest()
+
+def algorithmHallOfFame(config, hallOfFame, evalMaps, toolbox):
+    """Returns the hall of fame the algorithm should update.  Usually that's just
+    hallOfFame, but in mini-batch, multi-fidelity and float32 mode individuals have to be re-scored on all the
+    data in float64 before they go in, so the hall of fame only ever has exact fitnesses.
+
+    :param evalMaps: The evaluation maps from registerEvaluationMap
+    """
+    if(config.has_key("miniBatch") or config.has_key("multiFidelity") or config["precision"].lower() == "float32"):
+        return sr_errorfuncs.rescoringHallOfFame(hallOfFame, evalMaps[-1], toolbox)
+    return hallOfFame
+
+def exactPopulation(config, population, algoHof):
+    """Returns the population the way it should be printed or checkpointed.  In float32 mode
+    the fitnesses are only estimates, so that's a copy re-scored in float64.
+
+    :param algoHof: The hall of fame from algorithmHallOfFame
+    """
+    if(config["precision"].lower() == "float32"):
+        return algoHof.rescored(population)
+    return population
+
+def psetFactory(config):
+    """Makes the primitive set for a run: the primitives and constants from the
+    configuration file, and the arguments renamed to match the inVars.
+
+    :param config: The configuration dictionary
+    :return pset: The PrimitiveSet
+    """
+    pset = gp.PrimitiveSet("MAIN", len(config["inVars"]))  #Pass in the number of inVars here
+    sr_primitives.primitiveFactory(config["primitives"], pset)
+    constantFactory(config["constants"], pset)
+
+    #Rename the arguments to match the configuration file
+    rename_kwargs = {}
+    for ii in range(0, len(config["inVars"])):
+        rename_kwargs["ARG%d" % ii] = config["inVars"][ii]
+    pset.renameArguments(**rename_kwargs) 
+    return pset
+
+#DEAP keeps ephemeral classes by name in its own module, for every pset, and before
+#1.4 it refuses a second function under a name.  So each name keeps the function it
+#was first registered with, and psets made later in the process share it.
+ephemeralFunctions = {}
+
+def addEphemeral(pset, name, ephemeral):
+    pset.addEphemeralConstant(name, ephemeralFunctions.setdefault(name, ephemeral))
+
 def constantFactory(constants, pset):
 
     for const_block in constants:
@@ -302,30 +728,30 @@ def constantFactory(constants, pset):
                 raise ValueError("Constant randint in configuration must have min and max values.\n %s" % str(const_block));
             minn = int(const_block["min"])
             maxx = int(const_block["max"])
-            pset.addEphemeralConstant("randint%d.%d" %(minn, maxx), lambda: random.randint(minn,maxx))
+            addEphemeral(pset, "randint%d.%d" %(minn, maxx), lambda: random.randint(minn,maxx))
         elif typename == "uniform":
             if(not const_block.has_key("min") or not const_block.has_key("max")):
                 raise ValueError("Constant uniform in configuration must have min and max values.\n %s" % str(const_block));
             minn = int(const_block["min"])
             maxx = int(const_block["max"])
-            pset.addEphemeralConstant("uniform%d.%d" %(minn, maxx), lambda: random.uniform(minn,maxx))
+            addEphemeral(pset, "uniform%d.%d" %(minn, maxx), lambda: random.uniform(minn,maxx))
         elif typename == "normal":
             if(not const_block.has_key("mu") or not const_block.has_key("sigma")):
                 raise ValueError("Constant normal in configuration must have mu and sigma values.\n %s" % str(const_block));
             mu = int(const_block["mu"])
             sigma = int(const_block["sigma"])
-            pset.addEphemeralConstant("normal%d.%d" %(mu, sigma), lambda: random.normalvariate(mu,sigma))
+            addEphemeral(pset, "normal%d.%d" %(mu, sigma), lambda: random.normalvariate(mu,sigma))
         elif typename == "gamma":
             if(not const_block.has_key("alpha") or not const_block.has_key("beta")):
                 raise ValueError("Constant gamma in configuration must have alpha and beta values.\n %s" % str(const_block));
             alpha = int(const_block["alpha"])
             beta = int(const_block["beta"])
-            pset.addEphemeralConstant("normal%d.%d" %(alpha, beta), lambda: random.gammavariate(alpha,beta))
+            addEphemeral(pset, "gamma%d.%d" %(alpha, beta), lambda: random.gammavariate(alpha,beta))
         elif typename == "constant":
             if(not const_block.has_key("value")):
                 raise ValueError("Constant constant in configuration must have value.\n %s" % str(const_block));
             value = int(const_block["value"])
-            pset.addEphemeralConstant("const%d" %(value), lambda: value)
+            addEphemeral(pset, "const%d" %(value), lambda: value)
         else:
             raise ValueError("Unknown constant type %s\n" % typename)
 
@@ -0,0 +1,337 @@
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Copyright (c)2016, Lawrence Livermore National Security, LLC. 
+# Produced at the Lawrence Livermore National Laboratory. 
+# Written by Jim Leek <leek2@llnl.gov>. 
+# LLNL-CODE-704100. 
+# All rights reserved.
+#
+# This file is part of SoRa.  For details, see https://github.com/llnl/SoRa.
+# Please also read SoRa/LICENSE
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Interval analysis of trees.  Every input variable is known to lie between its
+# minimum and maximum in the data, so working out the range of each subtree
+# with interval arithmetic can prove that a tree is bad everywhere (e.g. the
+# sqrt of something that is always negative, or 0 / 0)
+# without evaluating it on any data.  Those trees get the worst fitness
+# straight away.
+#
+# An interval is a (lo, hi) tuple of floats.  The rules only ever make intervals
+# bigger than the real range, so a tree is only rejected when every value it
+# could produce is NaN or infinite.  The (-inf, inf) interval means "don't know".
+# A subtree that's inf everywhere is (inf, inf) (or (-inf, -inf)), and is passed
+# on up like any other interval, because functions further up can turn it back
+# into finite values (exp(-inf) is 0, tanh(inf) is 1).  So infinities are only
+# checked at the root.  A subtree that's NaN everywhere is rejected straight away,
+# NaN stays NaN.
+import math
+import numpy
+from deap import gp
+
+unknown = (-numpy.inf, numpy.inf)
+
+
+class invalidInterval(ArithmeticError):
+    """Raised when a subtree is NaN on every point of the data, or the whole tree
+    is NaN or infinite on every point."""
+    pass
+
+
+def interval(lo, hi):
+    """Makes an interval, turning NaN ends (from inf - inf, 0 * inf, etc.) into infinities."""
+    if(numpy.isnan(lo)):
+        lo = -numpy.inf
+    if(numpy.isnan(hi)):
+        hi = numpy.inf
+    return (lo, hi)
+
+
+def widen(lo, hi, ulps=4):
+    """numpy's transcendental functions aren't always correctly rounded, so their
+    results are widened by a few units in the last place to be safe."""
+    for ii in xrange(ulps):
+        if(lo != numpy.inf):  #(inf, inf) has to stay inf everywhere
+            lo = numpy.nextafter(lo, -numpy.inf)
+        if(hi != -numpy.inf):
+            hi = numpy.nextafter(hi, numpy.inf)
+    return (lo, hi)
+
+
+def monotonic(func, lo, hi, increasing=True):
+    """The interval of a monotonic function.  The basic arithmetic functions
+    are correctly rounded, and rounding is monotonic too, so evaluating the
+    endpoints is enough for them.  The functions that use this get widened."""
+    if(increasing):
+        return widen(*interval(func(lo), func(hi)))
+    return widen(*interval(func(hi), func(lo)))
+
+
+def intervalAdd(a, b):
+    return interval(a[0] + b[0], a[1] + b[1])
+
+def intervalSub(a, b):
+    return interval(a[0] - b[1], a[1] - b[0])
+
+def intervalMul(a, b):
+    products = [a[0] * b[0], a[0] * b[1], a[1] * b[0], a[1] * b[1]]
+    if(any(numpy.isnan(product) for product in products)):  #0 * inf
+        return unknown
+    return interval(min(products), max(products))
+
+def intervalDiv(a, b):
+    if(b[0] == 0 and b[1] == 0):
+        if(a[0] == 0 and a[1] == 0):  #0 / 0 is NaN everywhere
+            raise invalidInterval()
+        #Otherwise +-inf, but intervals don't keep the sign of a zero, so which inf isn't known
+        return unknown
+    if(b[0] <= 0 <= b[1]):
+        return unknown
+    quotients = [a[0] / b[0], a[0] / b[1], a[1] / b[0], a[1] / b[1]]
+    if(any(numpy.isnan(quotient) for quotient in quotients)):  #inf / inf
+        return unknown
+    return interval(min(quotients), max(quotients))
+
+def intervalNeg(a):
+    return (-a[1], -a[0])
+
+def intervalAbs(a):
+    if(a[0] >= 0):
+        return a
+    if(a[1] <= 0):
+        return (-a[1], -a[0])
+    return (0.0, max(-a[0], a[1]))
+
+def intervalSquare(a):
+    (lo, hi) = intervalAbs(a)
+    return interval(lo * lo, hi * hi)
+
+def intervalSqrt(a):
+    if(a[1] < 0):
+        raise invalidInterval()
+    return interval(numpy.sqrt(max(a[0], 0.0)), numpy.sqrt(a[1]))
+
+def intervalReciprocal(a):
+    return intervalDiv((1.0, 1.0), a)
+
+def intervalLog(func):
+    def rule(a):
+        if(a[1] < 0):  #NaN everywhere
+            raise invalidInterval()
+        if(a[1] == 0):  #-inf where it's 0, NaN where it's negative
+            return (-numpy.inf, -numpy.inf)
+        if(a[0] <= 0):
+            return (-numpy.inf, widen(func(a[1]), func(a[1]))[1])
+        return monotonic(func, a[0], a[1])
+    return rule
+
+def intervalSin(a):
+    if(a[0] == a[1] and numpy.isinf(a[0])):  #NaN everywhere
+        raise invalidInterval()
+    if(not (numpy.isfinite(a[0]) and numpy.isfinite(a[1])) or a[1] - a[0] >= 2 * math.pi):
+        return (-1.0, 1.0)
+    (lo, hi) = widen(min(numpy.sin(a[0]), numpy.sin(a[1])), max(numpy.sin(a[0]), numpy.sin(a[1])))
+    #Peaks at pi/2 + 2k pi, troughs at -pi/2 + 2k pi
+    if(math.floor((a[1] - math.pi / 2) / (2 * math.pi)) != math.floor((a[0] - math.pi / 2) / (2 * math.pi))):
+        hi = 1.0
+    if(math.floor((a[1] + math.pi / 2) / (2 * math.pi)) != math.floor((a[0] + math.pi / 2) / (2 * math.pi))):
+        lo = -1.0
+    return (max(lo, -1.0), min(hi, 1.0))
+
+def intervalCos(a):
+    if(a[0] == a[1] and numpy.isinf(a[0])):  #NaN everywhere
+        raise invalidInterval()
+    if(not (numpy.isfinite(a[0]) and numpy.isfinite(a[1])) or a[1] - a[0] >= 2 * math.pi):
+        return (-1.0, 1.0)
+    (lo, hi) = widen(min(numpy.cos(a[0]), numpy.cos(a[1])), max(numpy.cos(a[0]), numpy.cos(a[1])))
+    #Peaks at 2k pi, troughs at pi + 2k pi
+    if(math.floor(a[1] / (2 * math.pi)) != math.floor(a[0] / (2 * math.pi))):
+        hi = 1.0
+    if(math.floor((a[1] - math.pi) / (2 * math.pi)) != math.floor((a[0] - math.pi) / (2 * math.pi))):
+        lo = -1.0
+    return (max(lo, -1.0), min(hi, 1.0))
+
+def intervalTan(a):
+    if(a[0] == a[1] and numpy.isinf(a[0])):  #NaN everywhere
+        raise invalidInterval()
+    if(not (numpy.isfinite(a[0]) and numpy.isfinite(a[1])) or a[1] - a[0] >= math.pi):
+        return unknown
+    #Poles at pi/2 + k pi
+    if(math.floor((a[1] - math.pi / 2) / math.pi) != math.floor((a[0] - math.pi / 2) / math.pi)):
+        return unknown
+    return monotonic(numpy.tan, a[0], a[1])
+
+def clippedDomain(func, domainLo, domainHi, increasing=True):
+    """Rule for functions only defined on [domainLo, domainHi] (arcsin, etc.)"""
+    def rule(a):
+        if(a[1] < domainLo or a[0] > domainHi):
+            raise invalidInterval()
+        return monotonic(func, max(a[0], domainLo), min(a[1], domainHi), increasing)
+    return rule
+
+def intervalArctanh(a):
+    if(a[1] < -1 or a[0] > 1):  #NaN everywhere
+        raise invalidInterval()
+    if(a[1] == -1):  #-inf where it's -1, NaN below
+        return (-numpy.inf, -numpy.inf)
+    if(a[0] == 1):
+        return (numpy.inf, numpy.inf)
+    return monotonic(numpy.arctanh, max(a[0], -1.0), min(a[1], 1.0))
+
+def intervalCosh(a):
+    (lo, hi) = intervalAbs(a)
+    return monotonic(numpy.cosh, lo, hi)
+
+def increasing(func):
+    """Rule for functions that are increasing everywhere (exp, atan, etc.)"""
+    def rule(a):
+        return monotonic(func, a[0], a[1])
+    return rule
+
+def intervalArctan2(a, b):
+    return (-math.pi, math.pi)
+
+
+#The rule for each primitive in sr_primitives.primitiveFactory, by primitive name.
+#Primitives without a rule (power) are only analyzed when all their arguments are constant.
+intervalRules = {
+    "add"        : intervalAdd,
+    "sub"        : intervalSub,
+    "mul"        : intervalMul,
+    "div"        : intervalDiv,
+    "neg"        : intervalNeg,
+    "abs"        : intervalAbs,
+    "exp"        : increasing(numpy.exp),
+    "exp2"       : increasing(numpy.exp2),
+    "log"        : intervalLog(numpy.log),
+    "log2"       : intervalLog(numpy.log2),
+    "log10"      : intervalLog(numpy.log10),
+    "sqrt"       : intervalSqrt,
+    "square"     : intervalSquare,
+    "reciprocal" : intervalReciprocal,
+    "sin"        : intervalSin,
+    "cos"        : intervalCos,
+    "tan"        : intervalTan,
+    "asin"       : clippedDomain(numpy.arcsin, -1.0, 1.0),
+    "acos"       : clippedDomain(numpy.arccos, -1.0, 1.0, increasing=False),
+    "atan"       : increasing(numpy.arctan),
+    "atan2"      : intervalArctan2,
+    "sinh"       : increasing(numpy.sinh),
+    "cosh"       : intervalCosh,
+    "tanh"       : increasing(numpy.tanh),
+    "asinh"      : increasing(numpy.arcsinh),
+    "acosh"      : clippedDomain(numpy.arccosh, 1.0, numpy.inf),
+    "atanh"      : intervalArctanh,
+    }
+
+
+class intervalAnalyzer(object):
+    """Works out the interval of a tree's values over the data, from the range
+    of each input variable.
+    """
+
+    def __init__(self, pset, inVarNames, inVarValues):
+        """
+        :param pset:        The primitive set.  Its functions are used on constant subtrees.
+        :param inVarNames:  The names of the input variables (config["inVars"])
+        :param inVarValues: The input variable arrays
+        """
+        self.functions = {}
+        for primitives in pset.primitives.itervalues():
+            for primitive in primitives:
+                self.functions[primitive.name] = pset.context[primitive.name]
+        self.ranges = {}
+        for (name, values) in zip(inVarNames, inVarValues):
+            self.ranges[name] = (float(numpy.nanmin(values)), float(numpy.nanmax(values)))
+
+    def analyze(self, individual):
+        """Returns the interval of the tree's values.  Raises invalidInterval if
+        the tree is NaN or infinite everywhere."""
+        stack = []
+        with numpy.errstate(all='ignore'):
+            for node in reversed(individual):
+                if isinstance(node, gp.Primitive):
+                    args = [stack.pop() for ii in xrange(node.arity)]
+                    if(all(arg[0] == arg[1] for arg in args)):
+                        #All constant, so just do exactly what evaluation would do
+                        try:
+                            value = self.functions[node.name](*[arg[0] for arg in args])
+                        except (ArithmeticError, ValueError):  #The evaluation would fail the same way
+                            raise invalidInterval()
+                        if(numpy.isnan(value)):
+                            raise invalidInterval()
+                        stack.append((value, value))  #Can be +-inf, it might not stay that way
+                    elif(node.name in intervalRules):
+                        stack.append(intervalRules[node.name](*args))
+                    else:
+                        stack.append(unknown)
+                elif node.value in self.ranges:
+                    stack.append(self.ranges[node.value])
+                else:
+                    #Keep the constant's own type, integer constants do integer math (reciprocal(3) is 0)
+                    stack.append((node.value, node.value))
+        (lo, hi) = stack[0]
+        if(lo == hi and numpy.isinf(lo)):  #Overflowed everywhere
+            raise invalidInterval()
+        return stack[0]
+
+    def rejects(self, individual):
+        """True if the tree can't be evaluated anywhere on the data."""
+        try:
+            self.analyze(individual)
+        except invalidInterval:
+            return True
+        return False
+
+
+class intervalMap(object):
+    """intervalMap sits in front of the map used for evaluation (toolbox.map).
+    Individuals the interval analysis rejects get the worst fitness without being
+    evaluated, the rest are passed on to the inner map.
+    """
+
+    def __init__(self, rejectTree, errorObj, innerMap, logger=None):
+        """
+        :param rejectTree: Returns True for trees that can't be evaluated (intervalAnalyzer.rejects)
+        :param errorObj:   The error function registered as toolbox.evaluate
+        :param innerMap:   The map function to actually evaluate with
+        :param logger:     PrintLogger class.  Prints the number rejected each generation
+        """
+        self.rejectTree = rejectTree
+        self.errorObj = errorObj
+        self.innerMap = innerMap
+        self.logger = logger
+        self.generation = 0
+        self.totalChecked = 0
+        self.totalRejected = 0
+
+    def __call__(self, func, individuals):
+        if(getattr(func, "func", func) is not self.errorObj):  #toolbox.evaluate is a partial
+            return self.innerMap(func, individuals)
+        individuals = list(individuals)
+        if(len(individuals) == 0):
+            return []
+        fitnesses = [None] * len(individuals)
+        toEvaluate = []
+        for (idx, individual) in enumerate(individuals):
+            if(self.rejectTree(individual)):
+                fitnesses[idx] = self.errorObj.invalidFitness(individual)
+            else:
+                toEvaluate.append(idx)
+        results = self.innerMap(func, [individuals[idx] for idx in toEvaluate])
+        for (idx, fitness) in zip(toEvaluate, results):
+            fitnesses[idx] = fitness
+
+        rejected = len(individuals) - len(toEvaluate)
+        self.totalChecked += len(individuals)
+        self.totalRejected += rejected
+        if(self.logger):
+            self.logger.printOut(3, "Interval analysis generation %d: %d of %d rejected" %
+                                 (self.generation, rejected, len(individuals)))
+        self.generation += 1
+        return fitnesses
+
+    def report(self):
+        skipped = 0.0
+        if(self.totalChecked > 0):
+            skipped = float(self.totalRejected) / self.totalChecked
+        return "Interval analysis total: %d of %d evaluations skipped (%.1f%%)" % \
+            (self.totalRejected, self.totalChecked, 100.0 * skipped)
@@ -8,10 +8,335 @@
 # This file is part of SoRa.  For details, see https://github.com/llnl/SoRa.
 # Please also read SoRa/LICENSE
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Migration between the islands (one MPI rank each, see README 3j).  The topology
+# says which islands each island sends its emigrants to and gets immigrants from:
+#  ring:      rank -> rank+1
+#  torus:     the ranks are laid out on a 2-D grid that wraps around, and each one
+#             swaps with the 4 ranks next to it
+#  hypercube: each rank swaps with the ranks whose number differs by one bit
+#  random:    each rank sends to degree random ranks and gets from degree random
+#             ranks.  The graph is drawn again every migration, the same way on
+#             every rank (from the seed and the number of the migration).
+#  star:      rank 0 gathers everyone's emigrants, picks the best of them and
+#             sends those to every island.
+# On a ring good individuals need about as many migrations as there are ranks to
+# get everywhere.  The torus needs about the square root of that, the hypercube
+# and random graphs about the log.
+# The emigrants are sent with non-blocking sends to all the destinations at once.
+# The immigrants from all the sources are put together, and if there are more
+# than numMigrants the emigrant selection picks numMigrants of them.
+#
+# Normally every island waits at each migration for the emigrants of its sources,
+# so the slowest island holds up all of them.  With asynchronous migration the
+# emigrants are sent without waiting, and the immigrants that have arrived are put
+# in the population at the next stop (stopFrequency), whenever they come.  Nothing
+# waits for them: an island that gets nothing just carries on.  Immigrants sent more
+# than maxAge of the receiver's migrations ago are thrown away.  In the star topology
+# the islands send their emigrants to rank 0.  Rank 0 keeps the last emigrants from
+# each island, and picks what it sends to all the islands from those and its own
+# emigrants, so like the synchronous star it sends the best of all the islands.
+#
+# With a codec (sr_encoding.populationCodec) the migrants are sent as compact tree
+# encodings and fitness values, instead of pickled individuals.
+try:
+    from mpi4py import MPI
+    hasMPI = True
+except ImportError:
+    hasMPI = False
+
+import copy
+import cPickle
+import time
+
+import numpy
 from deap import tools
 from deap import gp
 from deap import algorithms
 
+topologies = ["ring", "torus", "hypercube", "random", "star"]
+
+#The MPI tag of asynchronous migration messages
+migrationTag = 17
+
+
+def torusDims(size):
+    """The (rows, columns) of the grid for the torus topology.  As square as possible."""
+    rows = int(numpy.sqrt(size))
+    while(size % rows != 0):
+        rows -= 1
+    return (rows, size // rows)
+
+
+def migrationNeighbors(topology, rank, size, epoch=0, degree=2, seed=0):
+    """Which ranks this rank sends emigrants to, and gets immigrants from.  (Not for star,
+    it goes through rank 0.)
+
+    :param topology: One of topologies
+    :param epoch:    The number of the migration, the random graph is different each time
+    :param degree:   The number of destinations (and sources) of each rank in the random graph
+    :param seed:     The random graph comes from seed and epoch, so it's the same on every rank
+    :return (destinations, sources): Lists of ranks.  A rank can be in a list more than once
+             in the random graph, then it gets several messages.
+    """
+    if(size == 1):
+        return ([], [])
+    if(topology == "ring"):
+        return ([(rank + 1) % size], [(rank - 1) % size])
+    if(topology == "torus"):
+        (rows, columns) = torusDims(size)
+        (row, column) = divmod(rank, columns)
+        neighbors = []
+        for (dRow, dColumn) in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
+            neighbor = ((row + dRow) % rows) * columns + (column + dColumn) % columns
+            if(neighbor != rank and neighbor not in neighbors):  #Short sides don't have 4 different neighbors
+                neighbors.append(neighbor)
+        return (neighbors, neighbors)
+    if(topology == "hypercube"):
+        neighbors = []
+        bit = 1
+        while(bit < size):
+            if(rank ^ bit < size):  #Not all the corners are there unless size is a power of 2
+                neighbors.append(rank ^ bit)
+            bit <<= 1
+        return (neighbors, neighbors)
+    if(topology == "random"):
+        #degree random rings: each one sends to the next rank in a random order of the ranks
+        randomState = numpy.random.RandomState([seed, epoch])
+        (destinations, sources) = ([], [])
+        for ii in xrange(degree):
+            order = list(randomState.permutation(size))
+            position = order.index(rank)
+            destinations.append(int(order[(position + 1) % size]))
+            sources.append(int(order[(position - 1) % size]))
+        return (destinations, sources)
+    raise ValueError("Unknown island topology %s" % topology)
+
+
+def replaceIndividuals(population, toBeReplaced, immigrants):
+    """Puts the immigrants in the population in place of the individuals in toBeReplaced.
+    The individuals are found by their id, population.index would compare whole trees."""
+    positions = dict((id(individual), indx) for (indx, individual) in enumerate(population))
+    for (deadInv, immigrant) in zip(toBeReplaced, immigrants):
+        indx = positions.pop(id(deadInv), None)
+        if(indx is None):
+            population.append(immigrant)  #Picked twice, or not from the population.  Just append the immigrant.
+        else:
+            population[indx] = immigrant  #replace the guy we picked to leave with the new arrival
+
+
+class islandMigrator(object):
+    """Migrates individuals between the islands with one of the topologies.  Unless it's
+    asynchronous, every rank of comm has to call migrate at the same time.  Every rank
+    has to call finish at the end of the run.
+    """
+
+    def __init__(self, comm, numMigrants, selection, replacement=None, topology="ring", degree=2,
+                 seed=0, asynchronous=False, maxAge=2, codec=None, logger=None):
+        """
+        :param comm:        An MPI communicator with one island per rank
+        :param numMigrants: The number of emigrants to send to each destination, and immigrants to keep
+        :param selection:   The algorithm to select individuals to emigrate.  It also picks which
+                            immigrants to keep, when more than numMigrants arrive
+        :param replacement: The function to select the individuals to be replaced.  If it's None
+                            the emigrants are replaced.
+        :param topology:    One of topologies
+        :param degree:      The number of destinations of each rank with the random topology
+        :param seed:        The seed for the random topology, the same on every rank
+        :param asynchronous: Send without waiting, and put in the immigrants that have arrived
+                            at the next call to integrate
+        :param maxAge:      Asynchronous immigrants from more than maxAge migrations ago are dropped
+        :param codec:       sr_encoding.populationCodec to send the migrants with.  If it's None
+                            the individuals are pickled.
+        :param logger:      PrintLogger class.  Optionally prints out debugging data.
+        """
+        if(topology not in topologies):
+            raise ValueError("Unknown island topology %s, it should be one of %s" % (topology, ", ".join(topologies)))
+        self.comm = comm
+        self.numMigrants = numMigrants
+        self.selection = selection
+        self.replacement = replacement
+        self.topology = topology
+        self.degree = degree
+        self.seed = seed
+        self.asynchronous = asynchronous
+        self.maxAge = maxAge
+        self.codec = codec
+        self.logger = logger
+        self.epoch = 0
+        self.totalImmigrants = 0
+        self.totalStale = 0
+        self.waitTime = 0.0      #Time this rank spent in migration, not evolving
+        self.finishTime = 0.0    #Time spent in finish, waiting for the other ranks to get to the end
+        self.rankWaitTimes = None
+        self.arrived = []        #(epoch, emigrants) messages received, not put in the population yet
+        self.latest = {}         #Asynchronous star, on rank 0: source rank -> its last (epoch, emigrants)
+        self.pendingSends = []
+        self.bytesSent = 0
+        self.bytesPickled = 0    #What sending the same migrants as pickled individuals would have been
+
+    def pack(self, individuals, numSends=1):
+        """The message to send the individuals in, numSends times.  Counts the bytes sent,
+        and the bytes the pickled individuals would have been, for the report."""
+        pickledBytes = len(cPickle.dumps(list(individuals), cPickle.HIGHEST_PROTOCOL)) * numSends
+        self.bytesPickled += pickledBytes
+        if(self.codec is None):
+            self.bytesSent += pickledBytes
+            return individuals
+        message = self.codec.encode(individuals)
+        self.bytesSent += len(cPickle.dumps(message, cPickle.HIGHEST_PROTOCOL)) * numSends
+        return message
+
+    def unpack(self, message):
+        return message if self.codec is None else self.codec.decode(message)
+
+    def exchange(self, emigrants):
+        """Sends the emigrants to this rank's destinations.
+        :return: The immigrants from all the sources"""
+        rank = self.comm.Get_rank()
+        if(self.topology == "star"):
+            pool = self.comm.gather(self.pack(emigrants), root=0)
+            best = None
+            if(rank == 0):
+                pool = [individual for message in pool for individual in self.unpack(message)]
+                best = self.pack(self.selection(pool, self.numMigrants), self.comm.Get_size() - 1)
+            best = self.comm.bcast(best, root=0)
+            if(rank == 0 and self.codec is None):
+                return copy.deepcopy(best)  #Copies, rank 0's own might come back
+            return self.unpack(best)
+        (destinations, sources) = migrationNeighbors(self.topology, rank, self.comm.Get_size(),
+                                                     self.epoch, self.degree, self.seed)
+        self.logger.printOut(5, "Migration %d on rank %d: sending to %s, receiving from %s" %
+                             (self.epoch, rank, destinations, sources))
+        message = self.pack(emigrants, len(destinations))
+        requests = [self.comm.isend(message, dest=destination) for destination in destinations]
+        immigrants = []
+        for source in sources:
+            immigrants.extend(self.unpack(self.comm.recv(source=source)))
+        for request in requests:
+            request.wait()
+        return immigrants
+
+    def destinations(self):
+        """Where this rank sends its emigrants asynchronously."""
+        (rank, size) = (self.comm.Get_rank(), self.comm.Get_size())
+        if(self.topology == "star"):
+            return range(1, size) if rank == 0 else [0]
+        return migrationNeighbors(self.topology, rank, size, self.epoch, self.degree, self.seed)[0]
+
+    def poll(self):
+        """Receives the asynchronous messages that have arrived, without waiting for any."""
+        status = MPI.Status()
+        while(self.comm.Iprobe(source=MPI.ANY_SOURCE, tag=migrationTag, status=status)):
+            message = self.comm.recv(source=status.Get_source(), tag=migrationTag)
+            self.arrived.append(message)
+            if(self.topology == "star"):
+                self.latest[status.Get_source()] = message
+        self.pendingSends = [request for request in self.pendingSends if not request.Test()]
+
+    def putIn(self, population, immigrants, toBeReplaced=None):
+        """Puts the immigrants in the population, in place of toBeReplaced, or the ones
+        the replacement selection (or the emigrant selection) picks."""
+        rank = self.comm.Get_rank()
+        if(len(immigrants) > self.numMigrants):
+            immigrants = self.selection(immigrants, self.numMigrants)
+        if(toBeReplaced is None):
+            toBeReplaced = (self.replacement or self.selection)(population, len(immigrants))
+
+        self.logger.printOut(5, "Migration: toBeReplaced on rank: %d" % (rank))
+        self.logger.printPopulation(5, toBeReplaced)
+        self.logger.printOut(5, "Migration: immigrants on rank: %d" % (rank))
+        self.logger.printPopulation(5, immigrants)
+
+        replaceIndividuals(population, toBeReplaced, immigrants)
+        self.totalImmigrants += len(immigrants)
+
+    def migrate(self, population):
+        """Sends emigrants from the population.  Unless it's asynchronous, waits for the
+        immigrants and puts them in the population (in place)."""
+        emigrants = self.selection(population, self.numMigrants)
+        if(self.asynchronous):
+            start = time.time()
+            self.poll()
+            if(self.topology == "star" and self.comm.Get_rank() == 0):
+                #The hub forwards the best of everyone's last emigrants, not just its own
+                pool = list(emigrants)
+                for (epoch, message) in self.latest.itervalues():
+                    if(epoch >= self.epoch - self.maxAge):
+                        pool.extend(self.unpack(message))
+                emigrants = self.selection(pool, self.numMigrants)
+            destinations = self.destinations()
+            message = (self.epoch, self.pack(emigrants, len(destinations)))
+            for destination in destinations:
+                #issend, so it's only done once it's been received (see finish)
+                self.pendingSends.append(self.comm.issend(message, dest=destination, tag=migrationTag))
+            self.epoch += 1
+            self.waitTime += time.time() - start
+            return
+
+        toBeReplaced = emigrants      #if not replacement selector was defined, replace the emigrants
+        if not self.replacement is None: #Otherwise use the replacement selector
+            toBeReplaced = self.replacement(population, self.numMigrants)
+        start = time.time()
+        immigrants = self.exchange(emigrants)
+        self.waitTime += time.time() - start
+        self.putIn(population, immigrants, toBeReplaced)
+        self.epoch += 1
+
+    def integrate(self, population):
+        """Puts the asynchronous immigrants that have arrived since the last call in the
+        population (in place).  Called at every stop, does nothing if it isn't asynchronous."""
+        if(not self.asynchronous):
+            return
+        start = time.time()
+        self.poll()
+        self.waitTime += time.time() - start
+        fresh = [message for (epoch, message) in self.arrived if epoch >= self.epoch - self.maxAge]
+        self.totalStale += len(self.arrived) - len(fresh)
+        self.arrived = []
+        immigrants = [individual for message in fresh for individual in self.unpack(message)]
+        if(immigrants):
+            self.putIn(population, immigrants)
+
+    def finish(self):
+        """Called by every rank at the end of the run.  Gets rid of the asynchronous messages
+        that are still on their way, so they can't get mixed up with anything sent after.
+        The sends are synchronous-mode, so once they're all done every message has been
+        received.  Each rank keeps receiving until its own sends are done, then joins a
+        non-blocking barrier, and keeps receiving until everyone's in the barrier.
+        Then the wait times of all the ranks are gathered on rank 0.  The time spent here
+        is kept apart from the time waiting during the run, it's mostly waiting for the
+        slowest rank to finish.
+        """
+        start = time.time()
+        if(self.asynchronous):
+            barrier = None
+            while(True):
+                self.poll()
+                if(barrier is None and not self.pendingSends):
+                    barrier = self.comm.Ibarrier()
+                if(barrier is not None and barrier.Test()):
+                    break
+                time.sleep(0.001)
+            self.totalStale += len(self.arrived)  #Too late to use
+            self.arrived = []
+        self.finishTime = time.time() - start
+        self.rankWaitTimes = self.comm.gather((self.waitTime, self.finishTime), root=0)
+
+    def report(self):
+        report = "Migration total: %d migrations with the %s topology, %d immigrants" % \
+            (self.epoch, self.topology, self.totalImmigrants)
+        if(self.asynchronous):
+            report += ", %d stale or late messages dropped" % self.totalStale
+        if(self.epoch > 0):
+            report += ", %d bytes sent per migration (%d as pickled individuals)" % \
+                (self.bytesSent // self.epoch, self.bytesPickled // self.epoch)
+        report += ", %.2f seconds waiting during the run, %.2f at the end" % (self.waitTime, self.finishTime)
+        if(self.rankWaitTimes is not None):
+            report += "\nMigration wait per rank (seconds during the run / at the end): %s" % \
+                " ".join("%.2f/%.2f" % waits for waits in self.rankWaitTimes)
+        return report
+
+
 def MPIMigRing(comm, population, numMigrants, selection, replacement, logger=None):
     """Perform a ring migration between the *populations*.
        In this case, each MPI rank is expected to have 1 population.
@@ -43,28 +368,4 @@ def MPIMigRing(comm, population, numMigrants, selection, replacement, logger=Non
                         that leave the population are directly replaced.
        :param logger:      PrintLogger class.  Optionally prints out debugging data.
     """
-    rank = comm.Get_rank()
-    size = comm.Get_size()
-    emigrants = selection(population, numMigrants)
-    toBeReplaced = emigrants      #if not replacement selector was defined, replace the emigrants
-    if not replacement is None: #Otherwise use the replacement selector
-        toBeReplaced = replacement(population, numMigrants)
-
-
-    logger.printOut(5, "MPIMigRing: toBeReplaced on rank: %d" % (rank))
-    logger.printPopulation(5, toBeReplaced)
-    
-    req = comm.isend(emigrants, dest=(rank+1)%size)  #Send and recv in a ring
-    immigrants = comm.recv(source=(rank-1)%size)
-    req.wait()
-
-    logger.printOut(5, "MPIMigRing: immigrants on rank: %d" % (rank))
-    logger.printPopulation(5, immigrants)
-    
-    for ii, deadInv in enumerate(toBeReplaced):
-        try:
-            indx = population.index(deadInv)
-        except:
-            population.append(immigrants[ii])  #Sometimes the index call fails for some reason.  If so, just append the immigrant.
-        else:
-            population[indx] = immigrants[ii]  #replace the guy we picked to leave with the new arrival
+    islandMigrator(comm, numMigrants, selection, replacement, "ring", logger=logger).migrate(population)
@@ -0,0 +1,242 @@
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Copyright (c)2016, Lawrence Livermore National Security, LLC. 
+# Produced at the Lawrence Livermore National Laboratory. 
+# Written by Jim Leek <leek2@llnl.gov>. 
+# LLNL-CODE-704100. 
+# All rights reserved.
+#
+# This file is part of SoRa.  For details, see https://github.com/llnl/SoRa.
+# Please also read SoRa/LICENSE
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Evaluation spread over MPI ranks (the "distributedEvaluation" section).
+#
+# Without it, every MPI rank is an island: it evolves its own population and
+# evaluates it by itself.  With it, the ranks are split into groups of
+# ranksPerIsland.  The first rank of each group runs the algorithm on the
+# island's population, and the rest only evaluate.  The ranks running the
+# algorithm get their own communicator for migration and the hall of fame, so
+# islands and distributed evaluation work together.
+#
+# Individuals go to the workers in batches of about equal cost (see
+# sr_parallel.balancedBatches), as compact tree encodings (see sr_encoding).
+# There are several batches per rank, handed out biggest first to whichever
+# rank finishes first, so a rank that got expensive trees doesn't hold up the
+# others.  The first rank evaluates batches itself while it waits.
+#
+# With "split" : "rows" the island's ranks split the rows of the data instead.
+# Each rank only keeps its own block of rows, and every rank evaluates all the
+# individuals on its rows.  The error functions add up (or max) the errors over
+# the ranks with allreduce (see sr_errorfuncs.shardedEngine).
+try:
+    from mpi4py import MPI
+    hasMPI = True
+except ImportError:
+    hasMPI = False
+
+import sr_encoding
+import sr_parallel
+from globalData import *
+
+#Message tags between the first rank of an island and its workers
+taskTag = 1
+resultTag = 2
+stopTag = 3
+
+
+def splitIslands(comm, ranksPerIsland):
+    """Splits the ranks into islands for distributed evaluation.
+
+    :param comm:           The communicator with all the ranks (COMM_WORLD)
+    :param ranksPerIsland: The number of ranks in each island, 0 for one island with all the ranks
+    :return (evalComm, islandComm): evalComm has the ranks of this rank's island, its rank 0
+             runs the algorithm.  islandComm has the ranks that run the algorithm, one per
+             island, for migration.  It's None on the ranks that only evaluate.
+    """
+    rank = comm.Get_rank()
+    if(ranksPerIsland <= 0):
+        ranksPerIsland = comm.Get_size()
+    evalComm = comm.Split(rank // ranksPerIsland, rank)
+    islandComm = comm.Split(0 if evalComm.Get_rank() == 0 else MPI.UNDEFINED, rank)
+    if(islandComm == MPI.COMM_NULL):
+        islandComm = None
+    return (evalComm, islandComm)
+
+
+def evaluationWorker(comm, errorObj, pset):
+    """The loop the ranks that only evaluate run.  Evaluates batches of encoded
+    trees from rank 0 of comm until it says to stop.
+
+    :param comm:     The island's evalComm from splitIslands
+    :param errorObj: The error function (toolbox.evaluate)
+    :param pset:     The primitive set
+    """
+    sr_parallel.initWorker(errorObj, pset)
+    status = MPI.Status()
+    while True:
+        task = comm.recv(source=0, tag=MPI.ANY_TAG, status=status)
+        if(status.Get_tag() == stopTag):
+            break
+        comm.send(sr_parallel.evaluateEncodedBatch(task), dest=0, tag=resultTag)
+
+
+def shardRows(comm, data):
+    """This rank's block of the rows of the data, for "split" : "rows".
+
+    :param comm: The island's evalComm from splitIslands
+    :param data: The list of data columns (from dataFilters.readDataAndApplyFilters)
+    :return: The list of columns, with just this rank's rows
+    """
+    numRows = len(data[0])
+    (rank, size) = (comm.Get_rank(), comm.Get_size())
+    start = numRows * rank // size
+    stop = numRows * (rank + 1) // size
+    return [column[start:stop] for column in data]
+
+
+def shardWorker(comm, errorObj, pset):
+    """The loop the ranks that don't run the algorithm run, with the rows split.  Every
+    batch of encoded trees rank 0 broadcasts is evaluated on this rank's rows.  The
+    errors are combined inside the error function, so there's nothing to send back.
+    """
+    sr_parallel.initWorker(errorObj, pset)
+    while True:
+        task = comm.bcast(None, root=0)
+        if(task is None):
+            break
+        sr_parallel.evaluateEncodedBatch(task)
+
+
+class shardedMap(object):
+    """The map registered as toolbox.map on the rank that runs the algorithm, with the
+    rows split.  The individuals are broadcast to the other ranks of the island as
+    encoded trees, then evaluated here on this rank's rows, while the other ranks do
+    theirs.
+    """
+
+    def __init__(self, comm, errorObj, pset, logger=None):
+        """
+        :param comm:     The island's evalComm from splitIslands
+        :param errorObj: The error function registered as toolbox.evaluate, after setRowShards
+        :param pset:     The primitive set
+        :param logger:   PrintLogger class
+        """
+        self.comm = comm
+        self.errorObj = errorObj
+        self.codec = sr_encoding.treeCodec(pset)
+        self.logger = logger
+        self.generation = 0
+        self.totalIndividuals = 0
+
+    def __call__(self, func, individuals):
+        if(not sr_parallel.isErrorFunc(func, self.errorObj)):
+            return map(func, individuals)
+        individuals = list(individuals)
+        task = (self.generation, self.errorObj.getContext(), [self.codec.encode(individual) for individual in individuals])
+        self.comm.bcast(task, root=0)
+        self.generation += 1
+        self.totalIndividuals += len(individuals)
+        return self.errorObj.evaluateBatch(individuals)
+
+    def stop(self):
+        """Tells the workers to stop.  Called once, at the end of the run."""
+        self.comm.bcast(None, root=0)
+
+    def report(self):
+        return "Row split evaluation total: %d individuals, %d rows split across %d ranks" % \
+            (self.totalIndividuals, self.errorObj.numRows(), self.comm.Get_size())
+
+
+class mpiMap(object):
+    """The map registered as toolbox.map on the rank that runs the algorithm, with
+    distributed evaluation.  Like sr_parallel.poolMap, but the batches go to the
+    other ranks of the island, and this rank evaluates batches too.
+    """
+
+    def __init__(self, comm, errorObj, pset, batchesPerRank=4, logger=None):
+        """
+        :param comm:           The island's evalComm from splitIslands
+        :param errorObj:       The error function registered as toolbox.evaluate
+        :param pset:           The primitive set
+        :param batchesPerRank: How many batches to split each generation into, per rank
+        :param logger:         PrintLogger class.  Prints how many batches each rank did
+        """
+        self.comm = comm
+        self.numRanks = comm.Get_size()
+        self.errorObj = errorObj
+        self.codec = sr_encoding.treeCodec(pset)
+        self.numBatches = self.numRanks * batchesPerRank
+        self.logger = logger
+        self.generation = 0
+        self.totalIndividuals = 0
+        self.rankBatches = [0] * self.numRanks
+
+    def __call__(self, func, individuals):
+        if(not sr_parallel.isErrorFunc(func, self.errorObj)):
+            return map(func, individuals)
+        individuals = list(individuals)
+        if(self.numRanks == 1):
+            return self.errorObj.evaluateBatch(individuals)
+        batches = sr_parallel.balancedBatches(individuals, self.numBatches)
+        #Biggest first, so the last batches to finish are small ones
+        order = sorted(xrange(len(batches)), key=lambda batchIdx: -sum(len(individuals[idx]) for idx in batches[batchIdx]))
+        context = self.errorObj.getContext()
+        results = [None] * len(batches)
+        busy = {}  #worker rank -> index of the batch it's evaluating
+        status = MPI.Status()
+        evaluator = getattr(toolbox.evalTree, "func", None)
+        counts = [0] * self.numRanks
+
+        def sendBatch(worker):
+            batchIdx = order.pop(0)
+            task = (self.generation, context, [self.codec.encode(individuals[idx]) for idx in batches[batchIdx]])
+            self.comm.send(task, dest=worker, tag=taskTag)
+            busy[worker] = batchIdx
+            counts[worker] += 1
+
+        for worker in xrange(1, self.numRanks):
+            if(order):
+                sendBatch(worker)
+        while(order or busy):
+            if(busy and (not order or self.comm.Iprobe(source=MPI.ANY_SOURCE, tag=resultTag))):
+                result = self.comm.recv(source=MPI.ANY_SOURCE, tag=resultTag, status=status)
+                worker = status.Get_source()
+                results[busy.pop(worker)] = result
+                if(order):
+                    sendBatch(worker)
+            else:
+                #Nothing back yet, evaluate the smallest batch here, so the workers aren't kept
+                #waiting long for their next one (evaluateBatch sets the attributes itself)
+                batchIdx = order.pop()
+                batch = [individuals[idx] for idx in batches[batchIdx]]
+                results[batchIdx] = (self.errorObj.evaluateBatch(batch), None, None, None)
+                counts[0] += 1
+        self.generation += 1
+
+        fitnesses = [None] * len(individuals)
+        for (batch, (batchFitnesses, attributes, stats, errorStats)) in zip(batches, results):
+            for (idx, fitness) in zip(batch, batchFitnesses):
+                fitnesses[idx] = fitness
+            if(attributes is not None):
+                for (idx, attribute) in zip(batch, attributes):
+                    self.errorObj.setAttributes(individuals[idx], attribute)
+            if(stats is not None and hasattr(evaluator, "mergeStats")):
+                evaluator.mergeStats(stats)
+            if(errorStats is not None):
+                self.errorObj.mergeStats(errorStats)
+
+        self.totalIndividuals += len(individuals)
+        for (rank, count) in enumerate(counts):
+            self.rankBatches[rank] += count
+        if(self.logger):
+            self.logger.printOut(4, "Distributed evaluation: %d individuals, batches per rank %s" %
+                                 (len(individuals), " ".join(str(count) for count in counts)))
+        return fitnesses
+
+    def stop(self):
+        """Tells the workers to stop.  Called once, at the end of the run."""
+        for worker in xrange(1, self.numRanks):
+            self.comm.send(None, dest=worker, tag=stopTag)
+
+    def report(self):
+        return "Distributed evaluation total: %d individuals on %d ranks, batches per rank %s" % \
+            (self.totalIndividuals, self.numRanks, " ".join(str(count) for count in self.rankBatches))
@@ -20,7 +20,7 @@ from deap import gp
 import sr_factories
 
 from globalData import *
-import sr_factories
+import sr_cache
 
 #Chooses amoung a set of mutators to provide ONE mutation.  So mutation probabilities must add to <= 1.
 #The configuration should be of the form:
@@ -67,3 +67,37 @@ class multiMutOr:
                 new_ind = mutator(individual, **kwargs)
                 return new_ind
         return individual
+
+
+#recordMutation wraps a mutator so the child remembers where it came from.  After the
+#mutation, the child gets a "mutation" attribute:
+#  (parent treeKey, start, parentEnd, childEnd, child treeKey)
+#Nodes [start, parentEnd) of the parent were replaced by nodes [start, childEnd) of the
+#child, everything else is the same.  sr_evaluators.incrementalEvaluator uses this to
+#only recompute the changed part of the child.
+#The region is found by comparing the trees, so it works for any mutator (including
+#multiMutOr).  The child treeKey is there because the record gets copied along with
+#the individual, and later changes (like crossover) would make it wrong.
+class recordMutation:
+
+    def __init__(self, mutator):
+        self.mutator = mutator
+        setattr(self, "__name__", getattr(mutator, "__name__", "recordMutation"))
+
+    def __call__(self, individual, **kwargs):
+        parentKey = sr_cache.treeKey(individual)
+        parentNodes = list(individual)
+        result = self.mutator(individual, **kwargs)
+        child = result[0]
+
+        #Mutators change the tree in place, so unchanged nodes are the very same objects
+        maxCommon = min(len(parentNodes), len(child))
+        start = 0
+        while(start < maxCommon and parentNodes[start] is child[start]):
+            start += 1
+        common = 0
+        while(common < maxCommon - start and parentNodes[-1 - common] is child[-1 - common]):
+            common += 1
+        child.mutation = (parentKey, start, len(parentNodes) - common, len(child) - common,
+                          sr_cache.treeKey(child))
+        return result
@@ -0,0 +1,151 @@
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Copyright (c)2016, Lawrence Livermore National Security, LLC. 
+# Produced at the Lawrence Livermore National Laboratory. 
+# Written by Jim Leek <leek2@llnl.gov>. 
+# LLNL-CODE-704100. 
+# All rights reserved.
+#
+# This file is part of SoRa.  For details, see https://github.com/llnl/SoRa.
+# Please also read SoRa/LICENSE
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Parallel evaluation with a multiprocessing pool (the -t option).
+#
+# Registering pool.map as toolbox.map pickles the error function, including
+# its copies of the data, along with every chunk of individuals sent to the
+# workers.  Instead the pool here is started with an initializer that hands
+# each worker the error function and primitive set once.  The workers are
+# forked, so the data arrays are inherited rather than pickled, and are
+# shared copy-on-write with the main process.  After that only compact tree
+# encodings (see sr_encoding) cross the process boundary.
+#
+# Evaluation goes through the error function's evaluateBatch, both here and
+# when running serially (batchMap).
+import multiprocessing
+import heapq
+
+import sr_encoding
+from globalData import *
+
+#The state each worker process gets from initWorker
+workerState = {}
+
+
+def initWorker(errorObj, pset):
+    """Pool initializer.  Runs once in each worker process."""
+    workerState["errorObj"] = errorObj
+    workerState["pset"] = pset
+    workerState["codec"] = sr_encoding.treeCodec(pset)
+    workerState["generation"] = None
+
+
+def evaluateEncodedBatch(task):
+    """Evaluates a batch of encoded trees in a worker process.
+
+    :param task: (generation, error function context, list of encoded trees)
+    :return: (list of fitness tuples, list of attributes the evaluation set on each
+              individual (see errorFunc.getAttributes) or None, evaluator statistics or None,
+              error function statistics)
+    """
+    (generation, context, encodedList) = task
+    evaluator = getattr(toolbox.evalTree, "func", None)
+    if(generation != workerState["generation"]):
+        #Let evaluators with per generation state (the subtree cache) know
+        if(hasattr(evaluator, "newGeneration")):
+            evaluator.newGeneration()
+        workerState["generation"] = generation
+    errorObj = workerState["errorObj"]
+    errorObj.setContext(context)
+    individuals = [workerState["codec"].decode(encoded) for encoded in encodedList]
+    fitnesses = errorObj.evaluateBatch(individuals)
+    attributes = [errorObj.getAttributes(individual) for individual in individuals]
+    if(all(attribute is None for attribute in attributes)):
+        attributes = None
+    stats = None
+    if(hasattr(evaluator, "takeStats")):
+        stats = evaluator.takeStats()
+    return (fitnesses, attributes, stats, errorObj.takeStats())
+
+
+def evaluationPool(numProcesses, errorObj, pset):
+    """Starts the worker processes.  Everything the workers need is handed
+    over here, so this must be called after toolbox.evalTree is registered.
+    """
+    return multiprocessing.Pool(processes=numProcesses, initializer=initWorker,
+                                initargs=(errorObj, pset))
+
+
+def balancedBatches(individuals, numBatches):
+    """Splits the individuals into batches of about equal evaluation cost.
+    Cost is taken to be the number of nodes, since each node is (about) one
+    pass over the data.  Biggest first, each individual goes in the cheapest
+    batch so far.
+
+    :return: A list of lists of indexes into individuals
+    """
+    numBatches = max(1, min(numBatches, len(individuals)))
+    batches = [[] for ii in xrange(numBatches)]
+    loads = [(0, ii) for ii in xrange(numBatches)]
+    order = sorted(xrange(len(individuals)), key=lambda idx: len(individuals[idx]), reverse=True)
+    for idx in order:
+        (load, batchIdx) = heapq.heappop(loads)
+        batches[batchIdx].append(idx)
+        heapq.heappush(loads, (load + len(individuals[idx]), batchIdx))
+    return [batch for batch in batches if batch]
+
+
+def isErrorFunc(func, errorObj):
+    return getattr(func, "func", func) is errorObj  #toolbox.evaluate is a partial
+
+
+class batchMap(object):
+    """The map registered as toolbox.map when running serially.
+    Evaluations of the error function go through its evaluateBatch.
+    """
+
+    def __init__(self, errorObj):
+        self.errorObj = errorObj
+
+    def __call__(self, func, individuals):
+        if(not isErrorFunc(func, self.errorObj)):
+            return map(func, individuals)
+        return self.errorObj.evaluateBatch(list(individuals))
+
+
+class poolMap(object):
+    """The map registered as toolbox.map when running with -t.
+    Evaluations of the error function are split into batches of about equal
+    cost, a few per worker so a slow batch doesn't hold everything up, and
+    sent to the workers as encoded trees.  The workers evaluate each batch with
+    evaluateBatch.  Anything else is just passed to pool.map.
+    """
+
+    def __init__(self, pool, numProcesses, errorObj, pset, batchesPerProcess=4):
+        self.pool = pool
+        self.numBatches = numProcesses * batchesPerProcess
+        self.errorObj = errorObj
+        self.codec = sr_encoding.treeCodec(pset)
+        self.generation = 0
+
+    def __call__(self, func, individuals):
+        if(not isErrorFunc(func, self.errorObj)):
+            return self.pool.map(func, individuals)
+        individuals = list(individuals)
+        batches = balancedBatches(individuals, self.numBatches)
+        context = self.errorObj.getContext()
+        tasks = [(self.generation, context, [self.codec.encode(individuals[idx]) for idx in batch])
+                 for batch in batches]
+        self.generation += 1
+        results = self.pool.map(evaluateEncodedBatch, tasks, chunksize=1)
+
+        fitnesses = [None] * len(individuals)
+        evaluator = getattr(toolbox.evalTree, "func", None)
+        for (batch, (batchFitnesses, attributes, stats, errorStats)) in zip(batches, results):
+            for (idx, fitness) in zip(batch, batchFitnesses):
+                fitnesses[idx] = fitness
+            if(attributes is not None):
+                for (idx, attribute) in zip(batch, attributes):
+                    self.errorObj.setAttributes(individuals[idx], attribute)
+            if(stats is not None and hasattr(evaluator, "mergeStats")):
+                evaluator.mergeStats(stats)
+            self.errorObj.mergeStats(errorStats)
+        return fitnesses
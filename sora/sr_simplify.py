@@ -0,0 +1,263 @@
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Copyright (c)2016, Lawrence Livermore National Security, LLC. 
+# Produced at the Lawrence Livermore National Laboratory. 
+# Written by Jim Leek <leek2@llnl.gov>. 
+# LLNL-CODE-704100. 
+# All rights reserved.
+#
+# This file is part of SoRa.  For details, see https://github.com/llnl/SoRa.
+# Please also read SoRa/LICENSE
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Algebraic simplification of trees, without sympy.  Random trees are full of
+# things like add(1, 3), neg(neg(x)) and mul(x, 1) that get evaluated over the
+# whole data set every time the tree is evaluated.  The simplifier:
+#  - folds constant subtrees into a single constant terminal
+#  - applies identity rules (neg(neg(x)) -> x, mul(x, 1) -> x, sub(x, x) -> 0, ...)
+#  - puts the operands of add and mul in a canonical order, so trees that only
+#    differ by the order of the operands get the same fitness cache key
+#
+# Simplified trees evaluate to the same values as the originals.  Constants are
+# folded with the primitive set's own functions, so they come out exactly as
+# evaluation would compute them (integer constants keep doing integer math).
+# The rules that aren't exact for every value of x (sub(x, x) -> 0 for inf and
+# NaN, add(x, 0) -> x for -0, etc.) are only used after checking x on the data.
+#
+# Folded constants are ephemerals, of the class of the constant they were folded
+# from (or the primitive set's first ephemeral class), so mutEphemeral can still
+# change them like the constants the tree started with.
+import numpy
+from deap import gp
+
+import sr_encoding
+
+
+class simplifier(object):
+    """Simplifies trees for one primitive set.
+    """
+
+    def __init__(self, pset, inVarNames=[], inVarValues=[]):
+        """
+        :param pset:        The primitive set the trees are made from
+        :param inVarNames:  The names of the input variables (config["inVars"])
+        :param inVarValues: The input variable arrays.  Without them the rules that
+                            have to check x on the data (sub(x, x) -> 0) are skipped.
+        """
+        self.pset = pset
+        self.inVars = dict(zip(inVarNames, inVarValues))
+        self.functions = {}
+        self.primitives = {}
+        for primitives in pset.primitives.itervalues():
+            for primitive in primitives:
+                self.functions[primitive.name] = pset.context[primitive.name]
+                self.primitives[primitive.name] = primitive
+        #The class for constants that weren't folded from an ephemeral, None if there are no ephemerals
+        self.ephemeralClass = None
+        for terminal in pset.terminals[pset.ret]:
+            if isinstance(terminal, type) and issubclass(terminal, gp.Ephemeral):
+                self.ephemeralClass = terminal
+                break
+
+    def constant(self, value, args=[]):
+        """Makes a constant terminal.  numpy scalars are turned back into python
+        ints and floats so the tree prints and compiles the same as the original constants.
+
+        :param args: The expressions the constant replaces.  It's an ephemeral of the
+                     same class as the first of them that is one.
+        """
+        if sr_encoding.isIntegerConstant(value):
+            value = int(value)
+        else:
+            value = float(value)
+        ephemeralClass = self.ephemeralClass
+        for arg in args:
+            if isinstance(arg[0][0], gp.Ephemeral):
+                ephemeralClass = type(arg[0][0])
+                break
+        if(ephemeralClass is None):
+            node = gp.Terminal(value, False, self.pset.ret)
+        else:
+            node = ephemeralClass.__new__(ephemeralClass)  #Don't draw a new random value
+            gp.Terminal.__init__(node, value, False, self.pset.ret)
+        return self.expression([node], [], value)
+
+    def expression(self, nodes, args, value=None):
+        """A simplified subtree: its nodes in prefix order, the expressions of its
+        arguments, its value if it is constant, and a key that is the same for
+        subtrees that compute exactly the same thing."""
+        if(value is not None):
+            key = repr(value)
+        elif isinstance(nodes[0], gp.Primitive):
+            key = "%s(%s)" % (nodes[0].name, ",".join(arg[3] for arg in args))
+        else:
+            key = nodes[0].value
+        return (nodes, args, value, key)
+
+    def primitive(self, name, args):
+        """Makes a primitive expression from simplified arguments."""
+        nodes = [self.primitives[name]]
+        for arg in args:
+            nodes.extend(arg[0])
+        return self.expression(nodes, args)
+
+    def values(self, expr):
+        """Evaluates expr on the data.
+        :return: The values, or None if there's no data to check on"""
+        if(len(self.inVars) == 0):
+            return None
+        stack = []
+        for node in reversed(expr[0]):
+            if isinstance(node, gp.Primitive):
+                args = [stack.pop() for ii in xrange(node.arity)]
+                stack.append(self.functions[node.name](*args))
+            elif isinstance(node.value, basestring):
+                stack.append(self.inVars[node.value])
+            else:
+                stack.append(node.value)
+        return stack[0]
+
+    def holds(self, expr, test):
+        """True if test(values) is True for the values of expr on the data.  Used
+        for the rules that are only exact for some values."""
+        try:
+            values = self.values(expr)
+        except (ArithmeticError, ValueError):
+            return False
+        if(values is None):
+            return False
+        return bool(test(values))
+
+    def fold(self, name, args):
+        """Evaluates a primitive on constant arguments, the same way evaluation would.
+        :return: The constant expression, or None if the result isn't finite (the tree is bad anyway)"""
+        try:
+            value = self.functions[name](*[arg[2] for arg in args])
+        except (ArithmeticError, ValueError):
+            return None
+        if(not numpy.isfinite(value)):
+            return None
+        return self.constant(value, args)
+
+    def applyRules(self, name, args):
+        """Simplifies one primitive applied to already simplified arguments.
+        :return: The simplified expression"""
+        if(all(arg[2] is not None for arg in args)):
+            folded = self.fold(name, args)
+            if(folded is not None):
+                return folded
+            return self.primitive(name, args)
+
+        values = [arg[2] for arg in args]
+        if(name == "neg" and isinstance(args[0][0][0], gp.Primitive) and args[0][0][0].name == "neg"):
+            return args[0][1][0]
+        if(name == "add" or name == "mul"):
+            if(name == "add" and 0 in values):
+                #x + 0 is x, except -0 + 0 is +0
+                other = args[1] if values[0] == 0 else args[0]
+                if(self.holds(other, lambda x: not numpy.any((x == 0) & numpy.signbit(x)))):
+                    return other
+            if(name == "mul" and 1 in values):
+                return args[1] if values[0] == 1 else args[0]
+            if(name == "mul" and 0 in values):
+                #x * 0 is NaN for inf and NaN, and flips the zero's sign for negative x.
+                #For the other x it's the zero, -0 included.
+                (zero, other) = (values[0], args[1]) if values[0] == 0 else (values[1], args[0])
+                if(self.holds(other, lambda x: numpy.all(numpy.isfinite(x) & ~numpy.signbit(x)))):
+                    return self.constant(numpy.copysign(0.0, zero), args)
+            #add and mul are exactly commutative in floating point, so any order
+            #of the operands gives the same values.  Use the order of the keys.
+            args = sorted(args, key=lambda arg: arg[3])
+        elif(name == "sub"):
+            #x - 0 is x, but x - -0 is x + 0, so -0 - -0 is +0
+            if(values[1] == 0 and (not numpy.signbit(values[1]) or
+                                   self.holds(args[0], lambda x: not numpy.any((x == 0) & numpy.signbit(x))))):
+                return args[0]
+            if(args[0][3] == args[1][3] and self.holds(args[0], lambda x: numpy.all(numpy.isfinite(x)))):
+                return self.constant(0.0, args)
+        elif(name == "div"):
+            if(values[1] == 1):
+                return args[0]
+            if(args[0][3] == args[1][3] and self.holds(args[0], lambda x: numpy.all(numpy.isfinite(x) & (x != 0)))):
+                return self.constant(1.0, args)
+        return self.primitive(name, args)
+
+    def simplifiedNodes(self, individual):
+        """Returns the nodes of the simplified tree, in prefix order."""
+        stack = []
+        with numpy.errstate(all='ignore'):
+            for node in reversed(individual):
+                if isinstance(node, gp.Primitive):
+                    args = [stack.pop() for ii in xrange(node.arity)]
+                    stack.append(self.applyRules(node.name, args))
+                elif isinstance(node.value, basestring):  #Arguments (inVars) have their name as value
+                    stack.append(self.expression([node], []))
+                else:
+                    stack.append(self.expression([node], [], node.value))
+        return stack[0][0]
+
+    def simplify(self, individual):
+        """Simplifies the tree in place.
+        :return: The individual"""
+        nodes = self.simplifiedNodes(individual)
+        if(len(nodes) != len(individual) or any(a is not b for (a, b) in zip(nodes, individual))):
+            individual[:] = nodes
+        return individual
+
+    def decorator(self, func):
+        """For toolbox.decorate, simplifies the children of mate and mutate."""
+        def wrapper(*args, **kwargs):
+            children = func(*args, **kwargs)
+            for child in children:
+                self.simplify(child)
+            return children
+        return wrapper
+
+
+class simplifyMap(object):
+    """simplifyMap sits in front of the map used for evaluation (toolbox.map).
+    Every individual is simplified in place before it is evaluated, so the
+    population keeps the smaller trees too.
+    """
+
+    def __init__(self, simplifyTree, errorObj, innerMap, logger=None):
+        """
+        :param simplifyTree: Simplifies a tree in place (simplifier.simplify)
+        :param errorObj:     The error function registered as toolbox.evaluate
+        :param innerMap:     The map function to actually evaluate with
+        :param logger:       PrintLogger class.  Prints the average tree sizes each generation
+        """
+        self.simplifyTree = simplifyTree
+        self.errorObj = errorObj
+        self.innerMap = innerMap
+        self.logger = logger
+        self.generation = 0
+        self.totalTrees = 0
+        self.totalBefore = 0
+        self.totalAfter = 0
+
+    def __call__(self, func, individuals):
+        if(getattr(func, "func", func) is not self.errorObj):  #toolbox.evaluate is a partial
+            return self.innerMap(func, individuals)
+        individuals = list(individuals)
+        if(len(individuals) == 0):
+            return []
+        before = sum(len(individual) for individual in individuals)
+        for individual in individuals:
+            self.simplifyTree(individual)
+        after = sum(len(individual) for individual in individuals)
+
+        self.totalTrees += len(individuals)
+        self.totalBefore += before
+        self.totalAfter += after
+        if(self.logger):
+            self.logger.printOut(3, "Simplify generation %d: average size %.1f -> %.1f" %
+                                 (self.generation, float(before) / len(individuals),
+                                  float(after) / len(individuals)))
+        self.generation += 1
+        return self.innerMap(func, individuals)
+
+    def report(self):
+        if(self.totalTrees == 0):
+            return "Simplify total: no trees simplified"
+        return "Simplify total: %d trees, average size %.1f -> %.1f" % \
+            (self.totalTrees, float(self.totalBefore) / self.totalTrees,
+             float(self.totalAfter) / self.totalTrees)
@@ -0,0 +1,86 @@
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Copyright (c)2016, Lawrence Livermore National Security, LLC. 
+# Produced at the Lawrence Livermore National Laboratory. 
+# Written by Jim Leek <leek2@llnl.gov>. 
+# LLNL-CODE-704100. 
+# All rights reserved.
+#
+# This file is part of SoRa.  For details, see https://github.com/llnl/SoRa.
+# Please also read SoRa/LICENSE
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Asynchronous star migration on 3 ranks, run by test_sr_migration with
+#   mpirun -n 3 python tests/mpi_migration.py
+# Rank 2 has the best individual.  Rank 0 has to forward it to rank 1, even though
+# it hasn't put it in its own population yet, and every rank has to get through
+# finish (the Ibarrier) with nothing left over.
+# Each rank prints "rank N ok" if everything it checked was right.
+import os
+import sys
+import time
+import traceback
+
+from mpi4py import MPI
+from deap import base
+from deap import creator
+from deap import tools
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sora"))
+import sr_migration
+
+creator.create("MigrationFitness", base.Fitness, weights=(-1.0,))
+creator.create("MigrationIndividual", list, fitness=creator.MigrationFitness)
+
+
+class quietLogger(object):
+    def printOut(self, level, text):
+        pass
+
+    def printPopulation(self, level, population):
+        pass
+
+
+def waitFor(migrator, numMessages):
+    """Polls until numMessages asynchronous messages have arrived, or gives up after 30 seconds."""
+    start = time.time()
+    while(len(migrator.arrived) < numMessages and time.time() - start < 30):
+        migrator.poll()
+        time.sleep(0.001)
+
+
+def main():
+    comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+    population = []
+    for value in range(5):
+        individual = creator.MigrationIndividual([rank, value])
+        individual.fitness.values = (10.0 * (3 - rank) + value,)  #Rank 2's [2, 0] is the best, at 10
+        population.append(individual)
+    migrator = sr_migration.islandMigrator(comm, 1, tools.selBest, tools.selWorst, "star",
+                                           asynchronous=True, maxAge=2, logger=quietLogger())
+    failures = []
+    if(rank == 0):
+        migrator.migrate(population)  #Only its own best, nothing has arrived yet
+        #The islands' emigrants arrive after the stop, they aren't in the population yet
+        waitFor(migrator, 2)
+        migrator.migrate(population)
+        migrator.integrate(population)
+    else:
+        migrator.migrate(population)
+        waitFor(migrator, 2)
+        migrator.integrate(population)
+        if(rank == 1 and [2, 0] not in population):
+            failures.append("rank 1 didn't get rank 2's best from rank 0: %s" % population)
+    migrator.finish()
+    if(migrator.pendingSends or migrator.arrived):
+        failures.append("messages left over after finish")
+    sys.stdout.write("rank %d %s\n" % (rank, "; ".join(failures) or "ok"))  #One write, so ranks' lines don't mix
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception:
+        traceback.print_exc()
+        sys.stdout.flush()
+        MPI.COMM_WORLD.Abort(1)  #Otherwise the other ranks wait in finish forever
@@ -0,0 +1,93 @@
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Copyright (c)2016, Lawrence Livermore National Security, LLC. 
+# Produced at the Lawrence Livermore National Laboratory. 
+# Written by Jim Leek <leek2@llnl.gov>. 
+# LLNL-CODE-704100. 
+# All rights reserved.
+#
+# This file is part of SoRa.  For details, see https://github.com/llnl/SoRa.
+# Please also read SoRa/LICENSE
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Tests of the fitness cache keys, LRU eviction and hit counting.  Run with
+#   python -m unittest discover tests
+import os
+import sys
+import unittest
+
+from deap import gp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sora"))
+import sr_cache
+import sr_factories
+
+
+class countingMap(object):
+    """A map that remembers how many individuals it was asked to evaluate."""
+
+    def __init__(self):
+        self.evaluated = 0
+
+    def __call__(self, func, individuals):
+        individuals = list(individuals)
+        self.evaluated += len(individuals)
+        return map(func, individuals)
+
+
+def treeLength(individual):
+    return (float(len(individual)),)
+
+
+class treeKeyTest(unittest.TestCase):
+
+    def setUp(self):
+        config = { "inVars" : ["x", "y"], "constants" : [],
+                   "primitives" : ["add", "mul", "reciprocal"] }
+        self.pset = sr_factories.psetFactory(config)
+
+    def key(self, text):
+        return sr_cache.treeKey(gp.PrimitiveTree.from_string(text, self.pset))
+
+    def test_sameTreeSameKey(self):
+        self.assertEqual(self.key("add(x, mul(y, 2.5))"), self.key("add(x, mul(y, 2.5))"))
+
+    def test_differentTreesDifferentKeys(self):
+        self.assertNotEqual(self.key("add(x, y)"), self.key("add(y, x)"))
+        self.assertNotEqual(self.key("add(x, 0.1)"), self.key("add(x, 0.1000000000000001)"))
+
+    def test_intAndFloatConstantsDontCollide(self):
+        self.assertNotEqual(self.key("add(x, reciprocal(3))"), self.key("add(x, reciprocal(3.0))"))
+
+
+class cachedMapTest(unittest.TestCase):
+
+    def setUp(self):
+        config = { "inVars" : ["x"], "constants" : [], "primitives" : ["add", "mul"] }
+        self.pset = sr_factories.psetFactory(config)
+        self.innerMap = countingMap()
+
+    def trees(self, *texts):
+        return [gp.PrimitiveTree.from_string(text, self.pset) for text in texts]
+
+    def test_hitsAndMisses(self):
+        cached = sr_cache.cachedMap(sr_cache.fitnessCache(10), self.innerMap)
+        fitnesses = cached(treeLength, self.trees("add(x, x)", "mul(x, x)", "add(x, x)"))
+        self.assertEqual(fitnesses, [(3.0,)] * 3)
+        self.assertEqual(self.innerMap.evaluated, 2)  #The repeat in the batch is only evaluated once
+        cached(treeLength, self.trees("mul(x, x)", "add(x, mul(x, x))"))
+        self.assertEqual(self.innerMap.evaluated, 3)
+        self.assertEqual((cached.totalHits, cached.totalMisses), (2, 3))
+
+    def test_leastRecentlyUsedIsEvicted(self):
+        cache = sr_cache.fitnessCache(2)
+        cache.store("a", 1)
+        cache.store("b", 2)
+        self.assertEqual(cache.lookup("a"), 1)  #Now b is the least recently used
+        cache.store("c", 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.lookup("b"), None)
+        self.assertEqual(cache.lookup("a"), 1)
+        self.assertEqual(cache.lookup("c"), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
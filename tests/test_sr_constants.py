@@ -0,0 +1,83 @@
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Copyright (c)2016, Lawrence Livermore National Security, LLC. 
+# Produced at the Lawrence Livermore National Laboratory. 
+# Written by Jim Leek <leek2@llnl.gov>. 
+# LLNL-CODE-704100. 
+# All rights reserved.
+#
+# This file is part of SoRa.  For details, see https://github.com/llnl/SoRa.
+# Please also read SoRa/LICENSE
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Tests that constant optimization fits the float constants and leaves the
+# integer ones alone.  Run with
+#   python -m unittest discover tests
+import os
+import sys
+import unittest
+
+import numpy
+from deap import gp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sora"))
+import sr_constants
+import sr_errorfuncs
+import sr_evaluators
+import sr_factories
+from globalData import toolbox
+
+
+class treeFitterTest(unittest.TestCase):
+
+    def setUp(self):
+        config = { "inVars" : ["x"], "targetVar" : "y", "constants" : [],
+                   "primitives" : ["add", "mul", "reciprocal"] }
+        self.pset = sr_factories.psetFactory(config)
+        toolbox.register("evalTree", sr_evaluators.stackEvaluator(self.pset))
+        x = numpy.linspace(1.0, 2.0, 21)
+        errorObj = sr_errorfuncs.totalAbsErrorSquared(["x", "y"], [x, 2.0 * x + 1.5], config)
+        self.fitter = sr_constants.treeFitter(errorObj, self.pset, 20)
+
+    def test_integerConstantsArentFitted(self):
+        tree = gp.PrimitiveTree.from_string("add(mul(x, 2), 0.0)", self.pset)
+        self.assertEqual(sr_constants.constantIndexes(tree), [4])
+        (fitted,) = self.fitter.optimize([tree])
+        self.assertEqual(fitted[3].value, 2)
+        self.assertTrue(isinstance(fitted[3].value, int))
+        self.assertAlmostEqual(fitted[4].value, 1.5, places=6)
+
+    def test_integerMathIsKept(self):
+        #reciprocal(3) is 0, so only the 0.5 can be fitted, to the mean of 2x + 1.5
+        tree = gp.PrimitiveTree.from_string("add(mul(x, reciprocal(3)), 0.5)", self.pset)
+        (fitted,) = self.fitter.optimize([tree])
+        self.assertEqual(sr_constants.constantIndexes(tree), [5])
+        self.assertEqual(fitted[4].value, 3)
+        self.assertTrue(isinstance(fitted[4].value, int))
+        self.assertAlmostEqual(fitted[5].value, 4.5, places=6)
+
+
+class scaledFitTest(unittest.TestCase):
+
+    def setUp(self):
+        config = { "inVars" : ["x"], "targetVar" : "y", "constants" : [], "linearScaling" : {},
+                   "primitives" : ["add", "mul", "reciprocal"] }
+        self.pset = sr_factories.psetFactory(config)
+        toolbox.register("evalTree", sr_evaluators.stackEvaluator(self.pset))
+        x = numpy.linspace(1.0, 2.0, 21)
+        errorObj = sr_errorfuncs.totalAbsErrorSquared(["x", "y"], [x, 3.0 * x * x + 1.5], config)
+        self.fitter = sr_constants.treeFitter(errorObj, self.pset, 20)
+
+    def test_offsetIsLeftAlone(self):
+        #Linear scaling fits the offset, so the residuals don't depend on the 7.0
+        tree = gp.PrimitiveTree.from_string("add(mul(x, x), add(mul(x, 0.3), 7.0))", self.pset)
+        (fitted,) = self.fitter.optimize([tree])
+        self.assertEqual(fitted[8].value, 7.0)
+        self.assertAlmostEqual(fitted[7].value, 0.0, places=6)
+
+    def test_cancellingOffsetsAreLeftAlone(self):
+        #a and b undo every constant here, so there's nothing to fit
+        tree = gp.PrimitiveTree.from_string("add(4669462.37, mul(1.16, add(-4015362.39, mul(x, x))))", self.pset)
+        self.assertEqual(self.fitter.optimize([tree]), [None])
+
+
+if __name__ == "__main__":
+    unittest.main()
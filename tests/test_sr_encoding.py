@@ -0,0 +1,108 @@
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Copyright (c)2016, Lawrence Livermore National Security, LLC. 
+# Produced at the Lawrence Livermore National Laboratory. 
+# Written by Jim Leek <leek2@llnl.gov>. 
+# LLNL-CODE-704100. 
+# All rights reserved.
+#
+# This file is part of SoRa.  For details, see https://github.com/llnl/SoRa.
+# Please also read SoRa/LICENSE
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Tests that trees and individuals come back from their compact encodings the
+# same, integer constants included.  Run with
+#   python -m unittest discover tests
+import cPickle
+import os
+import sys
+import unittest
+
+import numpy
+from deap import base
+from deap import creator
+from deap import gp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sora"))
+import sr_encoding
+import sr_factories
+import sr_migration
+
+creator.create("EncodingFitness", base.Fitness, weights=(-1.0,))
+creator.create("EncodingIndividual", gp.PrimitiveTree, fitness=creator.EncodingFitness)
+
+
+class codecTest(unittest.TestCase):
+
+    def setUp(self):
+        config = { "inVars" : ["x", "y"], "constants" : [{ "type" : "randint", "min" : 1, "max" : 5 }],
+                   "primitives" : ["add", "mul", "reciprocal"] }
+        self.pset = sr_factories.psetFactory(config)
+        self.codec = sr_encoding.treeCodec(self.pset)
+        self.populationCodec = sr_encoding.populationCodec(self.pset, creator.EncodingIndividual)
+
+    def tree(self, text, treeClass=gp.PrimitiveTree):
+        """The tree, with its integer constants made randint ephemerals."""
+        tree = treeClass(gp.PrimitiveTree.from_string(text, self.pset))
+        ephemeralClass = [terminal for terminal in self.pset.terminals[self.pset.ret]
+                          if isinstance(terminal, type) and issubclass(terminal, gp.Ephemeral)][0]
+        for (idx, node) in enumerate(tree):
+            if(not isinstance(node, gp.Primitive) and isinstance(node.value, int)):
+                tree[idx] = ephemeralClass.__new__(ephemeralClass)
+                gp.Terminal.__init__(tree[idx], node.value, False, self.pset.ret)
+        return tree
+
+    def assertSameTree(self, decoded, tree):
+        self.assertEqual(str(decoded), str(tree))
+        for (a, b) in zip(decoded, tree):
+            self.assertTrue(type(a) is type(b))
+            if(not isinstance(a, gp.Primitive)):
+                self.assertTrue(type(a.value) is type(b.value))
+
+    def test_treeRoundTrip(self):
+        #3 is a randint ephemeral, 3.0 a folded float constant and 2 a folded integer one
+        tree = self.tree("add(mul(x, reciprocal(3)), mul(y, 3.0))")
+        tree.append(gp.Terminal(2, False, self.pset.ret))
+        tree.insert(0, self.pset.mapping["add"])
+        decoded = self.codec.decode(self.codec.encode(tree))
+        self.assertSameTree(decoded, tree)
+        self.assertEqual(decoded[5].value, 3)
+
+    def test_numpyIntegerStaysInteger(self):
+        tree = self.tree("add(x, 1.5)")
+        tree[2] = gp.Terminal(numpy.int64(4), False, self.pset.ret)
+        decoded = self.codec.decode(self.codec.encode(tree))
+        self.assertEqual(decoded[2].value, 4)
+        self.assertTrue(isinstance(decoded[2].value, int))
+
+    def test_populationRoundTrip(self):
+        individuals = [self.tree(text, creator.EncodingIndividual)
+                       for text in ["add(x, reciprocal(3))", "mul(y, 0.25)", "x"]]
+        individuals[0].fitness.values = (1.5,)
+        individuals[1].fitness.values = (0.125,)
+        decoded = self.populationCodec.decode(self.populationCodec.encode(individuals))
+        self.assertEqual(len(decoded), 3)
+        for (a, b) in zip(decoded, individuals):
+            self.assertTrue(isinstance(a, creator.EncodingIndividual))
+            self.assertSameTree(a, b)
+        self.assertEqual(decoded[0].fitness.values, (1.5,))
+        self.assertEqual(decoded[1].fitness.values, (0.125,))
+        self.assertFalse(decoded[2].fitness.valid)
+
+    def test_secondPsetSharesTheEphemeral(self):
+        #Trees from one pset have to decode against the other, as on another MPI rank
+        pset = sr_factories.psetFactory({ "inVars" : ["x", "y"], "primitives" : ["add", "mul", "reciprocal"],
+                                          "constants" : [{ "type" : "randint", "min" : 1, "max" : 5 }] })
+        tree = self.tree("add(x, reciprocal(3))")
+        self.assertSameTree(sr_encoding.treeCodec(pset).decode(self.codec.encode(tree)), tree)
+
+    def test_migrationBytesCounted(self):
+        individuals = [self.tree("add(mul(x, y), reciprocal(%d))" % value, creator.EncodingIndividual)
+                       for value in range(1, 6)]
+        migrator = sr_migration.islandMigrator(None, 5, None, codec=self.populationCodec)
+        message = migrator.pack(individuals, 2)
+        self.assertEqual(migrator.bytesSent, 2 * len(cPickle.dumps(message, cPickle.HIGHEST_PROTOCOL)))
+        self.assertEqual(migrator.bytesPickled, 2 * len(cPickle.dumps(individuals, cPickle.HIGHEST_PROTOCOL)))
+        self.assertTrue(migrator.bytesSent < migrator.bytesPickled)
+
+
+if __name__ == "__main__":
+    unittest.main()
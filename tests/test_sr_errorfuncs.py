@@ -0,0 +1,128 @@
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Copyright (c)2016, Lawrence Livermore National Security, LLC. 
+# Produced at the Lawrence Livermore National Laboratory. 
+# Written by Jim Leek <leek2@llnl.gov>. 
+# LLNL-CODE-704100. 
+# All rights reserved.
+#
+# This file is part of SoRa.  For details, see https://github.com/llnl/SoRa.
+# Please also read SoRa/LICENSE
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Tests of racing: the cutoff, aborting hopeless individuals, and keeping their
+# estimated fitnesses out of the fitness cache.  And of scoring individuals between
+# mini-batch generations on the generation's sample, and the pareto wrapper's
+# fitness lengths.  Run with
+#   python -m unittest discover tests
+import os
+import random
+import sys
+import unittest
+
+import numpy
+from deap import gp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sora"))
+import sr_cache
+import sr_errorfuncs
+import sr_evaluators
+import sr_factories
+import sr_parallel
+from globalData import toolbox
+
+
+class racingTest(unittest.TestCase):
+
+    def setUp(self):
+        config = { "inVars" : ["x"], "targetVar" : "y", "constants" : [],
+                   "primitives" : ["add", "mul"], "racing" : { "chunkSize" : 4 } }
+        self.pset = sr_factories.psetFactory(config)
+        toolbox.register("evalTree", sr_evaluators.stackEvaluator(self.pset))
+        x = numpy.linspace(0.0, 1.0, 16)
+        self.errorObj = sr_errorfuncs.totalAbsErrorSquared(["x", "y"], [x, x.copy()], config)
+        self.raceConfig = { "cutoff" : "population", "quantile" : 0.5, "scale" : 1.0 }
+        #Errors 0, sum(x * x) and 16, so the next cutoff is sum(x * x)
+        self.generation = ["x", "add(x, x)", "add(x, 1.0)"]
+        self.cutoff = numpy.sum(x * x)
+
+    def trees(self, *texts):
+        return [gp.PrimitiveTree.from_string(text, self.pset) for text in texts]
+
+    def racer(self, innerMap):
+        return sr_errorfuncs.racingMap(self.errorObj, innerMap, self.raceConfig)
+
+    def test_cutoffFromLastGeneration(self):
+        racer = self.racer(sr_parallel.batchMap(self.errorObj))
+        self.assertEqual(racer.cutoff(), None)
+        racer(self.errorObj, self.trees(*self.generation))
+        self.assertAlmostEqual(racer.cutoff(), self.cutoff)
+
+    def test_hopelessIndividualIsAborted(self):
+        racer = self.racer(sr_parallel.batchMap(self.errorObj))
+        racer(self.errorObj, self.trees(*self.generation))
+        #add(x, 1.0) is over the cutoff after 2 of the 4 chunks, 8 extrapolated to 16 rows
+        fitnesses = racer(self.errorObj, self.trees("add(x, 1.0)", "x"))
+        self.assertTrue(isinstance(fitnesses[0], sr_errorfuncs.racedFitness))
+        self.assertAlmostEqual(fitnesses[0][0], 16.0)
+        self.assertFalse(isinstance(fitnesses[1], sr_errorfuncs.racedFitness))
+        self.assertEqual(fitnesses[1], (0.0,))
+        self.assertEqual(racer.totals["aborted"], 1)
+
+    def test_rescoringDoesntChangeTheCutoff(self):
+        racer = self.racer(sr_parallel.batchMap(self.errorObj))
+        racer(self.errorObj, self.trees(*self.generation))
+        racer.rescoreMap(self.errorObj, self.trees("x"))
+        self.assertAlmostEqual(racer.cutoff(), self.cutoff)
+        racer(self.errorObj, self.trees("x"))
+        self.assertEqual(racer.cutoff(), 0.0)
+
+    def test_racedFitnessIsntCached(self):
+        cache = sr_cache.fitnessCache(10)
+        racer = self.racer(sr_cache.cachedMap(cache, sr_parallel.batchMap(self.errorObj)))
+        racer(self.errorObj, self.trees(*self.generation))
+        self.assertEqual(len(cache), 3)
+        (tree,) = self.trees("add(x, 2.0)")
+        (fitness,) = racer(self.errorObj, [tree])
+        self.assertTrue(isinstance(fitness, sr_errorfuncs.racedFitness))
+        self.assertEqual(cache.lookup(sr_cache.treeKey(tree)), None)
+        self.assertEqual(len(cache), 3)
+
+
+class miniBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        config = { "inVars" : ["x"], "targetVar" : "y", "constants" : [], "primitives" : ["add", "mul"] }
+        self.pset = sr_factories.psetFactory(config)
+        toolbox.register("evalTree", sr_evaluators.stackEvaluator(self.pset))
+        x = numpy.linspace(0.0, 1.0, 40)
+        self.errorObj = sr_errorfuncs.avgAbsErrorSquared(["x", "y"], [x, x * x], config)
+        self.batchMap = sr_errorfuncs.miniBatchMap(self.errorObj, sr_parallel.batchMap(self.errorObj), 5)
+
+    def trees(self, *texts):
+        return [gp.PrimitiveTree.from_string(text, self.pset) for text in texts]
+
+    def test_rescoringUsesTheGenerationsSample(self):
+        random.seed(3)
+        generation = self.batchMap(self.errorObj, self.trees("x", "add(x, x)"))
+        #Scored between generations, it has to come out the same as in the generation
+        self.assertEqual(self.batchMap.sampleMap(self.errorObj, self.trees("add(x, x)")), generation[1:])
+        self.assertNotEqual(self.batchMap(self.errorObj, self.trees("add(x, x)")), generation[1:])
+
+
+class paretoErrorWrapperTest(unittest.TestCase):
+
+    def test_fitnessesHaveEveryObjective(self):
+        config = { "inVars" : ["x"], "targetVar" : "y", "constants" : [], "primitives" : ["add", "mul"] }
+        pset = sr_factories.psetFactory(config)
+        toolbox.register("evalTree", sr_evaluators.stackEvaluator(pset))
+        x = numpy.linspace(0.0, 1.0, 8)
+        wrapper = sr_errorfuncs.paretoErrorWrapper(sr_errorfuncs.avgAbsErrorSquared(["x", "y"], [x, x], config))
+        tree = gp.PrimitiveTree.from_string("add(x, x)", pset)
+        numObjectives = len(wrapper.weight())
+        self.assertEqual(len(wrapper(tree)), numObjectives)
+        self.assertEqual(len(wrapper.invalidFitness(tree)), numObjectives)
+        self.assertEqual(len(wrapper.worstFitness()), numObjectives)
+        self.assertEqual(wrapper.worstFitness()[0], wrapper.errorFunc.worstFitness()[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
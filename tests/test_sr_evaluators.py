@@ -0,0 +1,110 @@
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Copyright (c)2016, Lawrence Livermore National Security, LLC. 
+# Produced at the Lawrence Livermore National Laboratory. 
+# Written by Jim Leek <leek2@llnl.gov>. 
+# LLNL-CODE-704100. 
+# All rights reserved.
+#
+# This file is part of SoRa.  For details, see https://github.com/llnl/SoRa.
+# Please also read SoRa/LICENSE
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Tests of the caching and incremental evaluators' keys.  Run with
+#   python -m unittest discover tests
+import os
+import random
+import sys
+import unittest
+
+import numpy
+from deap import gp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sora"))
+import sr_evaluators
+import sr_factories
+import sr_mutators
+
+
+class subtreeCachingEvaluatorTest(unittest.TestCase):
+
+    def setUp(self):
+        config = { "inVars" : ["x", "y"], "constants" : [],
+                   "primitives" : ["add", "sub", "mul", "reciprocal"] }
+        self.pset = sr_factories.psetFactory(config)
+        self.evaluator = sr_evaluators.subtreeCachingEvaluator(self.pset, 100)
+        self.inputs = [numpy.linspace(1.0, 2.0, 11), numpy.linspace(-1.0, 1.0, 11)]
+
+    def evaluate(self, text):
+        return self.evaluator(gp.PrimitiveTree.from_string(text, self.pset), self.inputs)
+
+    def test_swappedSubtreesHit(self):
+        self.evaluate("add(mul(x, y), sub(x, y))")
+        self.evaluator.takeStats()
+        self.evaluate("add(sub(x, y), mul(x, y))")
+        self.assertEqual(self.evaluator.takeStats()["hits"], 2)
+
+    def test_relocatedSubtreeHits(self):
+        self.evaluate("add(x, mul(x, y))")
+        self.evaluator.takeStats()
+        values = self.evaluate("mul(x, y)")
+        self.assertEqual(self.evaluator.takeStats()["hits"], 1)
+        numpy.testing.assert_array_equal(values, self.inputs[0] * self.inputs[1])
+
+    def test_intAndFloatConstantsDontCollide(self):
+        self.evaluate("add(x, mul(x, reciprocal(3)))")
+        values = self.evaluate("add(x, mul(x, reciprocal(3.0)))")
+        numpy.testing.assert_allclose(values, self.inputs[0] + self.inputs[0] / 3.0)
+
+
+class incrementalEvaluatorTest(unittest.TestCase):
+
+    def setUp(self):
+        config = { "inVars" : ["x", "y"], "constants" : [],
+                   "primitives" : ["add", "mul", "reciprocal"] }
+        self.pset = sr_factories.psetFactory(config)
+        self.evaluator = sr_evaluators.incrementalEvaluator(self.pset, 100)
+        self.inputs = [numpy.linspace(1.0, 2.0, 11), numpy.linspace(-1.0, 1.0, 11)]
+
+    def evaluate(self, tree):
+        return self.evaluator(tree, self.inputs)
+
+    def test_childOfFloatParentDoesntUseIntOutputs(self):
+        self.evaluate(gp.PrimitiveTree.from_string("add(y, mul(x, reciprocal(3)))", self.pset))
+        parent = gp.PrimitiveTree.from_string("add(y, mul(x, reciprocal(3.0)))", self.pset)
+        self.evaluate(parent)
+
+        def replaceY(individual):
+            individual[1] = gp.PrimitiveTree.from_string("x", self.pset)[0]
+            return (individual,)
+        (child,) = sr_mutators.recordMutation(replaceY)(parent)
+        values = self.evaluate(child)
+        self.assertEqual(self.evaluator.takeStats()["incremental"], 1)
+        numpy.testing.assert_allclose(values, self.inputs[0] + self.inputs[0] / 3.0)
+
+    def test_sameAsFullEvaluation(self):
+        #Children of mutation use their parent's outputs, children that crossover changed
+        #after the mutation carry a stale record.  Both have to come out exactly as in full.
+        random.seed(11)
+        self.addCleanup(numpy.seterr, **numpy.seterr(all='ignore'))  #y goes through 0, so reciprocal(y) is inf
+        full = sr_evaluators.stackEvaluator(self.pset)
+        mutate = sr_mutators.recordMutation(gp.mutUniform)
+        grow = lambda pset, type_: gp.genGrow(pset, 0, 2, type_)
+        population = [gp.PrimitiveTree(gp.genHalfAndHalf(self.pset, 2, 5)) for ii in range(20)]
+        for individual in population:
+            self.evaluate(individual)
+        for generation in range(3):
+            children = [mutate(gp.PrimitiveTree(individual), expr=grow, pset=self.pset)[0]
+                        for individual in population]
+            for ii in range(0, len(children) - 1, 4):
+                gp.cxOnePoint(children[ii], children[ii + 1])
+            for child in children:
+                (values, expected) = (self.evaluate(child), full(child, self.inputs))
+                #Trees without a variable in them are a single number
+                numpy.testing.assert_array_equal(numpy.broadcast_to(values, (11,)), numpy.broadcast_to(expected, (11,)))
+            population = children
+        stats = self.evaluator.takeStats()
+        self.assertTrue(stats["incremental"] > 0)
+        self.assertTrue(stats["full"] > 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
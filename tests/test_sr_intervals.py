@@ -0,0 +1,60 @@
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Copyright (c)2016, Lawrence Livermore National Security, LLC. 
+# Produced at the Lawrence Livermore National Laboratory. 
+# Written by Jim Leek <leek2@llnl.gov>. 
+# LLNL-CODE-704100. 
+# All rights reserved.
+#
+# This file is part of SoRa.  For details, see https://github.com/llnl/SoRa.
+# Please also read SoRa/LICENSE
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Tests that interval analysis only rejects trees that really are bad
+# everywhere.  Run with
+#   python -m unittest discover tests
+import os
+import sys
+import unittest
+
+import numpy
+from deap import gp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sora"))
+import sr_factories
+import sr_intervals
+
+
+class intervalAnalyzerTest(unittest.TestCase):
+
+    def setUp(self):
+        config = { "inVars" : ["x"], "constants" : [],
+                   "primitives" : ["add", "div", "neg", "exp", "sinh", "tanh", "arccosh",
+                                   "square", "sqrt", "log", "sin", "arctan"] }
+        self.pset = sr_factories.psetFactory(config)
+        self.inputs = [numpy.linspace(-1.0, 1.0, 2000)]
+        self.analyzer = sr_intervals.intervalAnalyzer(self.pset, config["inVars"], self.inputs)
+
+    def check(self, text):
+        """Evaluates the tree like sora.py does, and checks that the analyzer
+        rejects it exactly when it has no finite value."""
+        tree = gp.PrimitiveTree.from_string(text, self.pset)
+        with numpy.errstate(all='ignore'):
+            values = gp.compile(tree, self.pset)(*self.inputs) * numpy.ones(len(self.inputs[0]))
+        self.assertEqual(self.analyzer.rejects(tree), not numpy.isfinite(values).any())
+
+    def test_squashedInfIsKept(self):
+        self.check("exp(neg(exp(sinh(sinh(2.91)))))")
+        self.check("atan(exp(sinh(sinh(x))))")
+
+    def test_divideByZeroSubtreeIsKept(self):
+        self.check("tanh(div(2.0, square(acosh(square(x)))))")
+
+    def test_badEverywhereIsRejected(self):
+        self.check("exp(sinh(sinh(2.91)))")
+        self.check("sqrt(neg(add(square(x), 1.0)))")
+        self.check("div(0.0, 0.0)")
+        self.check("sin(exp(sinh(sinh(2.91))))")
+        self.check("log(neg(add(square(x), 1.0)))")
+
+
+if __name__ == "__main__":
+    unittest.main()
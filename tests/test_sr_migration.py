@@ -0,0 +1,87 @@
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Copyright (c)2016, Lawrence Livermore National Security, LLC. 
+# Produced at the Lawrence Livermore National Laboratory. 
+# Written by Jim Leek <leek2@llnl.gov>. 
+# LLNL-CODE-704100. 
+# All rights reserved.
+#
+# This file is part of SoRa.  For details, see https://github.com/llnl/SoRa.
+# Please also read SoRa/LICENSE
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Tests of the island topologies' neighbor sets, which don't need MPI, and a smoke
+# test of asynchronous migration under mpirun (see mpi_migration.py).  Run with
+#   python -m unittest discover tests
+import os
+import subprocess
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sora"))
+import sr_migration
+
+
+class migrationNeighborsTest(unittest.TestCase):
+
+    def edges(self, topology, size, epoch=0, degree=2):
+        """The (from, to) edges as the senders see them, and as the receivers see them."""
+        (sent, received) = ([], [])
+        for rank in range(size):
+            (destinations, sources) = sr_migration.migrationNeighbors(topology, rank, size, epoch, degree, 7)
+            sent += [(rank, destination) for destination in destinations]
+            received += [(source, rank) for source in sources]
+        return (sorted(sent), sorted(received))
+
+    def test_ring(self):
+        self.assertEqual(sr_migration.migrationNeighbors("ring", 0, 5), ([1], [4]))
+        self.assertEqual(sr_migration.migrationNeighbors("ring", 4, 5), ([0], [3]))
+
+    def test_torus(self):
+        self.assertEqual(sr_migration.torusDims(12), (3, 4))
+        self.assertEqual(sr_migration.migrationNeighbors("torus", 5, 12), ([1, 9, 4, 6], [1, 9, 4, 6]))
+        #On a 2x2 grid up and down (and left and right) are the same rank
+        self.assertEqual(sr_migration.migrationNeighbors("torus", 0, 4), ([2, 1], [2, 1]))
+
+    def test_hypercube(self):
+        self.assertEqual(sr_migration.migrationNeighbors("hypercube", 5, 8), ([4, 7, 1], [4, 7, 1]))
+        #Corners past the last rank aren't there
+        self.assertEqual(sr_migration.migrationNeighbors("hypercube", 5, 6), ([4, 1], [4, 1]))
+
+    def test_everyMessageIsReceived(self):
+        for (topology, size) in [("ring", 7), ("torus", 12), ("torus", 7), ("hypercube", 6), ("random", 9)]:
+            (sent, received) = self.edges(topology, size)
+            self.assertEqual(sent, received, topology)
+
+    def test_randomGraph(self):
+        (sent, received) = self.edges("random", 9, epoch=3, degree=3)
+        self.assertEqual(len(sent), 27)
+        for rank in range(9):
+            self.assertEqual(sum(1 for (source, destination) in sent if source == rank), 3)
+            self.assertEqual(sum(1 for (source, destination) in sent if destination == rank), 3)
+            self.assertTrue((rank, rank) not in sent)
+        self.assertNotEqual(self.edges("random", 9, epoch=4, degree=3)[0], sent)
+
+    def test_oneIsland(self):
+        for topology in ["ring", "torus", "hypercube", "random"]:
+            self.assertEqual(sr_migration.migrationNeighbors(topology, 0, 1), ([], []))
+
+
+class asynchronousStarTest(unittest.TestCase):
+
+    def test_mpirun(self):
+        if(not sr_migration.hasMPI):
+            self.skipTest("mpi4py is not installed")
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mpi_migration.py")
+        try:
+            #os.environ is from before importing mpi4py started MPI here, mpirun mustn't
+            #see the variables that put in the real environment
+            process = subprocess.Popen(["mpirun", "-n", "3", sys.executable, script], env=dict(os.environ),
+                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except OSError:
+            self.skipTest("mpirun is not installed")
+        output = process.communicate()[0]
+        lines = sorted(line for line in output.splitlines() if line.startswith("rank "))
+        self.assertEqual(lines, ["rank 0 ok", "rank 1 ok", "rank 2 ok"], output)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Copyright (c)2016, Lawrence Livermore National Security, LLC. 
+# Produced at the Lawrence Livermore National Laboratory. 
+# Written by Jim Leek <leek2@llnl.gov>. 
+# LLNL-CODE-704100. 
+# All rights reserved.
+#
+# This file is part of SoRa.  For details, see https://github.com/llnl/SoRa.
+# Please also read SoRa/LICENSE
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Tests that simplified trees compute exactly the same values, signed zeros
+# included.  Run with
+#   python -m unittest discover tests
+import os
+import sys
+import unittest
+
+import numpy
+from deap import gp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sora"))
+import sr_factories
+import sr_simplify
+
+
+class simplifierTest(unittest.TestCase):
+
+    def setUp(self):
+        config = { "inVars" : ["x", "y"], "constants" : [],
+                   "primitives" : ["add", "sub", "mul", "sqrt", "square"] }
+        self.pset = sr_factories.psetFactory(config)
+        self.inputs = [numpy.linspace(0.0, 2.0, 11), numpy.linspace(-1.0, 1.0, 11)]
+        self.simplifier = sr_simplify.simplifier(self.pset, config["inVars"], self.inputs)
+
+    def evaluate(self, tree):
+        with numpy.errstate(all='ignore'):
+            return gp.compile(tree, self.pset)(*self.inputs) * numpy.ones(len(self.inputs[0]))
+
+    def check(self, text, simplified):
+        """Checks the tree simplifies to simplified, and still computes exactly the same values."""
+        tree = gp.PrimitiveTree.from_string(text, self.pset)
+        before = self.evaluate(tree)
+        self.simplifier.simplify(tree)
+        self.assertEqual(str(tree), simplified)
+        after = self.evaluate(tree)
+        numpy.testing.assert_array_equal(after, before)
+        numpy.testing.assert_array_equal(numpy.signbit(after), numpy.signbit(before))
+
+    def test_mulByNegativeZeroKeepsTheSign(self):
+        self.check("mul(square(y), -0.0)", "-0.0")
+        self.check("mul(0.0, sqrt(x))", "0.0")
+
+    def test_subNegativeZero(self):
+        self.check("sub(sqrt(x), 0.0)", "sqrt(x)")
+        self.check("sub(mul(y, 0.0), -0.0)", "sub(mul(0.0, y), -0.0)")
+        self.check("sub(x, -0.0)", "x")
+
+
+class foldedEphemeralTest(unittest.TestCase):
+
+    def setUp(self):
+        config = { "inVars" : ["x"], "constants" : [{ "type" : "randint", "min" : 1, "max" : 5 }],
+                   "primitives" : ["add", "mul"] }
+        self.pset = sr_factories.psetFactory(config)
+        self.simplifier = sr_simplify.simplifier(self.pset)
+        self.ephemeralClass = self.simplifier.ephemeralClass
+
+    def ephemeral(self, value):
+        node = self.ephemeralClass.__new__(self.ephemeralClass)
+        gp.Terminal.__init__(node, value, False, self.pset.ret)
+        return node
+
+    def test_foldedConstantIsStillEphemeral(self):
+        tree = gp.PrimitiveTree.from_string("add(x, add(2, 3))", self.pset)
+        tree[3] = self.ephemeral(2)
+        tree[4] = self.ephemeral(3)
+        self.simplifier.simplify(tree)
+        self.assertEqual(str(tree), "add(5, x)")
+        self.assertTrue(isinstance(tree[1], self.ephemeralClass))
+        self.assertEqual(tree[1].value, 5)
+        folded = tree[1]
+        gp.mutEphemeral(tree, "all")
+        self.assertTrue(tree[1] is not folded)
+        self.assertTrue(1 <= tree[1].value <= 5)
+
+
+if __name__ == "__main__":
+    unittest.main()